@@ -0,0 +1,74 @@
+"""Compare the image mode conversions in mezcal.convert against the
+per-pixel implementations that MezzanineFile.create used previously.
+
+Usage: python benchmarks/convert.py [--megapixels N] [--repeat N]
+"""
+import argparse
+import os
+from struct import unpack
+from time import perf_counter
+
+from PIL import Image
+
+from mezcal.convert import convert_to_jpeg_mode
+
+
+def legacy_convert_I16_to_L(img: Image.Image) -> Image.Image:
+    return img.point(lambda i: i / 256).convert('L')
+
+
+def legacy_convert_I16B_to_L(img: Image.Image) -> Image.Image:
+    byte_format = f'>{img.width * img.height}H'
+    pixels = unpack(byte_format, img.tobytes())
+    scaled_pixels = bytes((int(pixel / 256) for pixel in pixels))
+    return Image.frombytes('L', (img.width, img.height), scaled_pixels, 'raw')
+
+
+def make_image(mode: str, size: tuple[int, int]) -> Image.Image:
+    img = Image.new(mode, size)
+    # fill with noise so the conversions can't take any shortcuts
+    img.frombytes(os.urandom(len(img.tobytes())))
+    return img
+
+
+def best_of(repeat: int, func, img: Image.Image) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func(img)
+        timings.append(perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megapixels', type=float, default=10, help='size of the synthetic images (default: 10)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per conversion (default: 3)')
+    args = parser.parse_args()
+
+    side = int((args.megapixels * 1_000_000) ** 0.5)
+    size = (side, side)
+    print(f'Image size: {side}x{side} ({side * side / 1_000_000:.1f} MP), best of {args.repeat}')
+    print(f'{"mode":<8}{"legacy (s)":>12}{"current (s)":>13}{"speedup":>10}')
+
+    cases = [
+        ('I;16', legacy_convert_I16_to_L),
+        ('I;16B', legacy_convert_I16B_to_L),
+        ('I', None),
+        ('F', None),
+        ('LA', None),
+        ('RGBA', None),
+        ('P', None),
+    ]
+    for mode, legacy in cases:
+        img = make_image(mode, size)
+        current_time = best_of(args.repeat, convert_to_jpeg_mode, img)
+        if legacy is not None:
+            legacy_time = best_of(args.repeat, legacy, img)
+            print(f'{mode:<8}{legacy_time:>12.3f}{current_time:>13.3f}{legacy_time / current_time:>9.1f}x')
+        else:
+            print(f'{mode:<8}{"-":>12}{current_time:>13.3f}{"-":>10}')
+
+
+if __name__ == '__main__':
+    main()
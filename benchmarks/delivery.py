@@ -0,0 +1,120 @@
+"""Compare the cache hit throughput of the server when it sends cached files
+itself, and when it hands them off to a front proxy with X-Accel-Redirect
+or X-Sendfile.
+
+Each mode is served by waitress in a separate process, with a synthetic
+cached file, and requested by --clients concurrent keep-alive connections.
+In the proxy modes, this measures the requests the server can answer;
+the proxy's own sendfile() of the file is not included, since there is no
+proxy in front of the server here.
+
+Usage: python benchmarks/delivery.py [--file-size N] [--requests N] [--clients N] [--threads N]
+"""
+import argparse
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from multiprocessing import get_context
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+from waitress import serve
+
+from mezcal.delivery import DeliveryMode, ProxyDelivery
+from mezcal.http import OriginRepository, RepositoryAuthType
+from mezcal.storage import LocalStorage
+from mezcal.web import create_app
+
+MODES = {
+    'direct': None,
+    'x-accel-redirect': (DeliveryMode.X_ACCEL_REDIRECT, '/_mezcal/'),
+    'x-sendfile': (DeliveryMode.X_SENDFILE, ''),
+}
+
+
+def run_server(storage_dir: Path, port: int, mode: str, threads: int):
+    delivery = ProxyDelivery(MODES[mode][0], storage_dir, MODES[mode][1]) if MODES[mode] else None
+    app = create_app(
+        local_storage=LocalStorage(storage_dir),
+        origin_repo=OriginRepository(base_url='http://localhost/'),
+        auth_type=RepositoryAuthType.NONE,
+        delivery=delivery,
+    )
+    # the per-request logging would otherwise dominate the timings
+    app.logger.setLevel('WARNING')
+    serve(app, listen=f'127.0.0.1:{port}', threads=threads, _quiet=True)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port: int):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            sleep(0.1)
+    raise RuntimeError(f'Server on port {port} did not start')
+
+
+def client(port: int, count: int) -> int:
+    """Make count requests over one keep-alive connection, and return the number of body bytes received."""
+    received = 0
+    connection = HTTPConnection('127.0.0.1', port)
+    for _ in range(count):
+        connection.request('GET', '/images/foo')
+        response = connection.getresponse()
+        received += len(response.read())
+        if response.status != 200:
+            raise RuntimeError(f'Unexpected response status {response.status}')
+    connection.close()
+    return received
+
+
+def benchmark(storage_dir: Path, mode: str, args) -> tuple[float, float]:
+    """Return the requests per second and MB per second sent by the server in mode."""
+    port = free_port()
+    process = get_context('spawn').Process(target=run_server, args=(storage_dir, port, mode, args.threads))
+    process.start()
+    try:
+        wait_for(port)
+        # warm up the connection pool and page cache
+        client(port, 10)
+        per_client = args.requests // args.clients
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            received = sum(executor.map(client, [port] * args.clients, [per_client] * args.clients))
+        elapsed = perf_counter() - start
+    finally:
+        process.terminate()
+        process.join()
+    return per_client * args.clients / elapsed, received / elapsed / 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--file-size', type=int, default=2_000_000, help='cached file size (default: 2000000)')
+    parser.add_argument('--requests', type=int, default=2000, help='total requests per mode (default: 2000)')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent connections (default: 8)')
+    parser.add_argument('--threads', type=int, default=8, help='waitress threads (default: 8)')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as temp_dir:
+        storage_dir = Path(temp_dir)
+        (storage_dir / 'foo').mkdir()
+        (storage_dir / 'foo' / 'image.jpg').write_bytes(os.urandom(args.file_size))
+        print(f'File size: {args.file_size / 1_000_000:.1f} MB, {args.clients} clients, {args.threads} threads')
+        print(f'{"":<18}{"requests/s":>12}{"MB/s sent":>12}')
+        for mode in MODES:
+            rate, throughput = benchmark(storage_dir, mode, args)
+            print(f'{mode:<18}{rate:>12.0f}{throughput:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
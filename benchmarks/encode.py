@@ -0,0 +1,96 @@
+"""Compare the size and encoding time of mezzanine JPEGs with different
+JPEG encoder settings, and the time to scale down a large source image
+with and without reduce-on-decode.
+
+The encoder settings are the ones that can be set with the JPEG_QUALITY,
+JPEG_SUBSAMPLING, JPEG_PROGRESSIVE, and JPEG_OPTIMIZE environment variables.
+
+Usage: python benchmarks/encode.py [--megapixels N] [--max-size N] [--repeat N]
+"""
+import argparse
+from io import BytesIO
+from itertools import product
+from time import perf_counter
+
+from PIL import Image
+
+from mezcal.pyramid import write_pyramid
+from mezcal.resize import fit, open_image, downscale
+from mezcal.storage import EncodingOptions
+
+
+def make_image(size: tuple[int, int]) -> Image.Image:
+    # a smooth image, since noise would make the JPEG compression unrealistically bad
+    return Image.merge('RGB', [
+        Image.linear_gradient('L').resize(size),
+        Image.radial_gradient('L').resize(size),
+        Image.linear_gradient('L').rotate(90).resize(size),
+    ])
+
+
+def best_of(repeat: int, func, *args) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func(*args)
+        timings.append(perf_counter() - start)
+    return min(timings)
+
+
+def encode(img: Image.Image, options: EncodingOptions) -> bytes:
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', **options.jpeg_save_args(img.mode))
+    return buffer.getvalue()
+
+
+def full_decode(data: bytes, max_size: int) -> Image.Image:
+    # decode at full resolution, and resample straight to the final size
+    img = Image.open(BytesIO(data))
+    img.load()
+    return img.resize(fit(img.size, max_size), Image.LANCZOS)
+
+
+def reduced_decode(data: bytes, max_size: int) -> Image.Image:
+    return downscale(open_image(BytesIO(data), max_size), max_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megapixels', type=float, default=25, help='size of the synthetic image (default: 25)')
+    parser.add_argument(
+        '--max-size', type=int, default=2000, help='maximum width or height to scale down to (default: 2000)'
+    )
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per setting (default: 3)')
+    args = parser.parse_args()
+
+    side = int((args.megapixels * 1_000_000) ** 0.5)
+    img = make_image((side, side))
+    print(f'Image size: {side}x{side} ({side * side / 1_000_000:.1f} MP), best of {args.repeat}')
+    print()
+
+    print(f'{"quality":<9}{"subsampling":<13}{"progressive":<13}{"optimize":<10}{"encode (s)":>12}{"size (MB)":>11}')
+    settings = product((75, 90), ('4:2:0', '4:4:4'), (False, True), (False, True))
+    for quality, subsampling, progressive, optimize in settings:
+        options = EncodingOptions(quality=quality, subsampling=subsampling, progressive=progressive, optimize=optimize)
+        encode_time = best_of(args.repeat, encode, img, options)
+        size = len(encode(img, options))
+        print(
+            f'{quality:<9}{subsampling:<13}{str(progressive):<13}{str(optimize):<10}'
+            f'{encode_time:>12.3f}{size / 1_000_000:>11.2f}'
+        )
+    print()
+
+    jpeg = BytesIO()
+    img.save(jpeg, format='JPEG')
+    tiff = BytesIO()
+    write_pyramid(img, tiff)
+    print(f'Scale down to {args.max_size}px')
+    print(f'{"source":<10}{"full (s)":>12}{"reduced (s)":>13}{"speedup":>10}')
+    for name, data in (('JPEG', jpeg.getvalue()), ('TIFF', tiff.getvalue())):
+        full_time = best_of(args.repeat, full_decode, data, args.max_size)
+        reduced_time = best_of(args.repeat, reduced_decode, data, args.max_size)
+        print(f'{name:<10}{full_time:>12.3f}{reduced_time:>13.3f}{full_time / reduced_time:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
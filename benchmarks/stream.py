@@ -0,0 +1,117 @@
+"""Compare the peak memory use and time of creating a mezzanine file from a
+large uncompressed TIFF, decoded all at once and streamed in bands.
+
+The synthetic TIFF is written a few rows at a time, so that the benchmark
+itself can make sources larger than the available memory. Each run is done
+in a new process, and its peak memory is the maximum resident set size of
+that process.
+
+Usage: python benchmarks/stream.py [--megapixels N] [--mode MODE] [--working-set N] [--max-size N]
+"""
+import argparse
+import resource
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from PIL import Image
+
+from mezcal.pyramid import (
+    write_ifd, SHORT, LONG, IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, COMPRESSION, PHOTOMETRIC_INTERPRETATION,
+    SAMPLES_PER_PIXEL, PLANAR_CONFIGURATION,
+)
+from mezcal.storage import MezzanineFile, EncodingOptions
+
+# the synthetic images are meant to be large
+Image.MAX_IMAGE_PIXELS = None
+
+STRIP_OFFSETS = 273
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+
+# bits per sample, samples per pixel, and photometric interpretation
+MODES = {
+    'L': (8, 1, 1),
+    'I;16': (16, 1, 1),
+    'RGB': (8, 3, 2),
+}
+
+
+def write_tiff(path: Path, side: int, mode: str, rows_per_strip: int = 64):
+    """Write a side x side uncompressed, striped TIFF filled with a gradient."""
+    bits, samples, photometric = MODES[mode]
+    row_size = side * samples * bits // 8
+    row = bytes(n % 256 for n in range(row_size))
+    strips = range(0, side, rows_per_strip)
+    with path.open('wb') as fh:
+        fh.write(b'II*\x00\x00\x00\x00\x00')
+        offsets, byte_counts = [], []
+        for top in strips:
+            rows = min(rows_per_strip, side - top)
+            offsets.append(fh.tell())
+            byte_counts.append(row_size * rows)
+            fh.write(row * rows)
+        if fh.tell() % 2:
+            fh.write(b'\x00')
+        ifd_offset = fh.tell()
+        write_ifd(fh, 0, [
+            (IMAGE_WIDTH, LONG, [side]),
+            (IMAGE_LENGTH, LONG, [side]),
+            (BITS_PER_SAMPLE, SHORT, [bits] * samples),
+            (COMPRESSION, SHORT, [1]),
+            (PHOTOMETRIC_INTERPRETATION, SHORT, [photometric]),
+            (STRIP_OFFSETS, LONG, offsets),
+            (SAMPLES_PER_PIXEL, SHORT, [samples]),
+            (ROWS_PER_STRIP, LONG, [rows_per_strip]),
+            (STRIP_BYTE_COUNTS, LONG, byte_counts),
+            (PLANAR_CONFIGURATION, SHORT, [1]),
+        ])
+        fh.seek(4)
+        fh.write(struct.pack('<I', ifd_offset))
+
+
+def create(source: Path, options: EncodingOptions) -> tuple[float, int]:
+    """Create a mezzanine file from source, and return the time taken and the peak memory use in MB."""
+    start = perf_counter()
+    MezzanineFile(source.with_name('image.jpg'), options=options).encode(source)
+    elapsed = perf_counter() - start
+    # bytes on macOS, kilobytes everywhere else
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, max_rss // (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_in_new_process(source: Path, options: EncodingOptions) -> tuple[float, int]:
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(create, source, options).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megapixels', type=float, default=100, help='size of the synthetic image (default: 100)')
+    parser.add_argument('--mode', choices=MODES.keys(), default='I;16', help='mode of the synthetic image')
+    parser.add_argument(
+        '--working-set', type=int, default=64 * 1024 * 1024, help='bytes per streamed band (default: 64 MiB)'
+    )
+    parser.add_argument('--max-size', type=int, default=0, help='maximum mezzanine width or height (default: none)')
+    args = parser.parse_args()
+
+    side = int((args.megapixels * 1_000_000) ** 0.5)
+    with TemporaryDirectory() as temp_dir:
+        source = Path(temp_dir) / 'source.tif'
+        write_tiff(source, side, args.mode)
+        print(
+            f'Image size: {side}x{side} ({side * side / 1_000_000:.1f} MP, {args.mode}), '
+            f'{source.stat().st_size / 1_000_000:.0f} MB'
+        )
+        print(f'{"":<12}{"time (s)":>10}{"peak (MB)":>11}')
+        for name, working_set in (('all at once', 0), ('streamed', args.working_set)):
+            elapsed, peak = run_in_new_process(source, EncodingOptions(max_size=args.max_size, working_set=working_set))
+            print(f'{name:<12}{elapsed:>10.2f}{peak:>11}')
+
+
+if __name__ == '__main__':
+    main()
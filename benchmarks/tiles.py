@@ -0,0 +1,99 @@
+"""Compare the cost of extracting tiles from a flat mezzanine JPEG against
+a tiled pyramidal TIFF, the way a IIIF image server would.
+
+For the flat JPEG, every tile request has to decode the whole image (or,
+for reduced sizes, a draft-mode decode of it) and crop the tile out of it.
+For the pyramidal TIFF, only the one JPEG-compressed tile at the closest
+resolution level is read and decoded.
+
+Usage: python benchmarks/tiles.py [--megapixels N] [--repeat N] [--tile-size N]
+"""
+import argparse
+from io import BytesIO
+from time import perf_counter
+
+from PIL import Image
+
+from mezcal.pyramid import write_pyramid, TILE_OFFSETS, TILE_BYTE_COUNTS
+
+
+def make_image(size: tuple[int, int]) -> Image.Image:
+    # a smooth image, since noise would make the JPEG compression unrealistically bad
+    return Image.merge('RGB', [
+        Image.linear_gradient('L').resize(size),
+        Image.radial_gradient('L').resize(size),
+        Image.linear_gradient('L').rotate(90).resize(size),
+    ])
+
+
+def jpeg_tile(data: bytes, scale: int, box: tuple[int, int, int, int]) -> Image.Image:
+    img = Image.open(BytesIO(data))
+    size = (img.width // scale, img.height // scale)
+    if scale > 1:
+        # the JPEG decoder can decode at 1/2, 1/4, or 1/8 scale; anything smaller is resized from that
+        img.draft('RGB', size)
+        if img.size != size:
+            img = img.resize(size)
+    return img.crop(box)
+
+
+def tiff_tile(data: bytes, level: int, index: int) -> Image.Image:
+    img = Image.open(BytesIO(data))
+    img.seek(level)
+    offsets, byte_counts = img.tag_v2[TILE_OFFSETS], img.tag_v2[TILE_BYTE_COUNTS]
+    if isinstance(offsets, int):
+        # levels with a single tile
+        offsets, byte_counts = (offsets,), (byte_counts,)
+    # each tile is a complete JPEG stream
+    tile = Image.open(BytesIO(data[offsets[index]:offsets[index] + byte_counts[index]]))
+    tile.load()
+    return tile
+
+
+def best_of(repeat: int, func, *args) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func(*args)
+        timings.append(perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megapixels', type=float, default=25, help='size of the synthetic image (default: 25)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per tile (default: 3)')
+    parser.add_argument('--tile-size', type=int, default=256, help='tile size of the pyramid (default: 256)')
+    args = parser.parse_args()
+
+    side = int((args.megapixels * 1_000_000) ** 0.5)
+    img = make_image((side, side))
+    print(f'Image size: {side}x{side} ({side * side / 1_000_000:.1f} MP), best of {args.repeat}')
+
+    jpeg = BytesIO()
+    start = perf_counter()
+    img.save(jpeg, format='JPEG')
+    jpeg_encode = perf_counter() - start
+    tiff = BytesIO()
+    start = perf_counter()
+    write_pyramid(img, tiff, tile_size=args.tile_size)
+    tiff_encode = perf_counter() - start
+    jpeg_data, tiff_data = jpeg.getvalue(), tiff.getvalue()
+    print(f'{"":<18}{"JPEG":>12}{"TIFF":>12}')
+    print(f'{"encode (s)":<18}{jpeg_encode:>12.3f}{tiff_encode:>12.3f}')
+    print(f'{"size (MB)":<18}{len(jpeg_data) / 1_000_000:>12.1f}{len(tiff_data) / 1_000_000:>12.1f}')
+    print()
+
+    print(f'{"level":<8}{"scale":>6}{"JPEG (ms)":>12}{"TIFF (ms)":>12}{"speedup":>10}')
+    pyramid = Image.open(BytesIO(tiff_data))
+    for level in range(pyramid.n_frames):
+        scale = 2 ** level
+        # the top left tile of each level
+        box = (0, 0, min(args.tile_size, side // scale), min(args.tile_size, side // scale))
+        jpeg_time = best_of(args.repeat, jpeg_tile, jpeg_data, scale, box)
+        tiff_time = best_of(args.repeat, tiff_tile, tiff_data, level, 0)
+        print(f'{level:<8}{scale:>6}{jpeg_time * 1000:>12.1f}{tiff_time * 1000:>12.1f}{jpeg_time / tiff_time:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
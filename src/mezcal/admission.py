@@ -0,0 +1,214 @@
+"""Admission control for the work done on cache misses.
+
+Without a limit, every server thread can be fetching from the origin and
+encoding at the same time (for example, when a crawler walks through
+uncached paths), which leaves no threads or CPU for cache hits, and sends
+the origin as many requests as there are threads.
+
+A Limiter allows up to limit callers at a time into a block of code, and
+queues up to queue_size more, in the order they arrived. A caller that
+finds the queue full, or that waits longer than timeout seconds, gets an
+Overloaded exception right away, which the applications answer with a
+503 Service Unavailable response and a Retry-After header, instead of
+tying up a thread until LOCK_TIMEOUT. Cache hits never go through a
+Limiter.
+
+The same Limiter can be used from threads (slot()) and from an asyncio
+event loop (async_slot()); waiting in async_slot() does not block the
+loop or use a thread. Background work that can be put off, such as
+revalidation, uses try_slot(), which never queues, so it only runs when
+there is a slot to spare."""
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from threading import Event, Lock
+from typing import Callable, Optional
+
+from mezcal.metrics import Timer, ADMISSION_ACTIVE, ADMISSION_QUEUED, ADMISSION_REJECTIONS, ADMISSION_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a caller is not admitted by a Limiter. This is not a
+    RuntimeError, so that it is never mistaken for an origin failure (and
+    remembered by the negative cache)."""
+
+    def __init__(self, limiter: 'Limiter', reason: str):
+        super().__init__(f'Too many {limiter.name} requests in progress ({reason})')
+        self.reason = reason
+        self.retry_after = limiter.retry_after
+
+
+class Limiter:
+    """Allows up to limit callers in at once, with up to queue_size waiting.
+
+    When a caller leaves, its slot is handed directly to the first waiting
+    caller, so that callers that arrive later can't take it first."""
+
+    def __init__(self, name: str, limit: int, queue_size: int = 0, timeout: float = 10, retry_after: int = 5):
+        if limit < 1:
+            raise RuntimeError(f'Concurrency limit for {name} must be at least 1')
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._lock = Lock()
+        self._active = 0
+        # functions that wake each waiting caller
+        self._waiters: deque[Callable[[], None]] = deque()
+        self.counts = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timed_out': 0}
+        self._active_gauge = ADMISSION_ACTIVE.labels(name)
+        self._queued_gauge = ADMISSION_QUEUED.labels(name)
+        self._rejections = ADMISSION_REJECTIONS.labels(name, 'full')
+        self._timeouts = ADMISSION_REJECTIONS.labels(name, 'timeout')
+        self._wait_seconds = ADMISSION_WAIT_SECONDS.labels(name)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'queue_size': self.queue_size,
+            'active': self._active,
+            'waiting': len(self._waiters),
+            **self.counts,
+        }
+
+    def _take(self) -> bool:
+        """Take a slot and return True if one is free. The caller must hold the lock."""
+        if self._active < self.limit and not self._waiters:
+            self._active += 1
+            self.counts['admitted'] += 1
+            self._active_gauge.set(self._active)
+            return True
+        return False
+
+    def _enter(self, wake: Callable[[], None]) -> bool:
+        """Take a slot and return True if one is free, otherwise queue wake
+        and return False. Raises Overloaded if the queue is full."""
+        with self._lock:
+            if self._take():
+                return True
+            if len(self._waiters) >= self.queue_size:
+                self.counts['rejected'] += 1
+                self._rejections.inc()
+                raise Overloaded(self, 'queue is full')
+            self._waiters.append(wake)
+            self.counts['queued'] += 1
+            self._queued_gauge.set(len(self._waiters))
+            return False
+
+    def _give_up(self, wake: Callable[[], None]) -> bool:
+        """Remove wake from the queue, after its caller stopped waiting. Returns
+        False if it was already given a slot, which the caller now holds."""
+        with self._lock:
+            try:
+                self._waiters.remove(wake)
+            except ValueError:
+                return False
+            self._queued_gauge.set(len(self._waiters))
+            return True
+
+    def _timed_out(self) -> Overloaded:
+        with self._lock:
+            self.counts['timed_out'] += 1
+        self._timeouts.inc()
+        logger.warning(f'Waited more than {self.timeout}s for a {self.name} slot')
+        return Overloaded(self, f'waited more than {self.timeout}s')
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # the slot passes to the waiter, so the number of active callers stays the same
+                wake = self._waiters.popleft()
+                self.counts['admitted'] += 1
+                self._queued_gauge.set(len(self._waiters))
+                wake()
+            else:
+                self._active -= 1
+                self._active_gauge.set(self._active)
+
+    def acquire(self):
+        """Wait for a slot. Raises Overloaded if the queue is full, or no slot
+        is free within timeout seconds."""
+        event = Event()
+        if self._enter(event.set):
+            return
+        with Timer('wait for a %s slot', self.name, histogram=self._wait_seconds, stage='queue', logger=logger):
+            if not event.wait(self.timeout) and self._give_up(event.set):
+                raise self._timed_out()
+
+    async def acquire_async(self):
+        """Wait for a slot, without blocking the event loop. Raises Overloaded
+        if the queue is full, or no slot is free within timeout seconds."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            # called from whichever thread releases the slot
+            loop.call_soon_threadsafe(future.set_result, None)
+
+        if self._enter(wake):
+            return
+        with Timer('wait for a %s slot', self.name, histogram=self._wait_seconds, stage='queue', logger=logger):
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                if self._give_up(wake):
+                    raise self._timed_out()
+            except asyncio.CancelledError:
+                if not self._give_up(wake):
+                    # given a slot just as the request was cancelled
+                    self.release()
+                raise
+
+    def try_acquire(self) -> bool:
+        """Take a slot and return True if one is free right now, without
+        queueing. This is for work that can be skipped, so a False is not
+        counted as a rejection."""
+        with self._lock:
+            return self._take()
+
+    @contextmanager
+    def try_slot(self):
+        """Like slot(), but raises Overloaded if no slot is free right now, instead of waiting."""
+        if not self.try_acquire():
+            raise Overloaded(self, 'no free slot')
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        await self.acquire_async()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def admit(limiter: Optional[Limiter]):
+    """Context manager for a slot in limiter, or that does nothing if it is None."""
+    return limiter.slot() if limiter is not None else nullcontext()
+
+
+def admit_now(limiter: Optional[Limiter]):
+    """Context manager for a slot in limiter if one is free right now, or that
+    does nothing if it is None."""
+    return limiter.try_slot() if limiter is not None else nullcontext()
+
+
+def admit_async(limiter: Optional[Limiter]):
+    """Async context manager for a slot in limiter, or that does nothing if it is None."""
+    return limiter.async_slot() if limiter is not None else nullcontext()
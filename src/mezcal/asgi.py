@@ -0,0 +1,640 @@
+"""Asynchronous (ASGI) version of the mezcal web application.
+
+Cache hits are streamed from the event loop, with file reads done in a
+small thread pool, so open connections don't each need a server thread.
+Cache misses run in an executor thread, which holds the file lock (so
+that other processes and nodes don't fetch the same image), while the
+origin response is awaited on the event loop with an asynchronous HTTP
+client, and then does the CPU-bound decoding and encoding.
+
+This requires the optional "asgi" dependencies (httpx and uvicorn).
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Callable, Optional
+from urllib.parse import parse_qs
+
+import httpx
+import requests
+from filelock import Timeout
+from requests.auth import AuthBase
+from werkzeug.http import is_resource_modified, http_date, parse_range_header, quote_etag
+
+from mezcal.admission import Limiter, Overloaded, admit, admit_async
+from mezcal.delivery import ProxyDelivery
+from mezcal.http import (
+    OriginRepository, NotAnImageError, OriginTooLargeError, OriginStatusError, RepositoryAuthType, SpooledBody,
+    RETRY_STATUS_CODES, SPOOL_CHUNK_SIZE, get_content_length, get_origin_digest,
+)
+from mezcal.index import CacheIndex
+from mezcal.memory import MemoryCache
+from mezcal.negative import NegativeCache
+from mezcal.metrics import (
+    Timer, REGISTRY, CONTENT_TYPE, CACHE_HITS, CACHE_MISSES, NEGATIVE_CACHE_HITS, IN_FLIGHT_MISSES, REQUEST_SECONDS,
+    ORIGIN_REQUEST_SECONDS, ORIGIN_DOWNLOAD_SECONDS, ORIGIN_BYTES, ORIGIN_ERRORS,
+)
+from mezcal.revalidate import Revalidator, record_origin_metadata
+from mezcal.storage import LocalStorage, MezzanineFile, FileInfo
+from mezcal.trace import Trace, TraceLog, current_trace
+from mezcal.web import get_authenticator, get_auth_type, LOCK_TIMEOUT, DEFAULT_CACHE_CONTROL, REMOVED_RETRY_AFTER
+
+logger = logging.getLogger(__name__)
+
+# size of the reads when sending a cached file
+SEND_CHUNK_SIZE = 256 * 1024
+
+
+class RequestsAuth(httpx.Auth):
+    """Adapts a Requests authenticator (as returned by get_authenticator) for use with httpx."""
+
+    def __init__(self, auth: AuthBase):
+        self.auth = auth
+
+    def auth_flow(self, request: httpx.Request):
+        prepared = self.auth(requests.Request('GET', str(request.url)).prepare())
+        if 'Authorization' in prepared.headers:
+            request.headers['Authorization'] = prepared.headers['Authorization']
+        yield request
+
+
+class AsyncOriginRepository:
+    """Asynchronous client for the origin repository, with the same
+    connection pool size, timeouts, retries, and size limits as the
+    given OriginRepository."""
+
+    def __init__(
+            self,
+            origin_repo: OriginRepository,
+            auth: Optional[AuthBase] = None,
+            transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.origin_repo = origin_repo
+        self.base_url = origin_repo.base_url
+        self.max_retries = origin_repo.retry.total
+        self.backoff_factor = origin_repo.retry.backoff_factor
+        connect_timeout, read_timeout = origin_repo.timeout
+        limits = httpx.Limits(
+            max_connections=origin_repo.pool_size,
+            max_keepalive_connections=origin_repo.pool_size,
+        )
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=limits,
+            transport=transport,
+            auth=RequestsAuth(auth) if auth is not None else None,
+        )
+        self.requests = 0
+
+    @property
+    def pool_stats(self) -> dict:
+        """The size of the connection pool, and the total number of requests
+        sent; httpx doesn't expose its connection counts."""
+        return {'size': self.origin_repo.pool_size, 'requests': self.requests}
+
+    async def _get(self, url: str) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                self.requests += 1
+                response = await self.client.send(self.client.build_request('GET', url), stream=True)
+            except httpx.HTTPError as e:
+                if attempt >= self.max_retries:
+                    ORIGIN_ERRORS.inc()
+                    logger.error(f'Unable to retrieve {url}: {e}')
+                    raise RuntimeError('Unable to retrieve resource') from e
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+            attempt += 1
+
+    async def request(self, repo_path: str) -> httpx.Response:
+        """Request an image from the origin, the same way as OriginRepository.get().
+        Returns the response, whose body has not been read yet; pass it to
+        spool(), or close it."""
+        url = self.base_url + repo_path
+        logger.debug('Requesting from %s', url)
+        with Timer(
+            'request origin image %s', repo_path,
+            histogram=ORIGIN_REQUEST_SECONDS,
+            stage='origin',
+            logger=logger,
+        ):
+            response = await self._get(url)
+        try:
+            if not response.is_success:
+                ORIGIN_ERRORS.inc()
+                logger.error(f'Unable to retrieve {url}: {response.status_code} {response.reason_phrase}')
+                raise OriginStatusError('Unable to retrieve resource', status=response.status_code)
+
+            content_type = response.headers.get('Content-Type', '')
+            if not content_type.startswith('image/'):
+                logger.error(f'Resource at {url} is not an image; response Content-Type is "{content_type}"')
+                raise NotAnImageError
+
+            max_size = self.origin_repo.max_size
+            content_length = get_content_length(response.headers)
+            if max_size and content_length > max_size:
+                logger.error(f'Content-Length of {repo_path} is {content_length}; maximum is {max_size}')
+                raise OriginTooLargeError('Origin resource is too large')
+        except BaseException:
+            await response.aclose()
+            raise
+        return response
+
+    async def spool(self, repo_path: str, response: httpx.Response) -> SpooledBody:
+        """Read the body of an origin response from request() into a SpooledBody,
+        the same way as OriginRepository.spool(), and close the response."""
+        try:
+            body = SpooledBody(memory_limit=self.origin_repo.spool_memory_limit, spool_dir=self.origin_repo.spool_dir)
+            try:
+                with Timer(
+                    'spool origin image %s', repo_path,
+                    histogram=ORIGIN_DOWNLOAD_SECONDS,
+                    stage='download',
+                    logger=logger,
+                ):
+                    await self._spool(repo_path, response, body)
+            except BaseException:
+                body.close()
+                raise
+            finally:
+                ORIGIN_BYTES.inc(body.size)
+            return body
+        finally:
+            await response.aclose()
+
+    async def _spool(self, repo_path: str, response: httpx.Response, body: SpooledBody):
+        max_size = self.origin_repo.max_size
+        async for chunk in response.aiter_raw(SPOOL_CHUNK_SIZE):
+            if body.path is None and body.size + len(chunk) <= body.memory_limit:
+                body.write(chunk)
+            else:
+                # don't block the event loop on disk writes
+                await asyncio.to_thread(body.write, chunk)
+            if max_size and body.size > max_size:
+                logger.error(f'Received more than the maximum of {max_size} bytes for {repo_path}')
+                raise OriginTooLargeError('Origin resource is too large')
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class ErrorResponse(Exception):
+    def __init__(self, status: HTTPStatus, description: str = '', headers: Optional[list] = None):
+        self.status = status
+        self.description = description or status.phrase
+        self.headers = headers or []
+
+
+class MezcalASGI:
+    """ASGI application with the same /images/<path> GET and DELETE
+    semantics as the Flask application from mezcal.web.create_app()."""
+
+    def __init__(
+            self,
+            local_storage: LocalStorage,
+            origin_repo: OriginRepository,
+            auth_type: Optional[RepositoryAuthType] = None,
+            cache_index: Optional[CacheIndex] = None,
+            executor: Optional[Executor] = None,
+            transport: Optional[httpx.AsyncBaseTransport] = None,
+            cache_control: Optional[str] = None,
+            origin_max_age: Optional[float] = None,
+            trace_log: Optional[TraceLog] = None,
+            negative_cache: Optional[NegativeCache] = None,
+            memory_cache: Optional[MemoryCache] = None,
+            delivery: Optional[ProxyDelivery] = None,
+            fetch_limiter: Optional[Limiter] = None,
+            encode_limiter: Optional[Limiter] = None,
+    ):
+        if auth_type is None:
+            auth_type = get_auth_type(os.environ.get('AUTH_TYPE', 'NONE'))
+        if cache_control is None:
+            cache_control = os.environ.get('CACHE_CONTROL') or DEFAULT_CACHE_CONTROL
+        if origin_max_age is None:
+            origin_max_age = float(os.environ.get('ORIGIN_MAX_AGE', 0))
+        self.cache_control = cache_control
+        self.trace_log = trace_log
+        self.local_storage = local_storage
+        auth = get_authenticator(auth_type)
+        self.origin = AsyncOriginRepository(origin_repo, auth=auth, transport=transport)
+        # revalidation happens in background threads, using the synchronous client
+        self.revalidator = None
+        if origin_max_age > 0:
+            self.revalidator = Revalidator(
+                origin_repo,
+                max_age=origin_max_age,
+                auth=auth,
+                cache_index=cache_index,
+                memory_cache=memory_cache,
+                fetch_limiter=fetch_limiter,
+                encode_limiter=encode_limiter,
+            )
+        self.cache_index = cache_index
+        self.negative_cache = negative_cache
+        self.memory_cache = memory_cache
+        self.delivery = delivery
+        self.fetch_limiter = fetch_limiter
+        self.encode_limiter = encode_limiter
+        # runs cache misses, which hold file locks and create images; if the local
+        # storage has a ProcessEncoder, the threads here just wait on its worker processes
+        self.executor = executor or ThreadPoolExecutor(thread_name_prefix='Encode')
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    @property
+    def stats(self) -> dict:
+        """The same runtime statistics as the /stats endpoint of the Flask application."""
+        local_storage = self.local_storage
+        return {
+            'origin': self.origin.pool_stats,
+            'in_flight': len(self._in_flight),
+            **({'cache': self.cache_index.stats} if self.cache_index is not None else {}),
+            **({'encoder': local_storage.encoder.stats} if local_storage.encoder is not None else {}),
+            **({'revalidation': self.revalidator.stats} if self.revalidator is not None else {}),
+            **({'negative_cache': self.negative_cache.stats} if self.negative_cache is not None else {}),
+            **({'memory': self.memory_cache.stats} if self.memory_cache is not None else {}),
+            **({'content_store': local_storage.store.stats} if local_storage.store is not None else {}),
+            **({'shared': local_storage.shared.stats} if local_storage.shared is not None else {}),
+            **({'fetch': self.fetch_limiter.stats} if self.fetch_limiter is not None else {}),
+            **({'encode': self.encode_limiter.stats} if self.encode_limiter is not None else {}),
+        }
+
+    async def __call__(self, scope, receive, send):
+        match scope['type']:
+            case 'lifespan':
+                await self.lifespan(receive, send)
+            case 'http':
+                await self.handle(scope, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            match message['type']:
+                case 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                case 'lifespan.shutdown':
+                    await self.origin.aclose()
+                    if self.revalidator is not None:
+                        self.revalidator.shutdown(wait=False)
+                    # not on the event loop, since misses in progress still use it
+                    await asyncio.to_thread(self.executor.shutdown, wait=True)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+    async def handle(self, scope, send):
+        path = scope['path']
+        method = scope['method']
+        if path.startswith('/images/') and method in ('GET', 'HEAD'):
+            # use the caller's request ID, if it has one, so the traces can be correlated
+            request_id = dict(scope['headers']).get(b'x-request-id', b'').decode('latin-1')
+            trace = Trace(path[len('/images/'):], trace_id=request_id or None)
+            current_trace.set(trace)
+            send = self.traced_send(send, trace)
+        try:
+            if path == '/metrics' and method == 'GET':
+                await send_response(send, HTTPStatus.OK, REGISTRY.render().encode(), content_type=CONTENT_TYPE)
+                return
+            if path == '/stats' and method == 'GET':
+                await send_response(
+                    send, HTTPStatus.OK, json.dumps(self.stats).encode(), content_type='application/json'
+                )
+                return
+            if not path.startswith('/images/') or len(path) == len('/images/'):
+                raise ErrorResponse(HTTPStatus.NOT_FOUND)
+            repo_path = path[len('/images/'):]
+            match method:
+                case 'GET' | 'HEAD':
+                    with Timer('retrieve image %s', repo_path, histogram=REQUEST_SECONDS, logger=logger):
+                        await self.resource(repo_path, scope, send)
+                case 'DELETE':
+                    await self.delete_resource(repo_path)
+                    await send_response(send, HTTPStatus.NO_CONTENT)
+                case _:
+                    raise ErrorResponse(HTTPStatus.METHOD_NOT_ALLOWED)
+        except ErrorResponse as e:
+            await send_response(
+                send, e.status, e.description.encode(), content_type='text/plain; charset=utf-8', headers=e.headers
+            )
+
+    def traced_send(self, send, trace: Trace):
+        """Wrap send to add the Server-Timing and X-Request-ID headers to the
+        response, and write the trace to the trace log."""
+        async def _send(message):
+            if message['type'] == 'http.response.start':
+                message = {
+                    **message,
+                    'headers': [
+                        *message.get('headers', []),
+                        (b'server-timing', trace.server_timing().encode()),
+                        (b'x-request-id', trace.id.encode('latin-1')),
+                    ],
+                }
+                if self.trace_log is not None:
+                    self.trace_log.write(trace, message['status'])
+            await send(message)
+        return _send
+
+    async def resource(self, repo_path: str, scope, send):
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        try:
+            image_format = self.local_storage.get_format(query['format'][-1] if 'format' in query else None)
+            size = self.local_storage.get_size(query['size'][-1] if 'size' in query else None)
+        except RuntimeError as e:
+            raise ErrorResponse(HTTPStatus.BAD_REQUEST, str(e))
+        local_file = self.local_storage.get_file(repo_path, image_format, size)
+        cached = self.memory_cache.get(local_file) if self.memory_cache is not None else None
+        if cached is not None:
+            info, data = cached
+            CACHE_HITS.inc()
+            if self.cache_index is not None:
+                self.cache_index.touch(local_file)
+            if self.revalidator is not None:
+                self.revalidator.submit(repo_path, local_file, info)
+            await self.send_local_file(repo_path, local_file, info, scope, send, data)
+            return
+        try:
+            # mezzanine files are published atomically, so an existing
+            # file is always complete and can be sent without locking
+            info = await asyncio.to_thread(local_file.info)
+        except FileNotFoundError:
+            if scope['method'] == 'HEAD':
+                # HEAD only reports on the local copy, and never fetches from the origin
+                raise ErrorResponse(HTTPStatus.NOT_FOUND)
+            logger.debug('No local copy exists for /%s (local file path: %s)', repo_path, local_file)
+            if self.negative_cache is not None and (entry := self.negative_cache.get(repo_path)) is not None:
+                NEGATIVE_CACHE_HITS.inc()
+                raise ErrorResponse(HTTPStatus(entry.status), entry.description)
+            CACHE_MISSES.inc()
+            IN_FLIGHT_MISSES.inc()
+            try:
+                await self.create_local_file(repo_path, local_file)
+            finally:
+                IN_FLIGHT_MISSES.dec()
+            try:
+                info = await asyncio.to_thread(local_file.info)
+            except FileNotFoundError:
+                # deleted or evicted by another request as soon as it was created
+                logger.warning(f'{local_file} was removed before it could be sent for /{repo_path}')
+                raise removed_response()
+        else:
+            CACHE_HITS.inc()
+            if self.cache_index is not None:
+                self.cache_index.touch(local_file)
+            if self.revalidator is not None:
+                self.revalidator.submit(repo_path, local_file, info)
+        await self.send_local_file(repo_path, local_file, info, scope, send)
+
+    async def send_local_file(
+            self,
+            repo_path: str,
+            local_file: MezzanineFile,
+            info: FileInfo,
+            scope,
+            send,
+            data: Optional[bytes] = None,
+    ):
+        """Send local_file, or just its headers for a HEAD request or a 304
+        Not Modified response, or the requested byte range of it. If the
+        contents of the file are given in data, they are sent instead of
+        reading the file. If there is a delivery, the proxy is told to send
+        the file (and handle any Range header) instead.
+
+        If the server offers the "http.response.zerocopy" extension in the
+        scope, the file is sent with it, so the server can use sendfile().
+        uvicorn does not offer it, so under uvicorn the file is always read
+        and sent in chunks."""
+        request_headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        etag = quote_etag(info.etag)
+        headers = [
+            (b'etag', etag.encode()),
+            (b'last-modified', http_date(info.last_modified).encode()),
+            (b'cache-control', self.cache_control.encode()),
+            (b'accept-ranges', b'bytes'),
+        ]
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            **{f'HTTP_{name.upper().replace("-", "_")}': value for name, value in request_headers.items()},
+        }
+        if not is_resource_modified(environ, etag=info.etag, last_modified=info.last_modified):
+            # answered from the metadata alone, without opening the file
+            await send({'type': 'http.response.start', 'status': HTTPStatus.NOT_MODIFIED, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        if self.delivery is not None and scope['method'] == 'GET':
+            logger.info('Handing %s to the proxy for /%s', local_file, repo_path)
+            headers += [
+                (b'content-type', local_file.format.mimetype.encode()),
+                (self.delivery.header.lower().encode(), self.delivery.get_location(local_file.path).encode()),
+                (b'content-length', b'0'),
+            ]
+            await send({'type': 'http.response.start', 'status': HTTPStatus.OK, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        status = HTTPStatus.OK
+        start, stop = 0, info.size
+        # a Range with an If-Range that doesn't match the current file gets the whole file
+        if 'range' in request_headers and request_headers.get('if-range', etag) == etag:
+            byte_range = parse_range_header(request_headers['range'])
+            requested = byte_range.range_for_length(info.size) if byte_range is not None else None
+            if requested is None:
+                headers.append((b'content-range', f'bytes */{info.size}'.encode()))
+                raise ErrorResponse(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+            status = HTTPStatus.PARTIAL_CONTENT
+            start, stop = requested
+            headers.append((b'content-range', f'bytes {start}-{stop - 1}/{info.size}'.encode()))
+
+        headers += [
+            (b'content-type', local_file.format.mimetype.encode()),
+            (b'content-length', str(stop - start).encode()),
+        ]
+        if scope['method'] == 'HEAD':
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        try:
+            if data is None and self.memory_cache is not None:
+                data = await asyncio.to_thread(self.memory_cache.load, local_file, info)
+            if data is not None:
+                logger.info('Sending %s from memory for /%s', local_file, repo_path)
+                await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                await send({'type': 'http.response.body', 'body': data[start:stop]})
+                return
+            fh = await asyncio.to_thread(open, local_file.path, 'rb')
+        except FileNotFoundError:
+            logger.warning(f'{local_file} was removed before it could be sent for /{repo_path}')
+            raise removed_response()
+
+        logger.info('Sending file %s for /%s', local_file, repo_path)
+        try:
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            if 'http.response.zerocopy' in (scope.get('extensions') or {}):
+                await send({'type': 'http.response.zerocopy', 'file': fh, 'offset': start, 'count': stop - start})
+                return
+            fh.seek(start)
+            remaining = stop - start
+            while remaining > 0 and (chunk := await asyncio.to_thread(fh.read, min(SEND_CHUNK_SIZE, remaining))):
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            fh.close()
+
+    async def create_local_file(self, repo_path: str, local_file: MezzanineFile):
+        """Create the local file, or wait for the request in this process that is already creating it."""
+        key = str(local_file.path)
+        future = self._in_flight.get(key)
+        if future is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout=LOCK_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error(f'Request in progress for {local_file} did not finish in {LOCK_TIMEOUT}s')
+                raise ErrorResponse(HTTPStatus.INTERNAL_SERVER_ERROR, 'Unable to access mezzanine copy')
+            return
+
+        future = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            await self._create_local_file(repo_path, local_file)
+        except BaseException as e:
+            future.set_exception(e)
+            # the waiters (if any) will retrieve the exception; this just
+            # prevents a warning about it never being retrieved
+            future.exception()
+            raise
+        else:
+            future.set_result(None)
+        finally:
+            del self._in_flight[key]
+
+    async def _create_local_file(self, repo_path: str, local_file: MezzanineFile):
+        loop = asyncio.get_running_loop()
+
+        def create():
+            # the whole miss runs in one thread, holding the file lock, so that
+            # other processes and nodes wait for it instead of fetching the
+            # same image; file locks are owned by the thread that acquired them
+            with local_file.acquire_lock(LOCK_TIMEOUT):
+                # another process may have created it already
+                if local_file.exists:
+                    return
+                # or another node
+                if local_file.fetch_shared():
+                    logger.debug(f'Fetched the shared copy of {local_file} for /{repo_path}')
+                else:
+                    # the origin request itself still runs on the event loop; the body is not
+                    # downloaded if the same image is already stored for another path
+                    future = asyncio.run_coroutine_threadsafe(self.download(repo_path, local_file.link_stored), loop)
+                    headers, body = future.result()
+                    if body is not None:
+                        with body, admit(self.encode_limiter):
+                            local_file.create(body.source, get_origin_digest(headers))
+                    record_origin_metadata(local_file, headers)
+                    logger.debug(f'Saved {local_file} for /{repo_path}')
+                # however it got here, the new file counts toward the cache limits
+                if self.cache_index is not None:
+                    self.cache_index.add(local_file)
+
+        try:
+            # run in a copy of this context, so that the stages are added to this request's trace
+            await loop.run_in_executor(self.executor, contextvars.copy_context().run, create)
+        except Overloaded as e:
+            raise overloaded_response(e)
+        except Timeout:
+            logger.error(f'Unable to acquire a lock to {local_file} in {LOCK_TIMEOUT}s')
+            raise ErrorResponse(HTTPStatus.INTERNAL_SERVER_ERROR, 'Unable to access mezzanine copy')
+        except RuntimeError as e:
+            raise ErrorResponse(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+
+    async def download(
+            self,
+            repo_path: str,
+            link_stored: Callable[[Optional[str]], bool],
+    ) -> tuple[httpx.Headers, Optional[SpooledBody]]:
+        """Download repo_path from the origin, once there is a slot in the fetch
+        limiter. If link_stored(digest), given the digest from the response
+        headers, returns True, the same image is already stored, so the body is
+        not read, and None is returned in its place. Raises an ErrorResponse if
+        the origin request fails."""
+        try:
+            async with admit_async(self.fetch_limiter):
+                response = await self.origin.request(repo_path)
+                try:
+                    linked = await asyncio.to_thread(link_stored, get_origin_digest(response.headers))
+                except BaseException:
+                    await response.aclose()
+                    raise
+                if linked:
+                    await response.aclose()
+                    return response.headers, None
+                return response.headers, await self.origin.spool(repo_path, response)
+        except Overloaded as e:
+            raise overloaded_response(e)
+        except RuntimeError as e:
+            if self.negative_cache is not None:
+                await asyncio.to_thread(self.negative_cache.add, repo_path, e)
+            if isinstance(e, NotAnImageError):
+                raise ErrorResponse(HTTPStatus.BAD_REQUEST, 'Requested resource is not an image')
+            raise ErrorResponse(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+
+    async def delete_resource(self, repo_path: str):
+        if self.negative_cache is not None:
+            await asyncio.to_thread(self.negative_cache.invalidate, repo_path)
+
+        def delete(local_file: MezzanineFile):
+            with local_file.acquire_lock(LOCK_TIMEOUT):
+                logger.info(f'Removing {local_file} for /{repo_path}')
+                local_file.delete()
+                if self.cache_index is not None:
+                    self.cache_index.remove(local_file)
+
+        # removes the copies in every format
+        for local_file in self.local_storage.get_files(repo_path):
+            if self.memory_cache is not None:
+                self.memory_cache.invalidate(local_file)
+            try:
+                await asyncio.to_thread(delete, local_file)
+            except Timeout:
+                logger.error(f'Unable to acquire a lock to {local_file} in {LOCK_TIMEOUT}s')
+                raise ErrorResponse(HTTPStatus.INTERNAL_SERVER_ERROR, 'Unable to access mezzanine copy')
+            except RuntimeError as e:
+                raise ErrorResponse(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+
+        if self.local_storage.shared is not None:
+            try:
+                await asyncio.to_thread(self.local_storage.shared.delete, self.local_storage.get_dir(repo_path))
+            except RuntimeError as e:
+                raise ErrorResponse(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+
+
+def overloaded_response(error: Overloaded) -> ErrorResponse:
+    logger.warning(str(error))
+    return ErrorResponse(
+        HTTPStatus.SERVICE_UNAVAILABLE, str(error), headers=[(b'retry-after', str(error.retry_after).encode())]
+    )
+
+
+def removed_response() -> ErrorResponse:
+    return ErrorResponse(
+        HTTPStatus.SERVICE_UNAVAILABLE,
+        'Mezzanine copy was removed; try again',
+        headers=[(b'retry-after', str(REMOVED_RETRY_AFTER).encode())],
+    )
+
+
+async def send_response(
+        send, status: HTTPStatus, body: bytes = b'', content_type: Optional[str] = None, headers: Optional[list] = None
+):
+    headers = [*(headers or []), (b'content-length', str(len(body)).encode())]
+    if content_type is not None:
+        headers.append((b'content-type', content_type.encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
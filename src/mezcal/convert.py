@@ -0,0 +1,92 @@
+import logging
+import sys
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_JPEG_MODES = ('L', 'RGB', 'CMYK')
+
+# raw unpackers that read the most significant byte of each 16-bit sample
+# straight into an 8-bit grayscale image; this is the same as dividing each
+# pixel value by 256, but done by Pillow's C decoder instead of in Python
+L_FROM_16_BIT_RAWMODES = {
+    'I;16': 'L;16',
+    'I;16L': 'L;16',
+    'I;16B': 'L;16B',
+    # native byte order; there is no "L;16N" raw mode
+    'I;16N': 'L;16B' if sys.byteorder == 'big' else 'L;16',
+}
+
+
+class UnsupportedModeError(RuntimeError):
+    pass
+
+
+def convert_to_jpeg_mode(img: Image.Image) -> Image.Image:
+    """Return a version of img in one of the SUPPORTED_JPEG_MODES.
+
+    Images already in a supported mode are returned unchanged. All conversions
+    operate on the whole pixel buffer at once (either a raw unpacker or a native
+    Pillow operation), so there is never a Python-level loop over the pixels.
+    Raises an UnsupportedModeError if there is no known conversion for the mode."""
+
+    if img.mode in SUPPORTED_JPEG_MODES:
+        return img
+
+    logger.info(f'Source has mode "{img.mode}" that is not supported by JPEG; will attempt to convert')
+    match img.mode:
+        case 'I;16' | 'I;16L' | 'I;16B' | 'I;16N':
+            # 16-bit grayscale; JPEG only supports 8-bit samples, so we keep
+            # the high byte of each sample (i.e., divide by 256, or 2^8).
+            # Without this scaling, all the pixel values would likely be over
+            # 256, resulting in an all-white image
+            # see also: https://stackoverflow.com/a/43980135
+            logger.debug(f'Converting image from "{img.mode}" to "L"')
+            return convert_16_bit_to_L(img)
+        case 'I':
+            # 32-bit signed integer grayscale, typically a 16-bit PNG or TIFF
+            # that Pillow has widened; scale it down the same way as "I;16"
+            # if the values don't already fit in 8 bits
+            logger.debug(f'Converting image from "{img.mode}" to "L"')
+            _, high = img.getextrema()
+            if high > 255:
+                img = img.point(lambda i: i / 256)
+            return img.convert('L')
+        case 'F':
+            # 32-bit floating point grayscale has no fixed range, so stretch
+            # whatever range is present onto 0-255
+            logger.debug(f'Converting image from "{img.mode}" to "L"')
+            low, high = img.getextrema()
+            scale = 255 / (high - low) if high > low else 1
+            offset = -low * scale
+            return img.point(lambda i: i * scale + offset).convert('L')
+        case '1' | 'LA' | 'La':
+            # bilevel, and grayscale with alpha; the alpha channel is dropped
+            logger.debug(f'Converting image from "{img.mode}" to "L"')
+            return img.convert('L')
+        case 'P' | 'PA':
+            # palette images may have a transparent color (or an alpha band);
+            # go through RGBA so that Pillow applies it instead of warning
+            logger.debug(f'Converting image from "{img.mode}" to "RGB"')
+            if img.mode == 'PA' or 'transparency' in img.info:
+                img = img.convert('RGBA')
+            return img.convert('RGB')
+        case 'RGBA' | 'RGBa' | 'RGBX' | 'LAB' | 'HSV' | 'YCbCr':
+            # other color modes, including RGB-Alpha; note that 16-bit RGB and
+            # RGBA sources are already reduced to 8 bits per sample by Pillow's
+            # decoder, so they end up here as well
+            logger.debug(f'Converting image from "{img.mode}" to "RGB"')
+            return img.convert('RGB')
+        case _:
+            raise UnsupportedModeError(
+                f'Cannot convert from image mode "{img.mode}" to one of: {SUPPORTED_JPEG_MODES}'
+            )
+
+
+def convert_16_bit_to_L(img: Image.Image) -> Image.Image:
+    """Return a new grayscale (mode "L") image made from the high byte of each
+    pixel of the 16-bit grayscale image img."""
+
+    rawmode = L_FROM_16_BIT_RAWMODES[img.mode]
+    return Image.frombuffer('L', img.size, img.tobytes(), 'raw', rawmode, 0, 1)
@@ -0,0 +1,54 @@
+"""Handing the sending of cached files off to the front proxy.
+
+By default, the body of every cache hit is read and sent by the server
+process, a block at a time. When mezcal runs behind nginx, Apache (with
+mod_xsendfile), or lighttpd, it can instead just check the request against
+the file's ETag and modification time, and respond with a header telling
+the proxy which file to send; the proxy then sends it with sendfile(),
+and handles any Range header itself."""
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from urllib.parse import quote
+
+
+class DeliveryMode(Enum):
+    # name of the response header for each mode
+    X_ACCEL_REDIRECT = 'X-Accel-Redirect'
+    X_SENDFILE = 'X-Sendfile'
+
+
+def get_delivery_mode(name: str) -> DeliveryMode:
+    try:
+        return DeliveryMode[name.strip().upper().replace('-', '_')]
+    except KeyError as e:
+        raise RuntimeError(f'{e} is not a recognized delivery mode') from e
+
+
+@dataclass(frozen=True)
+class ProxyDelivery:
+    """Maps files in storage_dir to the location the proxy sends them from.
+
+    For X_ACCEL_REDIRECT, prefix is the URI of an nginx internal location
+    whose root (or alias) is the storage directory, such as "/_mezcal/".
+    For X_SENDFILE, prefix is the storage directory as the proxy sees it,
+    if that is different from storage_dir (for example, when they run in
+    separate containers); by default, it is storage_dir itself."""
+    mode: DeliveryMode
+    storage_dir: Path
+    prefix: str = ''
+
+    def __post_init__(self):
+        if self.mode == DeliveryMode.X_ACCEL_REDIRECT and not self.prefix:
+            raise RuntimeError('An internal location prefix is required for X-Accel-Redirect delivery')
+
+    @property
+    def header(self) -> str:
+        return self.mode.value
+
+    def get_location(self, path: Path) -> str:
+        """Return the value of the delivery header for the file at path."""
+        relative_path = path.relative_to(self.storage_dir)
+        if self.mode == DeliveryMode.X_ACCEL_REDIRECT:
+            return f'{self.prefix.rstrip("/")}/{quote(relative_path.as_posix())}'
+        return str(Path(self.prefix or self.storage_dir) / relative_path)
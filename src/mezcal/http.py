@@ -1,14 +1,36 @@
+import base64
+import binascii
 import logging
 from enum import Enum
-from threading import current_thread
+from http import HTTPStatus
+from io import BytesIO
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from threading import current_thread, local, Lock
+from time import time
+from typing import BinaryIO, Mapping, Optional
 
 import requests
-from codetiming import Timer
+from jwcrypto.jwt import JWT
+from requests.adapters import HTTPAdapter
+from requests_jwtauth import JWTSecretAuth
+from urllib3 import Retry
 
-from mezcal.config import TIMER_LOG_FORMAT
+from mezcal.metrics import Timer, ORIGIN_REQUEST_SECONDS, ORIGIN_DOWNLOAD_SECONDS, ORIGIN_BYTES, ORIGIN_ERRORS
 
 logger = logging.getLogger(__name__)
 
+# origin responses that are worth retrying, since they usually indicate
+# a transient problem with the origin (or a proxy in front of it)
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+# size of the reads from the origin response body when spooling it
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+# digest algorithms accepted in origin Content-Digest and Digest headers,
+# strongest first, with the length of their digests in bytes
+DIGEST_ALGORITHMS = {'sha-512': 64, 'sha-256': 32, 'sha': 20, 'md5': 16}
+
 
 class RepositoryAuthType(Enum):
     NONE = 0
@@ -17,34 +39,323 @@ class RepositoryAuthType(Enum):
     JWT_SECRET = 3
 
 
+class CachedJWTSecretAuth(JWTSecretAuth):
+    """JWTSecretAuth that can be shared by multiple threads.
+
+    The signed and serialized Authorization header value is cached until the
+    token is within expiration_buffer seconds of expiring. At most one thread
+    signs a replacement token; the others keep using the cached header."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = Lock()
+        self._header = None
+        self._renew_at = 0.0
+
+    def __call__(self, r):
+        if time() >= self._renew_at:
+            with self._lock:
+                # another thread may have renewed the token while we were waiting for the lock
+                if time() >= self._renew_at:
+                    self._renew()
+        r.headers['Authorization'] = self._header
+        return r
+
+    def _renew(self):
+        expiration_time = time() + self.ttl
+        token = JWT(
+            header={
+                'alg': self.signing_algorithm,
+            },
+            claims={
+                **self.claims,
+                'exp': expiration_time,
+            }
+        )
+        token.make_signed_token(self.key)
+        self.token = token
+        self._header = f'Bearer {token.serialize()}'
+        self._renew_at = expiration_time - self.expiration_buffer
+        logger.debug('Signed a new JWT for origin requests')
+
+
 class OriginRepository:
-    def __init__(self, base_url: str):
+    """Client for the origin repository.
+
+    All requests go through a single pool of keep-alive connections that is
+    shared by every thread using this object. Each thread gets its own
+    requests.Session (since sessions are not guaranteed to be thread-safe),
+    but all the sessions are mounted on the same HTTPAdapter, and therefore
+    the same urllib3 connection pool, which is thread-safe."""
+
+    def __init__(
+            self,
+            base_url: str,
+            pool_size: int = 10,
+            connect_timeout: float = 5,
+            read_timeout: float = 60,
+            max_retries: int = 3,
+            backoff_factor: float = 0.5,
+            max_size: int = 0,
+            spool_memory_limit: int = 16 * 1024 * 1024,
+            spool_dir: Optional[Path | str] = None,
+    ):
         self.base_url = base_url
+        self.pool_size = pool_size
+        # maximum size in bytes of an origin resource; 0 means no limit
+        self.max_size = max_size
+        # origin resources up to this many bytes are spooled in memory, larger ones on disk
+        self.spool_memory_limit = spool_memory_limit
+        # directory for on-disk spool files; None means the system temp directory
+        self.spool_dir = spool_dir
+        self.timeout = (connect_timeout, read_timeout)
+        self.retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            # return the last response instead of raising an exception
+            # when we run out of retries on a bad status
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=self.retry)
+        self._local = local()
+
+    @property
+    def session(self) -> requests.Session:
+        """The requests.Session for the current thread."""
+        try:
+            return self._local.session
+        except AttributeError:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self._local.session = session
+            return session
 
-    def get(self, repo_path: str, auth=None) -> requests.Response:
+    @property
+    def pool_stats(self) -> dict:
+        """Usage statistics for the origin connection pool.
+
+        "idle" is the number of open connections waiting to be reused,
+        "connections" is the total number of connections that have been
+        opened, and "requests" is the total number of requests sent."""
+        stats = {'size': self.pool_size, 'idle': 0, 'connections': 0, 'requests': 0}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            if pool.pool is not None:
+                # the pool's queue is pre-filled with None placeholders
+                stats['idle'] += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            stats['connections'] += pool.num_connections
+            stats['requests'] += pool.num_requests
+        return stats
+
+    def get(self, repo_path: str, auth=None, validators: Optional[dict] = None) -> requests.Response:
+        """Request an image from the origin.
+
+        If validators (as returned by get_origin_metadata() for an earlier
+        response) are given, the request is conditional, and a 304 Not
+        Modified response is returned (already closed) instead of raising
+        an error."""
         with Timer(
-            name=f'request origin image {repo_path} in {current_thread().name}',
-            logger=logger.info,
-            text=TIMER_LOG_FORMAT
+            'request origin image %s in %s', repo_path, current_thread().name,
+            histogram=ORIGIN_REQUEST_SECONDS,
+            stage='origin',
+            logger=logger,
         ):
             url = self.base_url + repo_path
-            logger.debug(f'Requesting from {url}')
-            response = requests.get(url, auth=auth, stream=True)
-            if response.ok:
-                logger.debug(f'Received {response.status_code} {response.reason} response')
-                logger.debug(f'Response headers: {response.headers}')
+            logger.debug('Requesting from %s', url)
+            try:
+                response = self.session.get(
+                    url, auth=auth, headers=get_conditional_headers(validators), stream=True, timeout=self.timeout
+                )
+            except requests.RequestException as e:
+                ORIGIN_ERRORS.inc()
+                logger.error(f'Unable to retrieve {url}: {e}')
+                raise RuntimeError('Unable to retrieve resource') from e
+
+            if response.status_code == HTTPStatus.NOT_MODIFIED and validators:
+                logger.debug('%s is not modified', url)
+                response.close()
+                return response
+            elif response.ok:
+                logger.debug('Received %s %s response', response.status_code, response.reason)
+                logger.debug('Response headers: %s', response.headers)
 
                 # check that we got an image
                 content_type = response.headers['Content-Type']
                 if not content_type.startswith('image/'):
                     logger.error(f'Resource at {url} is not an image; response Content-Type is "{content_type}"')
+                    response.close()
                     raise NotAnImageError
 
                 return response
             else:
+                ORIGIN_ERRORS.inc()
                 logger.error(f'Unable to retrieve {url}: {response.status_code} {response.reason}')
-                raise RuntimeError('Unable to retrieve resource')
+                response.close()
+                raise OriginStatusError('Unable to retrieve resource', status=response.status_code)
+
+    def spool(self, repo_path: str, response: requests.Response) -> 'SpooledBody':
+        """Read the body of an origin response into a seekable SpooledBody.
+
+        Raises an OriginTooLargeError if the body is larger than max_size, based
+        on either the Content-Length header or the number of bytes received."""
+        with Timer(
+            'spool origin image %s in %s', repo_path, current_thread().name,
+            histogram=ORIGIN_DOWNLOAD_SECONDS,
+            stage='download',
+            logger=logger,
+        ):
+            content_length = get_content_length(response.headers)
+            if self.max_size and content_length > self.max_size:
+                response.close()
+                logger.error(f'Content-Length of {repo_path} is {content_length}; maximum is {self.max_size}')
+                raise OriginTooLargeError('Origin resource is too large')
+
+            body = SpooledBody(memory_limit=self.spool_memory_limit, spool_dir=self.spool_dir)
+            if content_length > self.spool_memory_limit:
+                # no point in buffering in memory if we know it will not fit
+                body.rollover()
+            try:
+                while chunk := response.raw.read(SPOOL_CHUNK_SIZE):
+                    body.write(chunk)
+                    if self.max_size and body.size > self.max_size:
+                        logger.error(f'Received more than the maximum of {self.max_size} bytes for {repo_path}')
+                        raise OriginTooLargeError('Origin resource is too large')
+            except BaseException:
+                body.close()
+                raise
+            finally:
+                response.close()
+                ORIGIN_BYTES.inc(body.size)
+
+            logger.debug('Spooled %d bytes of %s to %s', body.size, repo_path, body.path or 'memory')
+            return body
+
+    def close(self):
+        self.adapter.close()
+
+
+def get_content_length(headers: Mapping[str, str]) -> int:
+    """Return the Content-Length from the headers of an origin response, or -1
+    if there is none, or it is not a valid number."""
+    try:
+        return int(headers.get('Content-Length', -1))
+    except ValueError:
+        return -1
+
+
+def get_origin_metadata(headers: Mapping[str, str]) -> dict:
+    """Return the validators and size from the headers of an origin response,
+    to be stored with the mezzanine file and used to revalidate it later."""
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'content_length': int(headers['Content-Length']) if headers.get('Content-Length', '').isdigit() else None,
+    }
+
+
+def get_origin_digest(headers: Mapping[str, str]) -> Optional[str]:
+    """Return the strongest digest of the body given in the Content-Digest
+    (RFC 9530) or Digest (RFC 3230) header of an origin response, as a
+    string such as "sha-256-<hex digest>", or None if there isn't one."""
+    digests = {}
+    for name in ('Content-Digest', 'Digest'):
+        for item in (headers.get(name) or '').split(','):
+            algorithm, sep, value = item.strip().partition('=')
+            algorithm = algorithm.strip().lower()
+            if not sep or algorithm not in DIGEST_ALGORITHMS or algorithm in digests:
+                continue
+            try:
+                # Content-Digest values are structured field byte sequences, wrapped in colons
+                raw = base64.b64decode(value.strip().strip(':'), validate=True)
+            except binascii.Error:
+                continue
+            if len(raw) == DIGEST_ALGORITHMS[algorithm]:
+                digests[algorithm] = raw.hex()
+    for algorithm in DIGEST_ALGORITHMS:
+        if algorithm in digests:
+            return f'{algorithm}-{digests[algorithm]}'
+    return None
+
+
+def get_conditional_headers(validators: Optional[dict]) -> dict[str, str]:
+    """Return the request headers for a conditional request using validators
+    from get_origin_metadata()."""
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+class SpooledBody:
+    """Seekable copy of an origin response body.
+
+    The body is kept in memory until it grows beyond memory_limit bytes,
+    and after that in a named temporary file in spool_dir. Use source to
+    get something that can be passed to PIL.Image.open(); for an on-disk
+    body this is the file path, which lets Pillow memory-map the image
+    data instead of reading it into memory."""
+
+    def __init__(self, memory_limit: int, spool_dir: Optional[Path | str] = None):
+        self.memory_limit = memory_limit
+        self.spool_dir = spool_dir
+        self.size = 0
+        self.path: Optional[Path] = None
+        self._file: BinaryIO = BytesIO()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def write(self, chunk: bytes):
+        if self.path is None and self.size + len(chunk) > self.memory_limit:
+            self.rollover()
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def rollover(self):
+        """Move the body from memory to a temporary file."""
+        if self.path is not None:
+            return
+        fh = NamedTemporaryFile(dir=self.spool_dir, prefix='mezcal-', suffix='.spool', delete=False)
+        fh.write(self._file.getbuffer())
+        self._file = fh
+        self.path = Path(fh.name)
+
+    @property
+    def source(self) -> BinaryIO | Path:
+        self._file.flush()
+        if self.path is not None:
+            return self.path
+        self._file.seek(0)
+        return self._file
+
+    def close(self):
+        self._file.close()
+        if self.path is not None:
+            self.path.unlink(missing_ok=True)
 
 
 class NotAnImageError(RuntimeError):
     pass
+
+
+class OriginTooLargeError(RuntimeError):
+    pass
+
+
+class OriginStatusError(RuntimeError):
+    """The origin responded with an error status."""
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
@@ -0,0 +1,296 @@
+import logging
+import sqlite3
+from enum import Enum
+from itertools import chain
+from pathlib import Path
+from threading import Lock, Thread, Event, current_thread
+from time import time
+from typing import Optional
+
+from filelock import Timeout
+
+from mezcal.metrics import Timer
+from mezcal.storage import LocalStorage, MezzanineFile, ImageFormat, OBJECTS_DIRNAME
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = '.mezcal-index.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+)
+'''
+
+
+class EvictionPolicy(Enum):
+    # least recently used
+    LRU = 1
+    # least frequently used, with ties broken by least recently used
+    LFU = 2
+
+
+EVICTION_ORDER = {
+    EvictionPolicy.LRU: 'last_access',
+    EvictionPolicy.LFU: 'hits, last_access',
+}
+
+
+class CacheIndex:
+    """Persistent index of the mezzanine files in a LocalStorage, recording
+    the size, last access time, and number of hits of each file.
+
+    The index is an SQLite database in the storage directory. Accesses are
+    buffered in memory and written to the database in batches, so a cache
+    hit never waits on the database.
+
+    When the total size or number of files goes over max_bytes or max_files
+    (0 means no limit), evict() deletes the coldest files according to the
+    eviction policy until the cache is back under low_water times the limits."""
+
+    def __init__(
+            self,
+            local_storage: LocalStorage,
+            max_bytes: int = 0,
+            max_files: int = 0,
+            policy: EvictionPolicy | str = EvictionPolicy.LRU,
+            low_water: float = 0.9,
+            db_path: Optional[Path | str] = None,
+    ):
+        self.local_storage = local_storage
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        if isinstance(policy, str):
+            try:
+                self.policy = EvictionPolicy[policy.upper()]
+            except KeyError as e:
+                raise RuntimeError(f'{e} is not a recognized eviction policy')
+        else:
+            self.policy = policy
+        self.low_water = low_water
+        self.db_path = Path(db_path or local_storage.storage_dir / INDEX_FILENAME)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.evictions = 0
+
+        self._db_lock = Lock()
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(SCHEMA)
+
+        self._pending_lock = Lock()
+        self._pending: dict[str, tuple[float, int]] = {}
+
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+
+    def key(self, file: MezzanineFile) -> str:
+        return str(file.path.relative_to(self.local_storage.storage_dir))
+
+    def touch(self, file: MezzanineFile):
+        """Record a hit on file. This only updates an in-memory buffer."""
+        key = self.key(file)
+        with self._pending_lock:
+            _, hits = self._pending.get(key, (0, 0))
+            self._pending[key] = (time(), hits + 1)
+
+    def add(self, file: MezzanineFile):
+        """Add a newly created file to the index.
+
+        This runs on the request path, so a database error (such as the
+        database being locked by another process for too long) is logged
+        instead of failing the request; the next rebuild() adds the file."""
+        size = file.path.stat().st_size
+        try:
+            with self._db_lock:
+                self._db.execute(
+                    'INSERT INTO files (path, size, last_access, hits) VALUES (?, ?, ?, 0) '
+                    'ON CONFLICT (path) DO UPDATE SET size = excluded.size, last_access = excluded.last_access',
+                    (self.key(file), size, time())
+                )
+        except sqlite3.Error as e:
+            logger.error(f'Unable to add {file} to the cache index: {e}')
+
+    def remove(self, file: MezzanineFile):
+        """Remove a deleted file from the index. As with add(), a database
+        error is logged; the next rebuild() removes the entry."""
+        key = self.key(file)
+        with self._pending_lock:
+            self._pending.pop(key, None)
+        try:
+            with self._db_lock:
+                self._db.execute('DELETE FROM files WHERE path = ?', (key,))
+        except sqlite3.Error as e:
+            logger.error(f'Unable to remove {file} from the cache index: {e}')
+
+    def flush(self):
+        """Write buffered accesses to the database."""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        with self._db_lock:
+            self._db.executemany(
+                'UPDATE files SET last_access = MAX(last_access, ?), hits = hits + ? WHERE path = ?',
+                ((last_access, hits, key) for key, (last_access, hits) in pending.items())
+            )
+
+    @property
+    def totals(self) -> tuple[int, int]:
+        """The number of files and total number of bytes in the index."""
+        with self._db_lock:
+            count, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files').fetchone()
+        return count, size
+
+    @property
+    def stats(self) -> dict:
+        files, size = self.totals
+        return {
+            'files': files,
+            'bytes': size,
+            'max_files': self.max_files,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions,
+        }
+
+    def rebuild(self):
+        """Synchronize the index with the files actually in the storage directory.
+
+        Files not yet in the index are added, using their access or modification
+        time (whichever is later) as the last access time. Entries for files
+        that no longer exist are removed. This works for every DirectoryLayout,
+        since they all store their files (such as "image.jpg") under the same
+        names in a per-resource directory (with size variants named like
+        "image-1024.jpg")."""
+        with Timer('rebuild cache index %s in %s', self.db_path, current_thread().name, logger=logger):
+            found = {}
+            paths = chain.from_iterable(
+                self.local_storage.storage_dir.rglob(pattern)
+                for image_format in ImageFormat
+                for pattern in (image_format.filename, image_format.variant_pattern)
+            )
+            for path in paths:
+                key = path.relative_to(self.local_storage.storage_dir)
+                if key.parts[0] == OBJECTS_DIRNAME:
+                    # stored copies for the CONTENT_ADDRESSED layout are
+                    # removed along with the last per-path file linked to them
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                found[str(key)] = (
+                    stat.st_size, max(stat.st_atime, stat.st_mtime)
+                )
+
+            with self._db_lock:
+                indexed = {row[0] for row in self._db.execute('SELECT path FROM files')}
+                # files created after the scan passed their directories are indexed but not found,
+                # so only the entries of files that are still missing are stale
+                stale = [key for key in indexed - found.keys() if not (self.local_storage.storage_dir / key).exists()]
+                self._db.execute('BEGIN')
+                try:
+                    self._db.executemany(
+                        'INSERT INTO files (path, size, last_access) VALUES (?, ?, ?) '
+                        'ON CONFLICT (path) DO UPDATE SET size = excluded.size',
+                        ((key, size, last_access) for key, (size, last_access) in found.items())
+                    )
+                    self._db.executemany('DELETE FROM files WHERE path = ?', ((key,) for key in stale))
+                except BaseException:
+                    self._db.execute('ROLLBACK')
+                    raise
+                self._db.execute('COMMIT')
+            logger.info(f'Cache index has {len(found)} files ({len(stale)} stale entries removed)')
+
+    def is_over_limit(self, files: int, size: int, factor: float = 1.0) -> bool:
+        return (
+            (self.max_files > 0 and files > self.max_files * factor) or
+            (self.max_bytes > 0 and size > self.max_bytes * factor)
+        )
+
+    def evict(self, batch_size: int = 100) -> int:
+        """Delete the coldest files until the cache is under its limits.
+
+        Each file is deleted while holding its lock, the same way that a
+        DELETE request would; files whose lock is currently held (because
+        they are being created or deleted) are skipped. The entries of files
+        that turn out to be gone already are removed. Returns the number of
+        files that were evicted."""
+        self.flush()
+        files, size = self.totals
+        if not self.is_over_limit(files, size):
+            return 0
+
+        evicted = 0
+        offset = 0
+        with Timer('evict cached images in %s', current_thread().name, logger=logger):
+            while self.is_over_limit(files, size, self.low_water):
+                with self._db_lock:
+                    rows = self._db.execute(
+                        f'SELECT path, size FROM files ORDER BY {EVICTION_ORDER[self.policy]} LIMIT ? OFFSET ?',
+                        (batch_size, offset)
+                    ).fetchall()
+                if not rows:
+                    break
+                for key, file_size in rows:
+                    if not self.is_over_limit(files, size, self.low_water):
+                        break
+                    file = self.local_storage.get_file_at(self.local_storage.storage_dir / key)
+                    try:
+                        with file.lock.acquire(timeout=0):
+                            file.delete()
+                        evicted += 1
+                    except Timeout:
+                        logger.debug(f'Skipping eviction of {file}, since it is locked')
+                        offset += 1
+                        continue
+                    except RuntimeError:
+                        if file.exists:
+                            offset += 1
+                            continue
+                        # already removed (for example, by a DELETE request), so only its entry is left
+                        logger.debug(f'Removing the entry for {file}, which no longer exists')
+                    self.remove(file)
+                    files -= 1
+                    size -= file_size
+
+        self.evictions += evicted
+        logger.info(f'Evicted {evicted} cached images; cache now has {files} files ({size} bytes)')
+        return evicted
+
+    def start(self, interval: float = 60, rebuild: bool = True, evict: bool = True):
+        """Start a background thread that flushes buffered accesses and
+        evicts files every interval seconds. If rebuild is true, the thread
+        first rebuilds the index from the storage directory. If evict is
+        false, the thread only flushes, such as when several processes share
+        the index and only one of them should evict files."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, args=(interval, rebuild, evict), name='CacheEvictor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def _run(self, interval: float, rebuild: bool, evict: bool):
+        if rebuild:
+            try:
+                self.rebuild()
+            except Exception as e:
+                logger.error(f'Unable to rebuild cache index: {e}')
+        while not self._stop.wait(interval):
+            try:
+                if evict:
+                    self.evict()
+                else:
+                    self.flush()
+            except Exception as e:
+                logger.error(f'Cache eviction failed: {e}')
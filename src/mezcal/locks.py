@@ -0,0 +1,241 @@
+import fcntl
+import logging
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from hashlib import md5
+from pathlib import Path
+from threading import local, current_thread
+from time import time, sleep
+from typing import Optional
+from uuid import uuid4
+
+from filelock import FileLock, Timeout
+
+logger = logging.getLogger(__name__)
+
+
+class LockManager(ABC):
+    """Provides the locks that coordinate the creation and deletion of
+    mezzanine files, across threads and processes.
+
+    The locks match the parts of filelock.FileLock that mezcal uses:
+    acquire() raises a filelock.Timeout if the lock can't be acquired in
+    time, and returns a context manager that releases the lock."""
+
+    @abstractmethod
+    def get_lock(self, path: Path):
+        ...
+
+    @abstractmethod
+    def get_lock_path(self, path: Path) -> Path:
+        """The file that backs the lock for path, for logging."""
+
+
+class DirectoryLockManager(LockManager):
+    """Lock file named after the mezzanine file's directory, with a ".lock"
+    suffix, so "foo/bar/image.jpg" is locked with "foo/bar.lock".
+
+    This is the original mezcal lock file naming. Each lock file is removed
+    when its lock is released (see DirectoryLock), so there are only lock
+    files for the directories that are locked at the moment."""
+
+    def __init__(self, poll_interval: float = 0.05):
+        self.poll_interval = poll_interval
+
+    def get_lock_path(self, path: Path) -> Path:
+        return Path(f'{path.parent}.lock')
+
+    def get_lock(self, path: Path) -> 'DirectoryLock':
+        lock_path = self.get_lock_path(path)
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        return DirectoryLock(lock_path, poll_interval=self.poll_interval)
+
+
+class ShardedLockManager(LockManager):
+    """Fixed set of lock files in lock_dir; each path is locked with lock file
+    number hash(path) modulo shards. There are never more than shards lock
+    files, no matter how many images are cached, at the cost of occasionally
+    making unrelated paths that share a shard wait for each other."""
+
+    def __init__(self, lock_dir: Path | str, shards: int = 1024):
+        if shards < 1:
+            raise RuntimeError('Number of lock shards must be at least 1')
+        self.lock_dir = Path(lock_dir)
+        self.shards = shards
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_lock_path(self, path: Path) -> Path:
+        shard = int(md5(str(path).encode()).hexdigest(), 16) % self.shards
+        return self.lock_dir / f'{shard:04x}.lock'
+
+    def get_lock(self, path: Path) -> FileLock:
+        return FileLock(self.get_lock_path(path))
+
+    def cleanup(self):
+        """Remove lock files left over from a configuration with more shards.
+
+        Only call this when no other process is using lock_dir."""
+        current = {self.lock_dir / f'{shard:04x}.lock' for shard in range(self.shards)}
+        for lock_path in self.lock_dir.glob('*.lock'):
+            if lock_path not in current:
+                lock_path.unlink(missing_ok=True)
+
+
+class LeaseLockManager(LockManager):
+    """Locks stored as leases in an SQLite database. Each lease expires ttl
+    seconds after it is acquired, so a hung or crashed process can only block
+    a path until then, rather than indefinitely. The ttl must be longer than
+    the longest time it takes to create a mezzanine file.
+
+    All state is in a single database file, so there are no per-path lock files."""
+
+    def __init__(self, db_path: Path | str, ttl: float = 300, poll_interval: float = 0.05):
+        self.db_path = Path(db_path)
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = local()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)'
+        )
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The database connection for the current thread."""
+        try:
+            return self._local.connection
+        except AttributeError:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.connection = connection
+            return connection
+
+    def get_lock_path(self, path: Path) -> Path:
+        return self.db_path
+
+    def get_lock(self, path: Path) -> 'LeaseLock':
+        return LeaseLock(self, str(path))
+
+    def try_acquire(self, key: str, owner: str) -> bool:
+        now = time()
+        db = self.connection
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM leases WHERE key = ? AND expires < ?', (key, now))
+            cursor = db.execute(
+                'INSERT OR IGNORE INTO leases (key, owner, expires) VALUES (?, ?, ?)', (key, owner, now + self.ttl)
+            )
+            acquired = cursor.rowcount == 1
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return acquired
+
+    def release(self, key: str, owner: str):
+        cursor = self.connection.execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, owner))
+        if cursor.rowcount == 0:
+            logger.warning(f'Lease on {key} expired before it was released')
+
+    def cleanup(self) -> int:
+        """Remove expired leases, and return how many were removed."""
+        cursor = self.connection.execute('DELETE FROM leases WHERE expires < ?', (time(),))
+        return cursor.rowcount
+
+
+class LeaseLock:
+    def __init__(self, manager: LeaseLockManager, key: str):
+        self.manager = manager
+        self.key = key
+        self.owner: Optional[str] = None
+
+    @property
+    def is_locked(self) -> bool:
+        return self.owner is not None
+
+    def acquire(self, timeout: Optional[float] = None) -> 'LeaseLock':
+        owner = f'{current_thread().name}-{uuid4()}'
+        deadline = None if timeout is None or timeout < 0 else time() + timeout
+        while not self.manager.try_acquire(self.key, owner):
+            if deadline is not None and time() >= deadline:
+                raise Timeout(self.key)
+            sleep(self.manager.poll_interval)
+        self.owner = owner
+        return self
+
+    def release(self):
+        if self.owner is not None:
+            self.manager.release(self.key, self.owner)
+            self.owner = None
+
+    def __enter__(self):
+        if not self.is_locked:
+            self.acquire()
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.release()
+
+
+class DirectoryLock:
+    """An flock() on a lock file that is removed when the lock is released.
+
+    The holder removes the file before unlocking it, so a process that was
+    waiting on the removed file can get the lock on a file that is no longer
+    at lock_path. After locking, the file is checked against the one at
+    lock_path, and if it is not the same, the lock is tried again on the
+    file that is there now (or a new one), so only one process at a time
+    holds the lock on the file at lock_path."""
+
+    def __init__(self, lock_path: Path, poll_interval: float = 0.05):
+        self.lock_path = lock_path
+        self.poll_interval = poll_interval
+        self._fd: Optional[int] = None
+
+    @property
+    def is_locked(self) -> bool:
+        return self._fd is not None
+
+    def _try_acquire(self) -> bool:
+        while True:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            try:
+                stat = os.stat(self.lock_path)
+            except FileNotFoundError:
+                stat = None
+            fd_stat = os.fstat(fd)
+            if stat is not None and (stat.st_dev, stat.st_ino) == (fd_stat.st_dev, fd_stat.st_ino):
+                self._fd = fd
+                return True
+            # removed by the previous holder after it was opened here
+            os.close(fd)
+
+    def acquire(self, timeout: Optional[float] = None) -> 'DirectoryLock':
+        deadline = None if timeout is None or timeout < 0 else time() + timeout
+        while not self._try_acquire():
+            if deadline is not None and time() >= deadline:
+                raise Timeout(str(self.lock_path))
+            sleep(self.poll_interval)
+        return self
+
+    def release(self):
+        if self._fd is not None:
+            # removed before it is unlocked, so whoever locks it next sees that it was removed
+            self.lock_path.unlink(missing_ok=True)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        if not self.is_locked:
+            self.acquire()
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.release()
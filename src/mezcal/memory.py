@@ -0,0 +1,96 @@
+"""In-memory cache of the contents of the most requested mezzanine files.
+
+A cache hit in LocalStorage still costs a stat() and an open() of the file,
+which on network-attached storage can take longer than sending it. A small
+number of images usually get most of the requests, so keeping just those
+in memory, with their ETags, saves most of those trips to the storage
+volume.
+
+Each server process has its own MemoryCache. Files can be changed by other
+processes (or deleted, by a DELETE request to another process), so entries
+are only used for max_age seconds after they were read from storage."""
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from time import monotonic
+from typing import Optional
+
+from mezcal.metrics import MEMORY_CACHE_HITS, MEMORY_CACHE_MISSES, MEMORY_CACHE_EVICTIONS
+from mezcal.storage import MezzanineFile, FileInfo
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MemoryEntry:
+    info: FileInfo
+    data: bytes
+    loaded: float
+
+
+class MemoryCache:
+    """Least recently used cache of mezzanine file contents, with a total size
+    of at most max_bytes. Files larger than max_file_size are never cached."""
+
+    def __init__(self, max_bytes: int, max_file_size: Optional[int] = None, max_age: float = 60):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size or max_bytes, max_bytes)
+        self.max_age = max_age
+        self.size = 0
+        self._lock = Lock()
+        self._entries: OrderedDict[str, MemoryEntry] = OrderedDict()
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @property
+    def stats(self) -> dict:
+        return {'files': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes, **self.counts}
+
+    def get(self, file: MezzanineFile) -> Optional[tuple[FileInfo, bytes]]:
+        """Return the info and contents of file, or None if it is not cached."""
+        key = str(file.path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and monotonic() - entry.loaded > self.max_age:
+                self._discard(key)
+                entry = None
+            if entry is None:
+                self.counts['misses'] += 1
+                MEMORY_CACHE_MISSES.inc()
+                return None
+            self._entries.move_to_end(key)
+            self.counts['hits'] += 1
+        MEMORY_CACHE_HITS.inc()
+        return entry.info, entry.data
+
+    def load(self, file: MezzanineFile, info: FileInfo) -> Optional[bytes]:
+        """Read the contents of file, whose info was just read from storage, and
+        cache them. Returns the contents, or None if the file is too large to
+        cache. Raises FileNotFoundError if the file has been removed."""
+        if info.size > self.max_file_size:
+            return None
+        data = file.path.read_bytes()
+        if len(data) != info.size:
+            # replaced since its info was read; the next request will try again
+            return None
+        key = str(file.path)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = MemoryEntry(info=info, data=data, loaded=monotonic())
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                self.counts['evictions'] += 1
+                MEMORY_CACHE_EVICTIONS.inc()
+        return data
+
+    def invalidate(self, file: MezzanineFile):
+        """Remove file from the cache, such as when it is deleted or replaced."""
+        with self._lock:
+            self._discard(str(file.path))
+
+    def _discard(self, key: str):
+        # the caller must hold the lock
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.data)
@@ -0,0 +1,287 @@
+"""Runtime metrics, in the Prometheus text exposition format.
+
+Metrics are kept in memory, per process. Recording a value is a dictionary
+lookup (skipped entirely for metrics without labels, or for label values
+bound once with labels()) plus an addition under a lock, so they are cheap
+enough to record on every request.
+
+When several server processes share a listening socket, each scrape gets
+the metrics of whichever process accepts it. With label_process set, every
+sample has a "pid" label, so each process's counters are a separate series
+that never goes backwards; sum them by the other labels to get totals."""
+import logging
+import os
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+from typing import Optional
+
+from mezcal import trace
+from mezcal.config import TIMER_LOG_FORMAT
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Registry:
+    def __init__(self, label_process: bool = False):
+        self._metrics: dict[str, 'Metric'] = {}
+        self.label_process = label_process
+
+    def register(self, metric: 'Metric'):
+        if metric.name in self._metrics:
+            raise RuntimeError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        # the process ID is read here, since it changes when the process is forked
+        const_labels = (f'pid="{os.getpid()}"',) if self.label_process else ()
+        return ''.join(metric.render(const_labels) for metric in self._metrics.values())
+
+
+REGISTRY = Registry()
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], *extra: str) -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    pairs.extend(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric(ABC):
+    type = ''
+
+    def __init__(
+            self,
+            name: str,
+            description: str,
+            labelnames: tuple[str, ...] = (),
+            registry: Optional[Registry] = REGISTRY,
+    ):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        self._children: dict[tuple[str, ...], object] = {}
+        if registry is not None:
+            registry.register(self)
+        if not self.labelnames:
+            # so that metrics without labels are reported before they are first recorded
+            self.labels()
+
+    @abstractmethod
+    def _new_child(self):
+        ...
+
+    def labels(self, *values: str):
+        """Return the child metric for these label values. Bind this once
+        for fixed label values, rather than calling it per request."""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} has labels {self.labelnames}')
+        try:
+            return self._children[values]
+        except KeyError:
+            with self._lock:
+                return self._children.setdefault(values, self._new_child())
+
+    def _samples(self, values: tuple[str, ...], child, const_labels: tuple[str, ...]) -> list[str]:
+        return [f'{self.name}{format_labels(self.labelnames, values, *const_labels)} {child.value}\n']
+
+    def render(self, const_labels: tuple[str, ...] = ()) -> str:
+        """Render this metric, with const_labels (formatted label pairs) added to every sample."""
+        lines = [f'# HELP {self.name} {self.description}\n', f'# TYPE {self.name} {self.type}\n']
+        for values, child in list(self._children.items()):
+            lines.extend(self._samples(values, child, const_labels))
+        return ''.join(lines)
+
+
+class CounterValue:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # the last count is for the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self) -> GaugeValue:
+        return GaugeValue()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(*args, **kwargs)
+
+    def _new_child(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self, values: tuple[str, ...], child: HistogramValue, const_labels: tuple[str, ...]) -> list[str]:
+        with child._lock:
+            counts = list(child.counts)
+            total, count = child.sum, child.count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+            cumulative += bucket_count
+            labels = format_labels(self.labelnames, values, *const_labels, f'le="{bound}"')
+            samples.append(f'{self.name}_bucket{labels} {cumulative}\n')
+        labels = format_labels(self.labelnames, values, *const_labels)
+        samples.append(f'{self.name}_sum{labels} {total}\n')
+        samples.append(f'{self.name}_count{labels} {count}\n')
+        return samples
+
+
+class Timer:
+    """Context manager that records the time taken by a block in a histogram,
+    and as a stage of the current request's trace, and logs it at INFO level
+    using TIMER_LOG_FORMAT.
+
+    The name is a %-style format string for args. It is only formatted if
+    the log message is actually emitted."""
+
+    __slots__ = ('name', 'args', 'histogram', 'stage', 'logger', 'start', 'elapsed')
+
+    def __init__(
+            self,
+            name: str,
+            *args,
+            histogram: Optional[Histogram | HistogramValue] = None,
+            stage: Optional[str] = None,
+            logger: Optional[logging.Logger] = None,
+    ):
+        self.name = name
+        self.args = args
+        self.histogram = histogram
+        self.stage = stage
+        self.logger = logger
+        self.start = 0.0
+        self.elapsed = 0.0
+
+    def __enter__(self) -> 'Timer':
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.elapsed = perf_counter() - self.start
+        if self.histogram is not None:
+            self.histogram.observe(self.elapsed)
+        if self.stage is not None:
+            trace.record(self.stage, self.elapsed)
+        if self.logger is not None and self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(TIMER_LOG_FORMAT.format(name=self.name % self.args, milliseconds=self.elapsed * 1000))
+
+
+CACHE_REQUESTS = Counter(
+    'mezcal_cache_requests_total', 'Image requests, by whether a cached copy was sent', ('result',)
+)
+CACHE_HITS = CACHE_REQUESTS.labels('hit')
+CACHE_MISSES = CACHE_REQUESTS.labels('miss')
+NEGATIVE_CACHE_HITS = CACHE_REQUESTS.labels('negative')
+MEMORY_CACHE_REQUESTS = Counter(
+    'mezcal_memory_cache_requests_total', 'Lookups in the in-memory cache of mezzanine files, by result', ('result',)
+)
+MEMORY_CACHE_HITS = MEMORY_CACHE_REQUESTS.labels('hit')
+MEMORY_CACHE_MISSES = MEMORY_CACHE_REQUESTS.labels('miss')
+MEMORY_CACHE_EVICTIONS = Counter(
+    'mezcal_memory_cache_evictions_total', 'Files removed from the in-memory cache to stay within its size limit'
+)
+SHARED_STORAGE_REQUESTS = Counter(
+    'mezcal_shared_storage_requests_total', 'Downloads from and uploads to the shared storage, by outcome', ('result',)
+)
+SHARED_STORAGE_SECONDS = Histogram('mezcal_shared_storage_seconds', 'Time to download or upload shared copies')
+REQUEST_SECONDS = Histogram('mezcal_image_request_seconds', 'Time to handle image requests')
+IN_FLIGHT_MISSES = Gauge('mezcal_in_flight_misses', 'Image requests currently waiting for a cached copy to be created')
+ORIGIN_REQUEST_SECONDS = Histogram('mezcal_origin_request_seconds', 'Time to receive the headers of origin responses')
+ORIGIN_DOWNLOAD_SECONDS = Histogram('mezcal_origin_download_seconds', 'Time to receive the bodies of origin responses')
+ORIGIN_BYTES = Counter('mezcal_origin_bytes_total', 'Bytes received in origin response bodies')
+ORIGIN_ERRORS = Counter('mezcal_origin_errors_total', 'Origin requests that failed')
+IMAGE_CREATE_SECONDS = Histogram('mezcal_image_create_seconds', 'Time to create mezzanine files')
+IMAGE_DECODE_SECONDS = Histogram(
+    'mezcal_image_decode_seconds', 'Time to decode origin images, by source image mode', ('mode',)
+)
+IMAGE_CONVERT_SECONDS = Histogram(
+    'mezcal_image_convert_seconds', 'Time to convert origin images to a JPEG mode, by source image mode', ('mode',)
+)
+IMAGE_ENCODE_SECONDS = Histogram(
+    'mezcal_image_encode_seconds', 'Time to encode and write mezzanine files, by source image mode', ('mode',)
+)
+LOCK_WAIT_SECONDS = Histogram('mezcal_lock_wait_seconds', 'Time spent waiting to acquire mezzanine file locks')
+LOCK_TIMEOUTS = Counter('mezcal_lock_timeouts_total', 'Mezzanine file locks that could not be acquired in time')
+ADMISSION_ACTIVE = Gauge(
+    'mezcal_admission_active', 'Cache misses currently fetching from the origin or encoding, by stage', ('stage',)
+)
+ADMISSION_QUEUED = Gauge(
+    'mezcal_admission_queued', 'Cache misses waiting to fetch from the origin or to encode, by stage', ('stage',)
+)
+ADMISSION_REJECTIONS = Counter(
+    'mezcal_admission_rejections_total',
+    'Cache misses answered with 503 Service Unavailable, by stage and whether the queue was full or the wait too long',
+    ('stage', 'reason'),
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    'mezcal_admission_wait_seconds', 'Time cache misses spent queued to fetch from the origin or to encode', ('stage',)
+)
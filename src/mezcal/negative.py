@@ -0,0 +1,189 @@
+"""Cache of origin requests that failed in a way that won't change by trying
+again right away, such as a 404 Not Found or a resource that is not an
+image.
+
+Without it, every request for a bad path (from a crawler, or a IIIF
+manifest that points at the wrong resource) costs an origin round trip,
+made while holding the path's file lock."""
+import json
+import logging
+import sqlite3
+from dataclasses import dataclass, asdict
+from http import HTTPStatus
+from pathlib import Path
+from threading import Lock, local
+from time import time
+from typing import Optional
+
+from mezcal.http import NotAnImageError, OriginStatusError
+from mezcal.storage import LocalStorage
+
+logger = logging.getLogger(__name__)
+
+# origin response statuses that are remembered; others (such as a 500, or
+# a timeout) are more likely to be transient
+NEGATIVE_STATUS_CODES = frozenset({HTTPStatus.FORBIDDEN, HTTPStatus.NOT_FOUND, HTTPStatus.GONE})
+
+# name of the database of persisted entries, in the storage directory
+NEGATIVE_DB_FILENAME = '.negative.sqlite'
+
+
+@dataclass
+class NegativeEntry:
+    """A remembered failure: the name of the exception class, the status
+    and description of the response that was sent for it, the status of
+    the origin response (if there was one), and when the entry expires."""
+    error: str
+    status: int
+    description: str
+    origin_status: Optional[int]
+    expires: float
+
+    @property
+    def expired(self) -> bool:
+        return time() >= self.expires
+
+
+def get_response(error: Exception) -> Optional[tuple[HTTPStatus, str]]:
+    """Return the status and description of the response to send for an
+    origin error, if it should be remembered, otherwise None."""
+    if isinstance(error, NotAnImageError):
+        return HTTPStatus.BAD_REQUEST, 'Requested resource is not an image'
+    if isinstance(error, OriginStatusError) and error.status in NEGATIVE_STATUS_CODES:
+        return HTTPStatus.INTERNAL_SERVER_ERROR, str(error)
+    return None
+
+
+class NegativeCache:
+    """Remembers origin failures by repository path for ttl seconds.
+
+    Entries are kept in memory, up to max_entries of them; when there are
+    more, the oldest are dropped. If a local_storage is given, entries are
+    also written to an SQLite database in its storage directory, so that
+    they are shared by every process using the same storage, and survive a
+    restart. Expired entries are removed from the database whenever an
+    entry is added, so it only ever holds the failures of the last ttl
+    seconds, and no per-path directories are created for them."""
+
+    def __init__(self, ttl: float, local_storage: Optional[LocalStorage] = None, max_entries: int = 10000):
+        self.ttl = ttl
+        self.local_storage = local_storage
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._entries: dict[str, NegativeEntry] = {}
+        self.counts = {'hits': 0, 'added': 0, 'invalidated': 0}
+        self._local = local()
+        if local_storage is not None:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, entry TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)')
+
+    @property
+    def stats(self) -> dict:
+        return {'ttl': self.ttl, 'entries': len(self._entries), **self.counts}
+
+    @property
+    def db_path(self) -> Path:
+        return self.local_storage.storage_dir / NEGATIVE_DB_FILENAME
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The database connection for the current thread."""
+        try:
+            return self._local.connection
+        except AttributeError:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.connection = connection
+            return connection
+
+    def get(self, repo_path: str) -> Optional[NegativeEntry]:
+        """Return the unexpired entry for repo_path, or None if there isn't one."""
+        entry = self._entries.get(repo_path)
+        if entry is None and self.local_storage is not None:
+            entry = self._read(repo_path)
+            if entry is not None:
+                self._remember(repo_path, entry)
+        if entry is None:
+            return None
+        if entry.expired:
+            with self._lock:
+                if self._entries.get(repo_path) is entry:
+                    del self._entries[repo_path]
+            if self.local_storage is not None:
+                self._delete(repo_path)
+            return None
+        with self._lock:
+            self.counts['hits'] += 1
+        return entry
+
+    def add(self, repo_path: str, error: Exception) -> Optional[NegativeEntry]:
+        """Remember error for repo_path, if it is the kind of error that should
+        be remembered. Returns the new entry, or None."""
+        response = get_response(error)
+        if response is None:
+            return None
+        status, description = response
+        entry = NegativeEntry(
+            error=type(error).__name__,
+            status=status,
+            description=description,
+            origin_status=getattr(error, 'status', None),
+            expires=time() + self.ttl,
+        )
+        self._remember(repo_path, entry)
+        with self._lock:
+            self.counts['added'] += 1
+        if self.local_storage is not None:
+            self._write(repo_path, entry)
+        logger.info(f'Remembering {entry.error} for /{repo_path} for {self.ttl}s')
+        return entry
+
+    def invalidate(self, repo_path: str):
+        """Forget any failure for repo_path, such as when it is deleted from the cache."""
+        with self._lock:
+            found = self._entries.pop(repo_path, None) is not None
+        if self.local_storage is not None and self._delete(repo_path):
+            found = True
+        if found:
+            with self._lock:
+                self.counts['invalidated'] += 1
+
+    def _remember(self, repo_path: str, entry: NegativeEntry):
+        with self._lock:
+            self._entries.pop(repo_path, None)
+            self._entries[repo_path] = entry
+            while len(self._entries) > self.max_entries:
+                # dicts are in insertion order, so this is the oldest entry
+                del self._entries[next(iter(self._entries))]
+
+    def _read(self, repo_path: str) -> Optional[NegativeEntry]:
+        try:
+            row = self.connection.execute('SELECT entry FROM entries WHERE path = ?', (repo_path,)).fetchone()
+            return NegativeEntry(**json.loads(row[0])) if row is not None else None
+        except sqlite3.Error as e:
+            logger.warning(f'Unable to read negative cache entry for /{repo_path}: {e}')
+            return None
+        except (TypeError, ValueError) as e:
+            logger.warning(f'Ignoring invalid negative cache entry for /{repo_path}: {e}')
+            return None
+
+    def _write(self, repo_path: str, entry: NegativeEntry):
+        try:
+            self.connection.execute('DELETE FROM entries WHERE expires < ?', (time(),))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO entries (path, entry, expires) VALUES (?, ?, ?)',
+                (repo_path, json.dumps(asdict(entry)), entry.expires),
+            )
+        except sqlite3.Error as e:
+            # the entry is still remembered in memory
+            logger.warning(f'Unable to write negative cache entry for /{repo_path}: {e}')
+
+    def _delete(self, repo_path: str) -> bool:
+        """Remove the persisted entry for repo_path, and return True if there was one."""
+        try:
+            return self.connection.execute('DELETE FROM entries WHERE path = ?', (repo_path,)).rowcount > 0
+        except sqlite3.Error as e:
+            logger.warning(f'Unable to remove negative cache entry for /{repo_path}: {e}')
+            return False
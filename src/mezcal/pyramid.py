@@ -0,0 +1,143 @@
+"""Writer for tiled, multi-resolution ("pyramidal") TIFF files with JPEG
+compressed tiles, as read by IIIF image servers such as IIPImage and
+Cantaloupe. A server can then decode only the tiles of the resolution
+level it needs, instead of the whole image.
+
+Pillow can read tiled TIFFs, but not write them, so the TIFF structure is
+written here, and Pillow is only used to encode each tile as a JPEG.
+
+The first image file directory (IFD) is the full resolution image; each
+following IFD is a reduced-resolution subfile half the size of the one
+before it, down to the first level that fits in a single tile."""
+import struct
+from io import BytesIO
+from typing import BinaryIO
+
+from PIL import Image
+
+TILE_SIZE = 256
+QUALITY = 75
+
+# modes that write_pyramid() can write, as grayscale or YCbCr tiles
+PYRAMID_MODES = ('L', 'RGB')
+
+# TIFF field types
+SHORT = 3
+LONG = 4
+
+# TIFF tags
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC_INTERPRETATION = 262
+ORIENTATION = 274
+SAMPLES_PER_PIXEL = 277
+PLANAR_CONFIGURATION = 284
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+YCBCR_SUBSAMPLING = 530
+
+COMPRESSION_JPEG = 7
+PHOTOMETRIC_MINISBLACK = 1
+PHOTOMETRIC_YCBCR = 6
+SUBFILE_REDUCED_IMAGE = 1
+
+# offsets are 32-bit in a (non-Big) TIFF
+MAX_SIZE = 2 ** 32 - 1
+
+
+def get_levels(img: Image.Image, tile_size: int = TILE_SIZE) -> list[Image.Image]:
+    """Return img followed by successively halved copies of it, until one fits in a single tile."""
+    levels = [img]
+    while max(img.size) > tile_size:
+        # reduce() averages each 2x2 block, which is both fast and a good filter for halving
+        img = img.reduce(2)
+        levels.append(img)
+    return levels
+
+
+def encode_tile(img: Image.Image, box: tuple[int, int, int, int], quality: int) -> bytes:
+    # crop() pads tiles that extend past the right or bottom edge, since TIFF tiles are all the same size;
+    # the chroma subsampling must match the YCbCrSubSampling tag, and greyscale JPEGs can't be subsampled
+    buffer = BytesIO()
+    img.crop(box).save(buffer, format='JPEG', quality=quality, subsampling='4:2:0' if img.mode == 'RGB' else '4:4:4')
+    return buffer.getvalue()
+
+
+def write_pyramid(img: Image.Image, fh: BinaryIO, tile_size: int = TILE_SIZE, quality: int = QUALITY):
+    """Write img to fh as a tiled pyramidal TIFF. The img must be in mode
+    "L" or "RGB" (see PYRAMID_MODES), and tile_size a multiple of 16."""
+    if img.mode not in PYRAMID_MODES:
+        raise ValueError(f'Cannot write a pyramidal TIFF from an image in mode {img.mode}')
+    if tile_size % 16:
+        raise ValueError('Tile size must be a multiple of 16')
+
+    start = fh.tell()
+    # little-endian header; the offset of the first IFD is filled in below
+    fh.write(b'II*\x00\x00\x00\x00\x00')
+    next_ifd_pointer = start + 4
+    photometric = PHOTOMETRIC_YCBCR if img.mode == 'RGB' else PHOTOMETRIC_MINISBLACK
+    for level, level_img in enumerate(get_levels(img, tile_size)):
+        width, height = level_img.size
+        offsets = []
+        byte_counts = []
+        for top in range(0, height, tile_size):
+            for left in range(0, width, tile_size):
+                tile = encode_tile(level_img, (left, top, left + tile_size, top + tile_size), quality)
+                offsets.append(fh.tell() - start)
+                byte_counts.append(len(tile))
+                fh.write(tile)
+
+        entries = [
+            (NEW_SUBFILE_TYPE, LONG, [SUBFILE_REDUCED_IMAGE if level else 0]),
+            (IMAGE_WIDTH, LONG, [width]),
+            (IMAGE_LENGTH, LONG, [height]),
+            (BITS_PER_SAMPLE, SHORT, [8] * len(img.mode)),
+            (COMPRESSION, SHORT, [COMPRESSION_JPEG]),
+            (PHOTOMETRIC_INTERPRETATION, SHORT, [photometric]),
+            (SAMPLES_PER_PIXEL, SHORT, [len(img.mode)]),
+            (PLANAR_CONFIGURATION, SHORT, [1]),
+            (TILE_WIDTH, LONG, [tile_size]),
+            (TILE_LENGTH, LONG, [tile_size]),
+            (TILE_OFFSETS, LONG, offsets),
+            (TILE_BYTE_COUNTS, LONG, byte_counts),
+        ]
+        if img.mode == 'RGB':
+            entries.append((YCBCR_SUBSAMPLING, SHORT, [2, 2]))
+
+        if fh.tell() - start > MAX_SIZE:
+            raise ValueError('Pyramidal TIFF is larger than 4 GiB')
+        if fh.tell() % 2:
+            # IFDs must start on a word boundary
+            fh.write(b'\x00')
+        ifd_offset = fh.tell() - start
+        fh.seek(next_ifd_pointer)
+        fh.write(struct.pack('<I', ifd_offset))
+        fh.seek(start + ifd_offset)
+        next_ifd_pointer = write_ifd(fh, start, entries)
+
+
+def write_ifd(fh: BinaryIO, start: int, entries: list[tuple[int, int, list[int]]]) -> int:
+    """Write an IFD at the current position of fh, followed by the values that
+    don't fit in its entries. Returns the position of its next IFD pointer."""
+    ifd_offset = fh.tell() - start
+    # values longer than 4 bytes are stored after the entries and the next IFD pointer
+    data_offset = ifd_offset + 2 + 12 * len(entries) + 4
+    ifd = struct.pack('<H', len(entries))
+    data = b''
+    for tag, field_type, values in entries:
+        value = struct.pack(f'<{len(values)}{"H" if field_type == SHORT else "I"}', *values)
+        if len(value) <= 4:
+            ifd += struct.pack('<HHI', tag, field_type, len(values)) + value.ljust(4, b'\x00')
+        else:
+            ifd += struct.pack('<HHII', tag, field_type, len(values), data_offset + len(data))
+            data += value
+    fh.write(ifd)
+    next_ifd_pointer = fh.tell()
+    fh.write(b'\x00\x00\x00\x00')
+    fh.write(data)
+    return next_ifd_pointer
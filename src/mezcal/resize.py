@@ -0,0 +1,84 @@
+"""Downscaling of source images that are larger than the mezzanine size.
+
+Decoding a 300 megapixel master at full resolution, only to throw most of
+the pixels away, is the most expensive part of creating a mezzanine file.
+So before decoding, open_image() uses the cheapest way the source format
+offers to decode it at a reduced size:
+
+* JPEG sources are decoded in "draft" mode, which has the decoder itself
+  scale the image by 1/2, 1/4, or 1/8
+* TIFF sources with reduced-resolution subfiles (such as pyramidal TIFFs)
+  are decoded from the smallest subfile that is still large enough
+
+Then downscale() averages blocks of pixels with Image.reduce() to get close
+to the final size, and only resamples the remaining, much smaller, image."""
+from typing import BinaryIO
+
+from PIL import Image
+
+from mezcal.pyramid import NEW_SUBFILE_TYPE, SUBFILE_REDUCED_IMAGE
+
+# reduce() only down to this many times the final size, so that the final
+# resample still has enough pixels to filter from
+REDUCING_GAP = 2
+
+
+def fit(size: tuple[int, int], max_size: int) -> tuple[int, int]:
+    """Return size scaled down so that its long side is max_size, keeping its aspect ratio."""
+    width, height = size
+    scale = max_size / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def open_image(source: BinaryIO | str, max_size: int = 0) -> Image.Image:
+    """Open and decode the image in source. If max_size is positive and the
+    image is larger than that, it may be decoded at a reduced size that is
+    still at least as large as fit(size, max_size)."""
+    return load_reduced(Image.open(source), max_size)
+
+
+def load_reduced(img: Image.Image, max_size: int = 0) -> Image.Image:
+    """Decode the opened, but not yet loaded, img, the same way as open_image()."""
+    if max_size > 0 and max(img.size) > max_size:
+        target = fit(img.size, max_size)
+        match img.format:
+            case 'JPEG':
+                img.draft(None, target)
+            case 'TIFF':
+                seek_reduced_subfile(img, target)
+    img.load()
+    return img
+
+
+def seek_reduced_subfile(img: Image.Image, target: tuple[int, int]):
+    """Seek the TIFF img to its smallest reduced-resolution subfile that is at
+    least as large as target, or to the full resolution image if there is none."""
+    best_frame, best_size = 0, img.size
+    for frame in range(1, getattr(img, 'n_frames', 1)):
+        img.seek(frame)
+        # other pages of a multi-page TIFF are not versions of the same image
+        if not img.tag_v2.get(NEW_SUBFILE_TYPE, 0) & SUBFILE_REDUCED_IMAGE:
+            continue
+        if img.width >= target[0] and img.height >= target[1] and img.width < best_size[0]:
+            best_frame, best_size = frame, img.size
+    img.seek(best_frame)
+
+
+def downscale(img: Image.Image, max_size: int) -> Image.Image:
+    """Return img scaled down so that its long side is at most max_size. Returns
+    img unchanged if max_size is not positive, or if it is already small enough."""
+    if max_size <= 0 or max(img.size) <= max_size:
+        return img
+    factor = reduce_factor(img.size, max_size)
+    if factor > 1:
+        img = img.reduce(factor)
+    return img.resize(fit(img.size, max_size), Image.LANCZOS)
+
+
+def reduce_factor(size: tuple[int, int], max_size: int) -> int:
+    """Return the factor to reduce() an image of this size by before resampling
+    it to max_size, or 1 if it should not be reduced."""
+    if max_size <= 0 or max(size) <= max_size:
+        return 1
+    target = fit(size, max_size)
+    return max(min(size[0] // target[0], size[1] // target[1]) // REDUCING_GAP, 1)
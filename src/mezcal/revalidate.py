@@ -0,0 +1,179 @@
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from http import HTTPStatus
+from threading import Lock
+from time import time
+from typing import Mapping, Optional
+
+from filelock import Timeout
+
+from mezcal.admission import Limiter, Overloaded, admit_now
+from mezcal.http import OriginRepository, get_origin_digest, get_origin_metadata
+from mezcal.index import CacheIndex
+from mezcal.memory import MemoryCache
+from mezcal.storage import MezzanineFile, FileInfo
+
+logger = logging.getLogger(__name__)
+
+# how long to wait for a file's lock when updating it after revalidation
+LOCK_TIMEOUT = 30
+
+
+def record_origin_metadata(local_file: MezzanineFile, headers: Mapping[str, str]):
+    """Store the validators from the headers of the origin response that
+    local_file was created from. The caller must hold the file's lock."""
+    local_file.update_metadata(origin=get_origin_metadata(headers), validated=time())
+
+
+class Revalidator:
+    """Refreshes mezzanine files in the background once they are more than
+    max_age seconds old.
+
+    A stale file is still served as-is; submit() queues a conditional
+    request to the origin, using the validators stored when the file was
+    created. If the origin responds with 304 Not Modified, only the time
+    of validation is updated. If it responds with 200, the image is fetched
+    and the mezzanine file is re-encoded and replaced. Each path is only
+    revalidated by one thread at a time, and a path that fails to
+    revalidate (for example, because the origin is down) is not tried
+    again for retry_interval seconds.
+
+    With a fetch_limiter or encode_limiter, revalidation takes a slot in
+    them like a cache miss, but only if one is free right away; otherwise
+    the file is skipped, and tried again after retry_interval seconds."""
+
+    def __init__(
+            self,
+            origin_repo: OriginRepository,
+            max_age: float,
+            auth=None,
+            cache_index: Optional[CacheIndex] = None,
+            memory_cache: Optional[MemoryCache] = None,
+            max_workers: int = 2,
+            retry_interval: float = 60,
+            max_entries: int = 10000,
+            fetch_limiter: Optional[Limiter] = None,
+            encode_limiter: Optional[Limiter] = None,
+    ):
+        self.origin_repo = origin_repo
+        self.max_age = max_age
+        self.auth = auth
+        self.cache_index = cache_index
+        # copies in memory have the old validation time (and maybe the old image), so are dropped
+        self.memory_cache = memory_cache
+        self.retry_interval = retry_interval
+        # shared with the cache misses, which take priority
+        self.fetch_limiter = fetch_limiter
+        self.encode_limiter = encode_limiter
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='Revalidate')
+        self._lock = Lock()
+        self._in_progress: set[str] = set()
+        self._retry_at: dict[str, float] = {}
+        # the validation times last read from up to max_entries metadata files
+        self.max_entries = max_entries
+        self._validated: OrderedDict[str, float] = OrderedDict()
+        self.counts = {'not_modified': 0, 'updated': 0, 'skipped': 0, 'failed': 0, 'overloaded': 0}
+
+    @property
+    def stats(self) -> dict:
+        return {'max_age': self.max_age, 'in_progress': len(self._in_progress), **self.counts}
+
+    def is_stale(self, local_file: MezzanineFile, info: FileInfo) -> bool:
+        """Return True if local_file was last validated more than max_age
+        seconds ago. Its metadata file is only read if it is older than
+        max_age, and not known to have been validated since."""
+        now = time()
+        # validated when it was created, so a newer file can't be stale
+        if now - info.last_modified.timestamp() <= self.max_age:
+            return False
+        key = str(local_file.path)
+        with self._lock:
+            validated = self._validated.get(key)
+        # validation times only move forward, so a recent one that was read earlier is still recent
+        if validated is not None and now - validated <= self.max_age:
+            return False
+        # files created before validators were recorded are as old as their modification time
+        validated = local_file.read_metadata().get('validated', info.last_modified.timestamp())
+        with self._lock:
+            self._validated[key] = validated
+            self._validated.move_to_end(key)
+            while len(self._validated) > self.max_entries:
+                self._validated.popitem(last=False)
+        return now - validated > self.max_age
+
+    def submit(self, repo_path: str, local_file: MezzanineFile, info: FileInfo) -> bool:
+        """Queue local_file for revalidation if it is stale, and not already
+        queued. Returns True if it was queued."""
+        # keyed by file, since each format of a resource is stored in its own file
+        key = str(local_file.path)
+        with self._lock:
+            if key in self._in_progress or time() < self._retry_at.get(key, 0):
+                # checked first, so that a stale file isn't read again while it is being revalidated
+                return False
+        if not self.is_stale(local_file, info):
+            return False
+        with self._lock:
+            if key in self._in_progress or time() < self._retry_at.get(key, 0):
+                return False
+            self._retry_at.pop(key, None)
+            self._in_progress.add(key)
+        logger.debug(f'{local_file} is stale; revalidating /{repo_path}')
+        self._executor.submit(self._revalidate, repo_path, local_file)
+        return True
+
+    def _revalidate(self, repo_path: str, local_file: MezzanineFile):
+        try:
+            outcome = self.revalidate(repo_path, local_file, local_file.read_metadata().get('origin'))
+        except Overloaded as e:
+            # cache misses come first; tried again after retry_interval
+            logger.info(f'Not revalidating {local_file} for /{repo_path}: {e}')
+            outcome = 'overloaded'
+        except Timeout:
+            logger.error(f'Unable to acquire a lock to {local_file} in {LOCK_TIMEOUT}s to revalidate it')
+            outcome = 'failed'
+        except Exception as e:
+            logger.error(f'Unable to revalidate {local_file} for /{repo_path}: {e}')
+            outcome = 'failed'
+        if self.memory_cache is not None and outcome not in ('failed', 'overloaded'):
+            self.memory_cache.invalidate(local_file)
+        key = str(local_file.path)
+        with self._lock:
+            self.counts[outcome] += 1
+            if outcome in ('failed', 'overloaded'):
+                self._retry_at[key] = time() + self.retry_interval
+            self._in_progress.discard(key)
+
+    def revalidate(self, repo_path: str, local_file: MezzanineFile, validators: Optional[dict]) -> str:
+        """Make a conditional request for repo_path, and update local_file to
+        match. Returns "not_modified", "updated", or "skipped" if the file
+        was deleted in the meantime. Raises Overloaded if the fetch_limiter
+        or encode_limiter has no free slot; revalidation never waits for one."""
+        body = None
+        # the origin connection is in use until the body is spooled
+        with admit_now(self.fetch_limiter):
+            response = self.origin_repo.get(repo_path, auth=self.auth, validators=validators)
+            if response.status_code != HTTPStatus.NOT_MODIFIED:
+                body = self.origin_repo.spool(repo_path, response)
+        with body or nullcontext(), local_file.acquire_lock(LOCK_TIMEOUT):
+            if not local_file.exists:
+                # deleted while we were waiting; the next request will fetch it again
+                return 'skipped'
+            if body is None:
+                local_file.update_metadata(validated=time())
+                logger.debug(f'/{repo_path} is not modified at the origin')
+                return 'not_modified'
+
+            digest = get_origin_digest(response.headers)
+            if not local_file.link_stored(digest):
+                with admit_now(self.encode_limiter):
+                    local_file.create(body.source, digest)
+            record_origin_metadata(local_file, response.headers)
+            if self.cache_index is not None:
+                self.cache_index.add(local_file)
+            logger.info(f'Replaced {local_file} with a new copy of /{repo_path}')
+            return 'updated'
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
@@ -1,24 +1,332 @@
 import logging
 import os
+import socket
+from functools import partial
+from pathlib import Path
+from typing import Optional
 
-from waitress import serve
+from waitress import create_server
 
 from mezcal import __version__
+from mezcal.admission import Limiter
+from mezcal.delivery import ProxyDelivery, get_delivery_mode
 from mezcal.http import OriginRepository
-from mezcal.storage import LocalStorage, DirectoryLayout
+from mezcal.index import CacheIndex
+from mezcal.locks import LockManager, DirectoryLockManager, ShardedLockManager, LeaseLockManager
+from mezcal.memory import MemoryCache
+from mezcal.metrics import REGISTRY
+from mezcal.negative import NegativeCache
+from mezcal.shared import SharedStorage, StorageBackend, FilesystemBackend, S3Backend
+from mezcal.storage import LocalStorage, DirectoryLayout, ProcessEncoder, EncodingOptions
+from mezcal.trace import TraceLog
 from mezcal.web import create_app
+from mezcal.workers import Prefork, ServerOptions, bind, serve_until_stopped, warm_up
 
 logger = logging.getLogger(__name__)
 
 
-def run():
-    server_identity = f'mezcal/{__version__}'
-    logger.info(f'Starting {server_identity}')
+def get_cache_index(local_storage: LocalStorage) -> Optional[CacheIndex]:
+    """Return a CacheIndex for local_storage if CACHE_MAX_BYTES or CACHE_MAX_FILES
+    is set to a positive number, otherwise return None."""
+    max_bytes = int(os.environ.get('CACHE_MAX_BYTES', 0))
+    max_files = int(os.environ.get('CACHE_MAX_FILES', 0))
+    if max_bytes <= 0 and max_files <= 0:
+        return None
+    logger.info(f'Limiting cache to {max_bytes or "unlimited"} bytes and {max_files or "unlimited"} files')
+    return CacheIndex(
+        local_storage=local_storage,
+        max_bytes=max_bytes,
+        max_files=max_files,
+        policy=os.environ.get('CACHE_EVICTION_POLICY', 'LRU'),
+    )
+
+
+def get_negative_cache(local_storage: LocalStorage) -> Optional[NegativeCache]:
+    """Return a NegativeCache if NEGATIVE_CACHE_TTL is set to a positive number,
+    otherwise return None. If NEGATIVE_CACHE_PERSIST is true, its entries are
+    also stored in local_storage."""
+    ttl = float(os.environ.get('NEGATIVE_CACHE_TTL', 0))
+    if ttl <= 0:
+        return None
+    persist = os.environ.get('NEGATIVE_CACHE_PERSIST', '').lower() in ('1', 'true', 'yes')
+    logger.info(f'Remembering origin failures for {ttl}s{" in the storage directory" if persist else ""}')
+    return NegativeCache(
+        ttl=ttl,
+        local_storage=local_storage if persist else None,
+        max_entries=int(os.environ.get('NEGATIVE_CACHE_MAX_ENTRIES', 10000)),
+    )
+
+
+def get_memory_cache(workers: int = 1) -> Optional[MemoryCache]:
+    """Return a MemoryCache if MEMORY_CACHE_MAX_BYTES is set to a positive number,
+    otherwise return None. MEMORY_CACHE_MAX_BYTES is the total for all the
+    server processes, so each of the workers gets an equal share of it."""
+    max_bytes = int(os.environ.get('MEMORY_CACHE_MAX_BYTES', 0)) // max(workers, 1)
+    if max_bytes <= 0:
+        return None
+    logger.info(f'Keeping up to {max_bytes} bytes of mezzanine files in memory in this process')
+    return MemoryCache(
+        max_bytes=max_bytes,
+        max_file_size=int(os.environ.get('MEMORY_CACHE_MAX_FILE_SIZE', 0)) or None,
+        max_age=float(os.environ.get('MEMORY_CACHE_MAX_AGE', 60)),
+    )
+
+
+def get_encoder() -> Optional[ProcessEncoder]:
+    """Return a ProcessEncoder if ENCODER_PROCESSES is set to a positive
+    number, otherwise return None."""
+    processes = int(os.environ.get('ENCODER_PROCESSES', 0))
+    if processes <= 0:
+        return None
+    logger.info(f'Encoding images in {processes} worker processes')
+    return ProcessEncoder(max_workers=processes)
+
+
+def get_lock_manager(storage_dir: Path) -> LockManager:
+    """Return the LockManager selected by the LOCK_BACKEND environment variable."""
+    backend = os.environ.get('LOCK_BACKEND', 'directory').lower()
+    lock_dir = Path(os.environ.get('LOCK_DIR') or storage_dir / '.locks')
+    match backend:
+        case 'directory':
+            return DirectoryLockManager()
+        case 'sharded':
+            return ShardedLockManager(lock_dir=lock_dir, shards=int(os.environ.get('LOCK_SHARDS', 1024)))
+        case 'lease':
+            return LeaseLockManager(
+                db_path=lock_dir / 'leases.sqlite',
+                ttl=float(os.environ.get('LOCK_LEASE_TTL', 300)),
+            )
+        case _:
+            raise RuntimeError(f'"{backend}" is not a recognized lock backend')
+
+
+def get_shared_backend() -> Optional[StorageBackend]:
+    """Return the StorageBackend selected by the SHARED_STORAGE environment
+    variable, or None if it is not set."""
+    backend = os.environ.get('SHARED_STORAGE', '').lower()
+    match backend:
+        case '':
+            return None
+        case 'filesystem':
+            root = os.environ.get('SHARED_STORAGE_DIR')
+            if not root:
+                raise RuntimeError('SHARED_STORAGE_DIR is required for filesystem shared storage')
+            return FilesystemBackend(root)
+        case 's3':
+            # optional dependency, only needed for this backend
+            import boto3
+
+            bucket = os.environ.get('S3_BUCKET')
+            if not bucket:
+                raise RuntimeError('S3_BUCKET is required for S3 shared storage')
+            return S3Backend(
+                # credentials and region are read from the usual AWS_* environment variables
+                client=boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None),
+                bucket=bucket,
+                prefix=os.environ.get('S3_PREFIX', ''),
+                multipart_threshold=int(os.environ.get('S3_MULTIPART_THRESHOLD', 64 * 1024 * 1024)),
+                part_size=int(os.environ.get('S3_PART_SIZE', 16 * 1024 * 1024)),
+            )
+        case _:
+            raise RuntimeError(f'"{backend}" is not a recognized shared storage backend')
+
+
+def get_delivery(local_storage: LocalStorage) -> Optional[ProxyDelivery]:
+    """Return a ProxyDelivery for local_storage if DELIVERY_MODE is set to
+    "x-accel-redirect" or "x-sendfile", or None if it is "direct" (the default)."""
+    mode = os.environ.get('DELIVERY_MODE', 'direct')
+    if mode.lower() == 'direct':
+        return None
+    delivery = ProxyDelivery(
+        mode=get_delivery_mode(mode),
+        storage_dir=local_storage.storage_dir,
+        prefix=os.environ.get('DELIVERY_PREFIX', ''),
+    )
+    logger.info(f'Cached files are sent by the front proxy using {delivery.header}')
+    return delivery
+
+
+def get_limiter(stage: str) -> Optional[Limiter]:
+    """Return a Limiter for cache misses at stage ("fetch" or "encode") if
+    <STAGE>_CONCURRENCY is set to a positive number, otherwise return None."""
+    prefix = stage.upper()
+    limit = int(os.environ.get(f'{prefix}_CONCURRENCY', 0))
+    if limit <= 0:
+        return None
+    queue_size = int(os.environ.get(f'{prefix}_QUEUE_SIZE') or limit)
+    logger.info(f'Allowing {limit} cache misses to {stage} at once, with {queue_size} more waiting')
+    return Limiter(
+        name=stage,
+        limit=limit,
+        queue_size=queue_size,
+        timeout=float(os.environ.get('ADMISSION_TIMEOUT', 10)),
+        retry_after=int(os.environ.get('ADMISSION_RETRY_AFTER', 5)),
+    )
+
+
+def get_trace_log() -> Optional[TraceLog]:
+    """Return a TraceLog writing to TRACE_LOG_FILE if it is set, otherwise return None."""
+    path = os.environ.get('TRACE_LOG_FILE')
+    if not path:
+        return None
+    sample_rate = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+    logger.info(f'Writing {sample_rate:.1%} of request traces to {path}')
+    return TraceLog(path, sample_rate=sample_rate)
+
+
+def get_encoding_options() -> EncodingOptions:
+    """Return the EncodingOptions configured by the MEZZANINE_MAX_SIZE, JPEG_*,
+    and STREAM_WORKING_SET environment variables."""
+    return EncodingOptions(
+        max_size=int(os.environ.get('MEZZANINE_MAX_SIZE', 0)),
+        quality=int(os.environ.get('JPEG_QUALITY', 75)),
+        subsampling=os.environ.get('JPEG_SUBSAMPLING', '4:2:0'),
+        progressive=os.environ.get('JPEG_PROGRESSIVE', '').lower() in ('1', 'true', 'yes'),
+        optimize=os.environ.get('JPEG_OPTIMIZE', '').lower() in ('1', 'true', 'yes'),
+        working_set=int(os.environ.get('STREAM_WORKING_SET', 64 * 1024 * 1024)),
+    )
+
+
+def get_local_storage(encoder: Optional[ProcessEncoder] = None) -> LocalStorage:
+    storage_dir = Path.cwd() / os.environ.get('STORAGE_DIR', '')
+    shared_backend = get_shared_backend()
+    return LocalStorage(
+        storage_dir=storage_dir,
+        layout=DirectoryLayout[os.environ.get('STORAGE_LAYOUT', 'BASIC').upper()],
+        encoder=encoder,
+        lock_manager=get_lock_manager(storage_dir),
+        formats=os.environ.get('IMAGE_FORMATS', 'JPEG').split(','),
+        options=get_encoding_options(),
+        sizes=[int(size) for size in os.environ.get('IMAGE_SIZES', '').split(',') if size.strip()],
+        shared=SharedStorage(shared_backend, storage_dir) if shared_backend is not None else None,
+    )
+
+
+def get_origin_repository(pool_size: Optional[int] = None) -> OriginRepository:
+    """Return an OriginRepository configured from the environment. If pool_size
+    is given, it overrides the ORIGIN_POOL_SIZE environment variable."""
+    return OriginRepository(
+        base_url=os.environ.get('REPO_BASE_URL'),
+        pool_size=pool_size or int(os.environ.get('ORIGIN_POOL_SIZE', 10)),
+        connect_timeout=float(os.environ.get('ORIGIN_CONNECT_TIMEOUT', 5)),
+        read_timeout=float(os.environ.get('ORIGIN_READ_TIMEOUT', 60)),
+        max_retries=int(os.environ.get('ORIGIN_MAX_RETRIES', 3)),
+        backoff_factor=float(os.environ.get('ORIGIN_RETRY_BACKOFF', 0.5)),
+        max_size=int(os.environ.get('ORIGIN_MAX_SIZE', 0)),
+        spool_memory_limit=int(os.environ.get('ORIGIN_SPOOL_MEMORY_LIMIT', 16 * 1024 * 1024)),
+        spool_dir=os.environ.get('ORIGIN_SPOOL_DIR') or None,
+    )
+
+
+def get_server_options() -> ServerOptions:
+    """Return the ServerOptions configured by the SERVER_* environment variables."""
+    return ServerOptions(
+        listen=os.environ.get('SERVER_LISTEN', '0.0.0.0:5000'),
+        workers=int(os.environ.get('SERVER_WORKERS', 1)),
+        threads=int(os.environ.get('SERVER_THREADS', 4)),
+        connection_limit=int(os.environ.get('SERVER_CONNECTION_LIMIT', 100)),
+        backlog=int(os.environ.get('SERVER_BACKLOG', 1024)),
+        channel_timeout=int(os.environ.get('SERVER_CHANNEL_TIMEOUT', 120)),
+        max_request_body_size=int(os.environ.get('SERVER_MAX_REQUEST_BODY_SIZE', 1024 * 1024 * 1024)),
+        shutdown_timeout=float(os.environ.get('SERVER_SHUTDOWN_TIMEOUT', 30)),
+    )
+
+
+def start_cache_index(local_storage: LocalStorage, worker: int) -> Optional[CacheIndex]:
+    """Return the configured CacheIndex, if any, with its background thread
+    started. Only the first worker rebuilds the index and evicts files."""
+    cache_index = get_cache_index(local_storage)
+    if cache_index is not None:
+        cache_index.start(
+            interval=float(os.environ.get('CACHE_EVICTION_INTERVAL', 60)), rebuild=worker == 0, evict=worker == 0
+        )
+    return cache_index
+
+
+def serve_wsgi(sock: socket.socket, worker: int, options: ServerOptions, server_identity: str):
+    """Serve the WSGI application on sock with waitress until the process is
+    told to stop, then finish the requests in progress."""
+    warm_up()
+    encoder = get_encoder()
+    local_storage = get_local_storage(encoder=encoder)
+    cache_index = start_cache_index(local_storage, worker)
     app = create_app(
-        local_storage=LocalStorage(
-            storage_dir=os.environ.get('STORAGE_DIR', ''),
-            layout=DirectoryLayout[os.environ.get('STORAGE_LAYOUT', 'BASIC').upper()],
-        ),
-        origin_repo=OriginRepository(os.environ.get('REPO_BASE_URL'))
+        local_storage=local_storage,
+        origin_repo=get_origin_repository(),
+        cache_index=cache_index,
+        trace_log=get_trace_log(),
+        negative_cache=get_negative_cache(local_storage),
+        memory_cache=get_memory_cache(options.workers),
+        delivery=get_delivery(local_storage),
+        fetch_limiter=get_limiter('fetch'),
+        encode_limiter=get_limiter('encode'),
+    )
+    server = create_server(app, sockets=[sock], ident=server_identity, **options.waitress_args)
+    try:
+        serve_until_stopped(server, options.shutdown_timeout)
+    finally:
+        if encoder is not None:
+            encoder.shutdown(wait=True)
+        if cache_index is not None:
+            cache_index.stop()
+
+
+def serve_asgi(sock: socket.socket, worker: int, options: ServerOptions, server_identity: str):
+    """Serve the ASGI application on sock with uvicorn, which finishes the
+    requests in progress when it is told to stop."""
+    # optional dependencies, only needed in this mode
+    import uvicorn
+    from mezcal.asgi import MezcalASGI
+
+    warm_up()
+    encoder = get_encoder()
+    local_storage = get_local_storage(encoder=encoder)
+    cache_index = start_cache_index(local_storage, worker)
+    app = MezcalASGI(
+        local_storage=local_storage,
+        origin_repo=get_origin_repository(),
+        cache_index=cache_index,
+        trace_log=get_trace_log(),
+        negative_cache=get_negative_cache(local_storage),
+        memory_cache=get_memory_cache(options.workers),
+        delivery=get_delivery(local_storage),
+        fetch_limiter=get_limiter('fetch'),
+        encode_limiter=get_limiter('encode'),
+    )
+    config = uvicorn.Config(
+        app,
+        backlog=options.backlog,
+        limit_concurrency=options.connection_limit,
+        timeout_graceful_shutdown=options.shutdown_timeout,
+        server_header=False,
+        headers=[('Server', server_identity)],
     )
-    serve(app, listen='0.0.0.0:5000', ident=server_identity)
+    try:
+        uvicorn.Server(config).run(sockets=[sock])
+    finally:
+        if encoder is not None:
+            encoder.shutdown(wait=True)
+        if cache_index is not None:
+            cache_index.stop()
+
+
+def run():
+    server_identity = f'mezcal/{__version__}'
+    server_mode = os.environ.get('SERVER_MODE', 'wsgi').lower()
+    if server_mode not in ('wsgi', 'asgi'):
+        raise RuntimeError(f'"{server_mode}" is not a recognized server mode')
+    options = get_server_options()
+    logger.info(f'Starting {server_identity} ({server_mode.upper()}) on {options.listen}')
+    serve = serve_asgi if server_mode == 'asgi' else serve_wsgi
+    sock = bind(options.listen, options.backlog)
+    if options.workers > 1:
+        # each scrape of /metrics is answered by one of the workers
+        REGISTRY.label_process = True
+        Prefork(
+            sock=sock,
+            workers=options.workers,
+            target=partial(serve, options=options, server_identity=server_identity),
+            shutdown_timeout=options.shutdown_timeout,
+        ).run()
+    else:
+        serve(sock, 0, options, server_identity)
@@ -0,0 +1,351 @@
+"""Storage for mezzanine files that is shared by every mezcal node.
+
+Each node still serves its requests from its own LocalStorage, which acts
+as a read-through tier in front of the shared storage: on a local miss,
+the file is downloaded from the shared storage if another node already
+created it, and only fetched from the origin and encoded if no node has.
+Newly created files are uploaded for the other nodes to use.
+
+Nodes do not share locks. Uploads of new files are conditional, so when
+two nodes create the same file at the same time, only the first upload
+succeeds, and the other node replaces its own copy with the uploaded
+one, so that every node sends the same ETag for it."""
+import json
+import logging
+import os
+import shutil
+from abc import ABC, abstractmethod
+from itertools import count
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import BinaryIO, Optional
+
+from mezcal.metrics import Timer, SHARED_STORAGE_REQUESTS, SHARED_STORAGE_SECONDS
+from mezcal.storage import MezzanineFile, sync_dir
+
+logger = logging.getLogger(__name__)
+
+# size of the reads when copying files to and from the storage
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# metadata of a mezzanine file that is kept with its shared copy
+SHARED_METADATA_KEYS = ('etag',)
+
+
+class StorageBackend(ABC):
+    """Objects stored by key, where keys are relative paths such as
+    "foo/bar/image.jpg", each with a small dict of string metadata."""
+
+    @abstractmethod
+    def download(self, key: str, fh: BinaryIO) -> Optional[dict]:
+        """Write the object with key to fh, and return its metadata, or return
+        None (without writing anything) if there is no such object."""
+
+    @abstractmethod
+    def upload(self, key: str, path: Path, metadata: dict, replace: bool = False) -> bool:
+        """Store the file at path as the object with key. Unless replace is
+        true, this only succeeds if there is no object with key yet; returns
+        False if there is."""
+
+    @abstractmethod
+    def get_metadata(self, key: str) -> Optional[dict]:
+        """Return the metadata of the object with key, or None if there is no such object."""
+
+    @abstractmethod
+    def list(self, prefix: str) -> list[str]:
+        """Return the keys of the objects directly in prefix (such as "foo/bar"), but not in its subdirectories."""
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Remove the object with key, if there is one."""
+
+
+class FilesystemBackend(StorageBackend):
+    """Objects stored as files under root, which can be a network file
+    system mounted on every node. The metadata of each object is kept in a
+    JSON sidecar file. Conditional uploads use link(), which fails if the
+    target already exists, so no file locks are needed."""
+
+    def __init__(self, root: Path | str):
+        self.root = Path(root)
+
+    def get_path(self, key: str) -> Path:
+        return self.root / key
+
+    def download(self, key: str, fh: BinaryIO) -> Optional[dict]:
+        path = self.get_path(key)
+        # read first, since the object could be replaced between the two reads
+        metadata = self.get_metadata(key)
+        try:
+            with path.open('rb') as src:
+                shutil.copyfileobj(src, fh, COPY_CHUNK_SIZE)
+        except FileNotFoundError:
+            return None
+        return metadata or {}
+
+    def upload(self, key: str, path: Path, metadata: dict, replace: bool = False) -> bool:
+        target = self.get_path(key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self._copy_to_temp(path, target)
+        metadata_path = self._write_temp_metadata(target, metadata)
+        try:
+            if replace:
+                os.replace(temp_path, target)
+            else:
+                try:
+                    os.link(temp_path, target)
+                except FileExistsError:
+                    return False
+            os.replace(metadata_path, self._metadata_path(target))
+            return True
+        finally:
+            temp_path.unlink(missing_ok=True)
+            metadata_path.unlink(missing_ok=True)
+
+    def get_metadata(self, key: str) -> Optional[dict]:
+        try:
+            return json.loads(self._metadata_path(self.get_path(key)).read_text())
+        except FileNotFoundError:
+            return {} if self.get_path(key).exists() else None
+        except ValueError:
+            return {}
+
+    def list(self, prefix: str) -> list[str]:
+        directory = self.get_path(prefix)
+        try:
+            return sorted(
+                f'{prefix}/{entry.name}' for entry in os.scandir(directory)
+                if entry.is_file() and not entry.name.startswith('.')
+            )
+        except FileNotFoundError:
+            return []
+
+    def delete(self, key: str):
+        target = self.get_path(key)
+        target.unlink(missing_ok=True)
+        self._metadata_path(target).unlink(missing_ok=True)
+
+    @staticmethod
+    def _metadata_path(target: Path) -> Path:
+        # a hidden file, so that list() skips it
+        return target.with_name(f'.{target.name}.json')
+
+    @staticmethod
+    def _copy_to_temp(path: Path, target: Path) -> Path:
+        fh = NamedTemporaryFile(dir=target.parent, prefix=f'.{target.name}.', suffix='.tmp', delete=False)
+        try:
+            with fh, path.open('rb') as src:
+                shutil.copyfileobj(src, fh, COPY_CHUNK_SIZE)
+                fh.flush()
+                os.fsync(fh.fileno())
+        except BaseException:
+            Path(fh.name).unlink(missing_ok=True)
+            raise
+        return Path(fh.name)
+
+    @staticmethod
+    def _write_temp_metadata(target: Path, metadata: dict) -> Path:
+        fh = NamedTemporaryFile(
+            mode='w', dir=target.parent, prefix=f'.{target.name}.json.', suffix='.tmp', delete=False
+        )
+        with fh:
+            json.dump(metadata, fh)
+        return Path(fh.name)
+
+
+class S3Backend(StorageBackend):
+    """Objects stored in an S3-compatible bucket, under prefix, using a boto3
+    S3 client (boto3 is an optional dependency, installed with the "s3"
+    extra). Metadata is stored as the objects' user metadata.
+
+    Conditional uploads use "If-None-Match: *", which the bucket must
+    support (AWS S3 and MinIO do). Files larger than multipart_threshold
+    bytes are uploaded in parts of part_size bytes, and the condition is
+    checked when the upload is completed."""
+
+    def __init__(
+            self,
+            client,
+            bucket: str,
+            prefix: str = '',
+            multipart_threshold: int = 64 * 1024 * 1024,
+            part_size: int = 16 * 1024 * 1024,
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.multipart_threshold = multipart_threshold
+        # S3 requires every part but the last to be at least 5 MiB
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+
+    def get_key(self, key: str) -> str:
+        return f'{self.prefix}/{key}' if self.prefix else key
+
+    def download(self, key: str, fh: BinaryIO) -> Optional[dict]:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.get_key(key))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        body = response['Body']
+        try:
+            for chunk in body.iter_chunks(COPY_CHUNK_SIZE):
+                fh.write(chunk)
+        finally:
+            body.close()
+        return response.get('Metadata', {})
+
+    def upload(self, key: str, path: Path, metadata: dict, replace: bool = False) -> bool:
+        conditions = {} if replace else {'IfNoneMatch': '*'}
+        try:
+            if path.stat().st_size > self.multipart_threshold:
+                self._upload_parts(self.get_key(key), path, metadata, conditions)
+            else:
+                with path.open('rb') as fh:
+                    self.client.put_object(
+                        Bucket=self.bucket, Key=self.get_key(key), Body=fh, Metadata=metadata, **conditions
+                    )
+        except self.client.exceptions.ClientError as e:
+            # 409 ConditionalRequestConflict is returned for a conflicting upload that is still in progress
+            if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
+    def _upload_parts(self, key: str, path: Path, metadata: dict, conditions: dict):
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key, Metadata=metadata)['UploadId']
+        try:
+            parts = []
+            with path.open('rb') as fh:
+                for number in count(1):
+                    data = fh.read(self.part_size)
+                    if not data:
+                        break
+                    response = self.client.upload_part(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data
+                    )
+                    parts.append({'ETag': response['ETag'], 'PartNumber': number})
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts}, **conditions
+            )
+        except BaseException:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def get_metadata(self, key: str) -> Optional[dict]:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.get_key(key)).get('Metadata', {})
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def list(self, prefix: str) -> list[str]:
+        keys = []
+        full_prefix = self.get_key(prefix) + '/'
+        paginator = self.client.get_paginator('list_objects_v2')
+        # with a delimiter, objects in "subdirectories" are left out
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=full_prefix, Delimiter='/'):
+            keys.extend(f'{prefix}/{item["Key"][len(full_prefix):]}' for item in page.get('Contents', []))
+        return sorted(keys)
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.get_key(key))
+
+
+class SharedStorage:
+    """Copies of the mezzanine files in a LocalStorage at storage_dir, kept in
+    backend under the same relative paths, so the nodes sharing a backend
+    must use the same STORAGE_LAYOUT."""
+
+    def __init__(self, backend: StorageBackend, storage_dir: Path):
+        self.backend = backend
+        self.storage_dir = storage_dir
+        self._lock = Lock()
+        self.counts = {'hit': 0, 'miss': 0, 'upload': 0, 'conflict': 0, 'error': 0}
+
+    @property
+    def stats(self) -> dict:
+        return {'backend': type(self.backend).__name__, **self.counts}
+
+    def get_key(self, path: Path) -> str:
+        return path.relative_to(self.storage_dir).as_posix()
+
+    def fetch(self, file: MezzanineFile) -> bool:
+        """Download the shared copy of file, if there is one, and publish it
+        as file. Returns True if it was downloaded. Errors are logged, and
+        treated as a miss. The caller must hold the file's lock."""
+        key = self.get_key(file.path)
+        old_digest = file.read_metadata().get('digest') if file.store is not None else None
+        file.path.parent.mkdir(parents=True, exist_ok=True)
+        fh = NamedTemporaryFile(dir=file.path.parent, prefix=f'.{file.path.name}.', suffix='.tmp', delete=False)
+        try:
+            with fh, Timer(
+                'download shared copy of %s', key, histogram=SHARED_STORAGE_SECONDS, stage='shared', logger=logger
+            ):
+                metadata = self.backend.download(key, fh)
+                fh.flush()
+                os.fsync(fh.fileno())
+                stat = os.fstat(fh.fileno())
+            if metadata is None:
+                self._count('miss')
+                return False
+            os.replace(fh.name, file.path)
+        except Exception as e:
+            logger.warning(f'Unable to download the shared copy of {file}: {e}')
+            self._count('error')
+            return False
+        finally:
+            Path(fh.name).unlink(missing_ok=True)
+        file.write_metadata({
+            **{name: metadata[name] for name in SHARED_METADATA_KEYS if name in metadata},
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+        })
+        sync_dir(file.path.parent)
+        if old_digest is not None:
+            # this replaced a link to a ContentStore copy
+            file.store.release(old_digest, file.path.name)
+        self._count('hit')
+        logger.debug(f'Downloaded the shared copy of {file}')
+        return True
+
+    def publish(self, file: MezzanineFile, replace: bool = False):
+        """Upload a newly created file. If replace is false and another node has
+        already uploaded it, the file is replaced with the shared copy.
+        Errors are logged; the file is still available locally. The caller
+        must hold the file's lock."""
+        key = self.get_key(file.path)
+        metadata = file.read_metadata()
+        shared_metadata = {name: str(metadata[name]) for name in SHARED_METADATA_KEYS if name in metadata}
+        try:
+            with Timer(
+                'upload shared copy of %s', key, histogram=SHARED_STORAGE_SECONDS, stage='shared', logger=logger
+            ):
+                uploaded = self.backend.upload(key, file.path, shared_metadata, replace=replace)
+            if uploaded:
+                self._count('upload')
+                return
+            self._count('conflict')
+            if self.backend.get_metadata(key) != shared_metadata:
+                logger.info(f'{file} was created by another node; replacing it with the shared copy')
+                self.fetch(file)
+        except Exception as e:
+            logger.warning(f'Unable to upload {file} to the shared storage: {e}')
+            self._count('error')
+
+    def delete(self, directory: Path):
+        """Remove the shared copies of the files in directory, the local
+        storage directory of a repository path. Raises a RuntimeError if they
+        could not be removed."""
+        try:
+            for key in self.backend.list(self.get_key(directory)):
+                self.backend.delete(key)
+        except Exception as e:
+            logger.error(f'Unable to remove the shared copies of {directory}: {e}')
+            raise RuntimeError('Unable to remove resource')
+
+    def _count(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+        SHARED_STORAGE_REQUESTS.labels(key).inc()
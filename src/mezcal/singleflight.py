@@ -0,0 +1,61 @@
+import logging
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """Registry of in-progress operations, keyed by a string.
+
+    The first thread to call run() for a key (the "leader") executes the
+    operation; any other threads that call run() for the same key while it
+    is in progress wait for the leader's outcome instead of repeating the
+    work. Waiters are woken as soon as the leader finishes, and get the
+    leader's return value or exception.
+
+    This only coordinates threads within a single process."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flights: dict[str, Future] = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def __contains__(self, key: str):
+        return key in self._flights
+
+    def run(self, key: str, func: Callable[[], T], timeout: Optional[float] = None) -> T:
+        """Run func, unless another thread is already running it for key, in
+        which case wait up to timeout seconds for that thread's outcome.
+
+        Raises TimeoutError if the wait times out."""
+
+        with self._lock:
+            future = self._flights.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._flights[key] = Future()
+
+        if not is_leader:
+            logger.debug(f'Waiting for in-flight operation for {key}')
+            return future.result(timeout=timeout)
+
+        try:
+            result = func()
+        except BaseException as e:
+            self._land(key)
+            future.set_exception(e)
+            raise
+        else:
+            self._land(key)
+            future.set_result(result)
+            return result
+
+    def _land(self, key: str):
+        with self._lock:
+            del self._flights[key]
@@ -1,16 +1,37 @@
+import errno
+import json
 import logging
 import os
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from enum import Enum
-from hashlib import md5
+from hashlib import md5, file_digest
 from pathlib import Path
-from struct import unpack
-from threading import current_thread
+from secrets import token_hex
+from tempfile import NamedTemporaryFile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import get_context, get_all_start_methods
+from threading import current_thread, Lock
+from time import perf_counter
+from typing import BinaryIO, Iterable, Optional
 
 from PIL import Image
-from codetiming import Timer
-from filelock import FileLock
+from filelock import Timeout
 
-from mezcal.config import TIMER_LOG_FORMAT
+from mezcal.convert import convert_to_jpeg_mode
+from mezcal.resize import load_reduced, downscale
+from mezcal.stream import can_stream, stream_to_jpeg_mode
+from mezcal import trace
+from mezcal.locks import LockManager, DirectoryLockManager
+from mezcal.pyramid import write_pyramid, PYRAMID_MODES
+from mezcal.metrics import (
+    Timer, IMAGE_CREATE_SECONDS, IMAGE_DECODE_SECONDS, IMAGE_CONVERT_SECONDS, IMAGE_ENCODE_SECONDS, LOCK_WAIT_SECONDS,
+    LOCK_TIMEOUTS,
+)
 
 logger = logging.getLogger(__name__)
 MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 0))
@@ -20,6 +41,99 @@ class DirectoryLayout(Enum):
     BASIC = 1
     MD5_ENCODED = 2
     MD5_ENCODED_PAIRTREE = 3
+    # MD5_ENCODED_PAIRTREE directories, whose files are hard links to a
+    # single copy per distinct source image (see ContentStore)
+    CONTENT_ADDRESSED = 4
+
+
+# directory in the storage directory for the files of a ContentStore
+OBJECTS_DIRNAME = '.objects'
+
+
+class ImageFormat(Enum):
+    """Formats that mezzanine files can be written in. Each format is stored
+    under its own file name, in the same per-resource directory."""
+    # flat baseline JPEG
+    JPEG = ('image.jpg', 'image/jpeg')
+    # tiled pyramidal TIFF with JPEG compression (see mezcal.pyramid)
+    TIFF = ('image.tif', 'image/tiff')
+
+    def __init__(self, filename: str, mimetype: str):
+        self.filename = filename
+        self.mimetype = mimetype
+
+    def get_filename(self, size: Optional[int] = None) -> str:
+        """Return the file name for this format, or for a size variant of it (such as "image-1024.jpg")."""
+        if size is None:
+            return self.filename
+        stem, suffix = self.filename.split('.', 1)
+        return f'{stem}-{size}.{suffix}'
+
+    @property
+    def variant_pattern(self) -> str:
+        """Glob pattern matching the file names of every size variant of this format."""
+        return self.get_filename('*')
+
+    @classmethod
+    def for_path(cls, path: Path) -> 'ImageFormat':
+        filename, _ = split_variant_name(path.name)
+        for image_format in cls:
+            if filename == image_format.filename:
+                return image_format
+        # files with other names are written as JPEGs, as they always have been
+        return cls.JPEG
+
+
+VARIANT_NAME = re.compile(r'^(?P<stem>[^.]+)-(?P<size>\d+)(?P<suffix>\..+)$')
+
+
+def split_variant_name(name: str) -> tuple[str, Optional[int]]:
+    """Return the file name of the full-size file and the size of a size variant
+    file name (for example, "image.jpg" and 1024 for "image-1024.jpg"), or the
+    name and None if it is not a size variant."""
+    match = VARIANT_NAME.match(name)
+    if match is None:
+        return name, None
+    return match['stem'] + match['suffix'], int(match['size'])
+
+
+@dataclass(frozen=True)
+class EncodingOptions:
+    """How mezzanine files are encoded. The max_size is the maximum width or
+    height of a mezzanine file; larger source images are scaled down to fit,
+    and 0 means no limit. The JPEG settings are passed to Pillow's JPEG
+    encoder; quality is also used for the tiles of pyramidal TIFFs, which
+    always use 4:2:0 subsampling, and are never progressive.
+
+    Higher quality, less chroma subsampling ("4:4:4" instead of "4:2:0"),
+    and optimize make files larger, or slower to encode, or both; see
+    benchmarks/encode.py to compare the settings on your own images.
+
+    Uncompressed TIFF sources that take up more than working_set bytes when
+    decoded are decoded and converted a band of about that size at a time
+    (see mezcal.stream); 0 means they are always decoded all at once."""
+    max_size: int = 0
+    quality: int = 75
+    subsampling: str = '4:2:0'
+    progressive: bool = False
+    optimize: bool = False
+    working_set: int = 64 * 1024 * 1024
+
+    def jpeg_save_args(self, mode: str) -> dict:
+        args = {'quality': self.quality, 'progressive': self.progressive, 'optimize': self.optimize}
+        if mode == 'RGB':
+            # only color images can be subsampled
+            args['subsampling'] = self.subsampling
+        return args
+
+
+def get_image_format(name: 'ImageFormat | str') -> ImageFormat:
+    if isinstance(name, ImageFormat):
+        return name
+    try:
+        return ImageFormat[name.strip().upper()]
+    except KeyError as e:
+        raise RuntimeError(f'{e} is not a recognized image format')
 
 
 # set a different max pixel size than the default
@@ -34,8 +148,35 @@ elif MAX_IMAGE_PIXELS < 0:
 
 
 class LocalStorage:
-    def __init__(self, storage_dir: Path | str = '', layout: DirectoryLayout | str = DirectoryLayout.BASIC):
+    def __init__(
+            self,
+            storage_dir: Path | str = '',
+            layout: DirectoryLayout | str = DirectoryLayout.BASIC,
+            encoder: Optional['ProcessEncoder'] = None,
+            lock_manager: Optional[LockManager] = None,
+            formats: Iterable[ImageFormat | str] = (ImageFormat.JPEG,),
+            options: Optional[EncodingOptions] = None,
+            sizes: Iterable[int] = (),
+            shared: Optional['SharedStorage'] = None,
+    ):
         self.storage_dir = Path.cwd() / storage_dir
+        # so that serving a file doesn't read its metadata file on every request
+        self.etags = ETagCache()
+        # if given, files are downloaded from it on a miss, and uploaded to it when created
+        self.shared = shared
+        # if given, mezzanine files are created in the encoder's worker processes
+        self.encoder = encoder
+        self.lock_manager = lock_manager or DirectoryLockManager()
+        # the formats that can be requested; the first one is the default
+        self.formats = tuple(get_image_format(name) for name in formats)
+        if not self.formats:
+            raise RuntimeError('At least one image format is required')
+        self.options = options or EncodingOptions()
+        # the smaller sizes (maximum width or height) that can be requested,
+        # each of which is stored as a separate file
+        self.sizes = frozenset(int(size) for size in sizes)
+        if any(size <= 0 for size in self.sizes):
+            raise RuntimeError('Image sizes must be positive')
         if isinstance(layout, str):
             try:
                 self.layout = DirectoryLayout[layout.upper()]
@@ -43,6 +184,10 @@ class LocalStorage:
                 raise RuntimeError(f'{e} is not a recognized storage layout')
         else:
             self.layout = layout
+        if self.layout == DirectoryLayout.CONTENT_ADDRESSED:
+            self.store = ContentStore(self.storage_dir / OBJECTS_DIRNAME)
+        else:
+            self.store = None
 
     def get_dir(self, repo_path: Path | str) -> Path:
         match self.layout:
@@ -53,92 +198,397 @@ class LocalStorage:
                 # directories named by md5-encoding the repository path
                 encoded_path = md5(str(repo_path).encode()).hexdigest()
                 return self.storage_dir / encoded_path
-            case DirectoryLayout.MD5_ENCODED_PAIRTREE:
+            case DirectoryLayout.MD5_ENCODED_PAIRTREE | DirectoryLayout.CONTENT_ADDRESSED:
                 # directories named by md5-encoding the repository path, with pairtree elements
                 encoded_path = md5(str(repo_path).encode()).hexdigest()
                 pairtree = [str(encoded_path)[n:n + 2] for n in range(0, 6, 2)]
                 return self.storage_dir / os.path.join(*pairtree) / encoded_path
 
-    def get_file(self, repo_path: str) -> 'MezzanineFile':
-        return MezzanineFile(self.get_dir(repo_path) / 'image.jpg')
+    def get_format(self, name: Optional[str] = None) -> ImageFormat:
+        """Return the enabled format with this name, or the default format if
+        name is not given. Raises a RuntimeError if the format is not enabled."""
+        if name is None:
+            return self.formats[0]
+        image_format = get_image_format(name)
+        if image_format not in self.formats:
+            raise RuntimeError(f'{image_format.name} is not an enabled image format')
+        return image_format
+
+    def get_size(self, value: Optional[str] = None) -> Optional[int]:
+        """Return the enabled size variant given by value, or None (for the
+        full-size file) if value is not given. Raises a RuntimeError if the
+        size is not enabled."""
+        if value is None:
+            return None
+        try:
+            size = int(value)
+        except ValueError:
+            raise RuntimeError(f'"{value}" is not a valid image size')
+        if size not in self.sizes:
+            raise RuntimeError(f'{size} is not an enabled image size')
+        return size
+
+    def get_file(
+            self,
+            repo_path: str,
+            image_format: Optional[ImageFormat] = None,
+            size: Optional[int] = None,
+    ) -> 'MezzanineFile':
+        """Return the mezzanine file for repo_path in image_format, or in the
+        default format, and in the size variant size, if it is given."""
+        return self.get_file_at(self.get_dir(repo_path) / (image_format or self.formats[0]).get_filename(size))
+
+    def get_files(self, repo_path: str) -> list['MezzanineFile']:
+        """Return the mezzanine files for repo_path in every format and every
+        existing size variant, including formats and sizes that are no longer
+        enabled, for removing all of them."""
+        directory = self.get_dir(repo_path)
+        paths = [directory / image_format.filename for image_format in ImageFormat]
+        for image_format in ImageFormat:
+            paths.extend(sorted(directory.glob(image_format.variant_pattern)))
+        return [self.get_file_at(path) for path in paths]
+
+    def get_file_at(self, path: Path) -> 'MezzanineFile':
+        """Return the MezzanineFile at a path in this storage, such as one found by scanning the storage directory."""
+        return MezzanineFile(
+            path,
+            encoder=self.encoder,
+            lock_manager=self.lock_manager,
+            options=self.options,
+            store=self.store,
+            shared=self.shared,
+            etags=self.etags,
+        )
 
 
-SUPPORTED_JPEG_MODES = ('L', 'RGB', 'CMYK')
+@dataclass
+class FileInfo:
+    """Validators for a mezzanine file, for HTTP conditional requests."""
+    etag: str
+    size: int
+    last_modified: datetime
+
+
+class ETagCache:
+    """Least recently used cache of the ETags of up to max_entries files.
+
+    Each ETag is stored with the inode, modification time, and size of the
+    file it was read for, and is only used while stat() of the file still
+    returns the same ones, so a file that is replaced (always with a new
+    inode) or removed is never sent with an old ETag, even when another
+    process replaced it."""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._entries: OrderedDict[str, tuple[tuple[int, int, int], str]] = OrderedDict()
+
+    @staticmethod
+    def _get_key(stat: os.stat_result) -> tuple[int, int, int]:
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def get(self, path: Path, stat: os.stat_result) -> Optional[str]:
+        """Return the ETag of the file at path, or None if it is not cached
+        for the file that stat is for."""
+        with self._lock:
+            entry = self._entries.get(str(path))
+            if entry is None or entry[0] != self._get_key(stat):
+                return None
+            self._entries.move_to_end(str(path))
+            return entry[1]
+
+    def add(self, path: Path, stat: os.stat_result, etag: str):
+        with self._lock:
+            self._entries[str(path)] = (self._get_key(stat), etag)
+            self._entries.move_to_end(str(path))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+@dataclass
+class ImageTimings:
+    """Seconds spent in each stage of creating a mezzanine file from a source
+    image with the given mode."""
+    mode: str
+    decode: float
+    convert: float
+    encode: float
+
+    def record(self):
+        """Record the timings in the metrics, and in the current request's trace."""
+        IMAGE_DECODE_SECONDS.labels(self.mode).observe(self.decode)
+        IMAGE_CONVERT_SECONDS.labels(self.mode).observe(self.convert)
+        IMAGE_ENCODE_SECONDS.labels(self.mode).observe(self.encode)
+        trace.record('decode', self.decode)
+        trace.record('convert', self.convert)
+        trace.record('encode', self.encode)
+
 
 class MezzanineFile:
-    def __init__(self, path: Path = None):
+    def __init__(
+            self,
+            path: Path = None,
+            encoder: Optional['ProcessEncoder'] = None,
+            lock_manager: Optional[LockManager] = None,
+            options: Optional[EncodingOptions] = None,
+            store: Optional['ContentStore'] = None,
+            shared: Optional['SharedStorage'] = None,
+            etags: Optional[ETagCache] = None,
+    ):
         self.path = path
-        self.lock_path = Path(f'{self.path.parent}.lock')
+        self.etags = etags
+        self.encoder = encoder
+        self.lock_manager = lock_manager or DirectoryLockManager()
+        self.options = options or EncodingOptions()
+        # if given, this file is a link to the store's copy for its source image
+        self.store = store
+        # if given, this file is a copy of the shared storage's copy
+        self.shared = shared
 
     def __str__(self):
         return str(self.path)
 
+    @property
+    def format(self) -> ImageFormat:
+        return ImageFormat.for_path(self.path)
+
+    @property
+    def size(self) -> Optional[int]:
+        """The size of this file's size variant, or None if it is a full-size file."""
+        return split_variant_name(self.path.name)[1]
+
+    @property
+    def max_size(self) -> int:
+        """The maximum width or height of this file, or 0 for no limit."""
+        return min((size for size in (self.size, self.options.max_size) if size), default=0)
+
     @property
     def exists(self) -> bool:
         return self.path.exists()
 
+    @property
+    def metadata_path(self) -> Path:
+        """Sidecar JSON file with information recorded when the file was published."""
+        return self.path.with_name(f'{self.path.name}.json')
+
+    def read_metadata(self) -> dict:
+        try:
+            return json.loads(self.metadata_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_metadata(self, metadata: dict):
+        """Atomically replace the sidecar metadata file."""
+        fh = NamedTemporaryFile(
+            mode='w', dir=self.path.parent, prefix=f'.{self.metadata_path.name}.', suffix='.tmp', delete=False
+        )
+        try:
+            with fh:
+                json.dump(metadata, fh)
+            os.replace(fh.name, self.metadata_path)
+        except BaseException:
+            Path(fh.name).unlink(missing_ok=True)
+            raise
+
+    def update_metadata(self, **values):
+        """Add values to the metadata file. The caller must hold the file's lock."""
+        self.write_metadata({**self.read_metadata(), **values})
+
+    def info(self) -> FileInfo:
+        """Return the ETag, size, and modification time of this file, without
+        opening it. Raises FileNotFoundError if the file does not exist.
+
+        The ETag is the digest recorded in the metadata file when the file
+        was published. If the metadata file is missing or doesn't match the
+        file (for example, for a file published by an older version), it
+        falls back to an ETag made from the modification time and size.
+        With an ETagCache, the metadata file is only read until its ETag is
+        cached, and again after the file is replaced."""
+        stat = self.path.stat()
+        etag = self.etags.get(self.path, stat) if self.etags is not None else None
+        if etag is None:
+            metadata = self.read_metadata()
+            if metadata.get('mtime_ns') == stat.st_mtime_ns and metadata.get('size') == stat.st_size:
+                etag = metadata['etag']
+                if self.etags is not None:
+                    self.etags.add(self.path, stat, etag)
+            else:
+                # not cached, since the metadata file may just not be written yet
+                etag = f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+        return FileInfo(
+            etag=etag,
+            size=stat.st_size,
+            last_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+        )
+
+    @property
+    def lock_path(self) -> Path:
+        return self.lock_manager.get_lock_path(self.path)
+
     @property
     def lock(self):
-        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
-        return FileLock(self.lock_path)
+        return self.lock_manager.get_lock(self.path)
+
+    def acquire_lock(self, timeout: float):
+        """Acquire this file's lock, recording the time spent waiting for it.
+        Returns a context manager that releases the lock. Raises a
+        filelock.Timeout if the lock is not acquired within timeout seconds."""
+        lock = self.lock
+        start = perf_counter()
+        try:
+            return lock.acquire(timeout=timeout)
+        except Timeout:
+            LOCK_TIMEOUTS.inc()
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            LOCK_WAIT_SECONDS.observe(elapsed)
+            trace.record('lock', elapsed)
+
+    def create(self, source: BinaryIO | Path | str, digest: Optional[str] = None) -> Optional[ImageTimings]:
+        """Create this file from source, and return the time taken by each stage.
+
+        If this file is in a ContentStore, digest identifies the source image
+        (by default, it is the SHA-256 digest of source). If the store already
+        has a file for that source image, this file is linked to it instead of
+        being encoded, and None is returned.
 
-    def create(self, fh):
+        If this file has a SharedStorage, the new file is uploaded to it."""
+        replace = self.exists
+        old_digest = None
+        if self.store is not None:
+            digest = digest or digest_source(source)
+            old_digest = self.read_metadata().get('digest')
+            if self.link_stored(digest):
+                return None
         with Timer(
-            name=f'create cached image {self.path} in {current_thread().name}',
-            logger=logger.info,
-            text=TIMER_LOG_FORMAT
+            'create cached image %s in %s', self.path, current_thread().name,
+            histogram=IMAGE_CREATE_SECONDS,
+            logger=logger,
         ):
-            try:
-                img = Image.open(fh)
-                self.path.parent.mkdir(parents=True, exist_ok=True)
-
-                if img.mode not in SUPPORTED_JPEG_MODES:
-                    logger.info(f'Source has mode "{img.mode}" that is not supported by JPEG; will attempt to convert')
-                    match img.mode:
-                        case 'RGBA' | 'P':
-                            # convert to RGB if the source image is RGB-Alpha or Palette
-                            logger.debug(f'Converting image from "{img.mode}" to "RGB"')
-                            img = img.convert('RGB')
-                        case 'I;16':
-                            # 16-bit TIFF needs special handling
-                            # the point function given scales the 16-bit pixel
-                            # values down to 8-bit (which is the max that JPEG
-                            # supports) by dividing by 256 (i.e., 2^8)
-                            # then the image can be safely rendered as grayscale
-                            # (mode "L") JPEG. Without the division by 256,
-                            # all the pixel values will likely be over 256,
-                            # resulting in an all-white image
-                            # see also: https://stackoverflow.com/a/43980135
-                            logger.debug(f'Converting image from "{img.mode}" to "L"')
-                            img = img.point(lambda i: i / 256).convert('L')
-                        case 'I;16B':
-                            # 16-bit big endian also needs special handling
-                            # in this case we are actually getting the raw bytestream
-                            # of the pixel data, unpacking it from big-endian 2-byte
-                            # integers, scaling it down from 2-byte to 1-byte pixels,
-                            # and creating a new Image object from that data
-                            # see also: https://stackoverflow.com/a/26553424
-                            logger.debug(f'Converting image from "{img.mode}" to "L"')
-                            img = convert_I16B_to_L(img)
-                        case _:
-                            raise RuntimeError(
-                                f'Cannot convert from image mode "{img.mode}" to one of: {SUPPORTED_JPEG_MODES}'
-                            )
-
-                img.save(self.path)
-            except Exception as e:
-                logger.error(str(e))
-                raise RuntimeError('Unable to create mezzanine copy')
+            if self.encoder is not None:
+                timings = self.encoder.run(self.path, source, self.options)
+            else:
+                timings = self.encode(source)
+        timings.record()
+        if self.store is not None:
+            self.update_metadata(digest=digest)
+            self.store.add(self, digest)
+            if old_digest not in (None, digest):
+                self.store.release(old_digest, self.path.name)
+        if self.shared is not None:
+            self.shared.publish(self, replace=replace)
+        return timings
+
+    def link_stored(self, digest: Optional[str]) -> bool:
+        """If this file is in a ContentStore that already has a file for the
+        source image with digest, replace this file with a link to it, and
+        return True. Otherwise, return False. The caller must hold the file's
+        lock."""
+        if self.store is None or digest is None:
+            return False
+        replace = self.exists
+        old_digest = self.read_metadata().get('digest')
+        metadata = self.store.link(self, digest)
+        if metadata is None:
+            return False
+        self.write_metadata({**metadata, 'digest': digest})
+        sync_dir(self.path.parent)
+        if old_digest not in (None, digest):
+            self.store.release(old_digest, self.path.name)
+        logger.debug(f'Linked {self.path} to the stored copy of {digest}')
+        if self.shared is not None:
+            self.shared.publish(self, replace=replace)
+        return True
+
+    def fetch_shared(self) -> bool:
+        """Download this file from its SharedStorage, if it has one and another
+        node has already created the file. Returns True if the file was
+        downloaded. The caller must hold the file's lock."""
+        return self.shared is not None and self.shared.fetch(self)
+
+    def encode(self, source: BinaryIO | Path | str) -> ImageTimings:
+        """Decode source, convert it to a JPEG mode and scale it down to this
+        file's max_size, and publish it as this file, and return the time taken
+        by each stage."""
+        try:
+            start = perf_counter()
+            img = Image.open(source)
+            mode = img.mode
+            if can_stream(img, self.options.working_set):
+                # each band is converted as it is decoded, so the decode time includes the conversion
+                img = stream_to_jpeg_mode(source, img, self.max_size, self.options.working_set)
+            else:
+                img = load_reduced(img, self.max_size)
+            decoded = perf_counter()
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+            img = downscale(convert_to_jpeg_mode(img), self.max_size)
+            converted = perf_counter()
+            self.publish(img)
+        except Exception as e:
+            logger.error(str(e))
+            raise RuntimeError('Unable to create mezzanine copy')
+        return ImageTimings(
+            mode=mode,
+            decode=decoded - start,
+            convert=converted - decoded,
+            encode=perf_counter() - converted,
+        )
+
+    def publish(self, img: Image.Image):
+        """Atomically write img to this file's path in this file's format.
+
+        The image is written and synced to a temporary file in the same
+        directory, then renamed into place, so readers never see a partially
+        written file, and a crash while encoding leaves no file at the path.
+
+        The ETag for the file is computed here, once, and recorded with the
+        file's size and modification time in the metadata file."""
+        fh = NamedTemporaryFile(dir=self.path.parent, prefix=f'.{self.path.name}.', suffix='.tmp', delete=False)
+        try:
+            with fh:
+                if self.format == ImageFormat.TIFF:
+                    if img.mode not in PYRAMID_MODES:
+                        # such as CMYK, which is written as is to flat JPEG files
+                        img = img.convert('RGB')
+                    write_pyramid(img, fh, quality=self.options.quality)
+                else:
+                    img.save(fh, format='JPEG', **self.options.jpeg_save_args(img.mode))
+                fh.flush()
+                os.fsync(fh.fileno())
+                # the file was just written, so this reads it from the page cache
+                fh.seek(0)
+                digest = file_digest(fh, 'md5').hexdigest()
+                stat = os.fstat(fh.fileno())
+            os.replace(fh.name, self.path)
+        except BaseException:
+            Path(fh.name).unlink(missing_ok=True)
+            raise
+        self.write_metadata({'etag': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+        sync_dir(self.path.parent)
+
+    @property
+    def temp_files(self) -> list[Path]:
+        """Temporary files left behind by an interrupted publish."""
+        return list(self.path.parent.glob(f'.{self.path.name}.*.tmp'))
 
     def delete(self):
-        with Timer(
-            name=f'delete cached image {self.path} in {current_thread().name}',
-            logger=logger.info,
-            text=TIMER_LOG_FORMAT
-        ):
+        with Timer('delete cached image %s in %s', self.path, current_thread().name, logger=logger):
             try:
+                digest = self.read_metadata().get('digest') if self.store is not None else None
                 self.path.unlink(missing_ok=True)
-                self.path.parent.rmdir()
+                if digest is not None:
+                    self.store.release(digest, self.path.name)
+                self.metadata_path.unlink(missing_ok=True)
+                for temp_file in self.temp_files:
+                    temp_file.unlink(missing_ok=True)
+                try:
+                    self.path.parent.rmdir()
+                except OSError as e:
+                    # keep the directory if there are still files in other formats
+                    if e.errno != errno.ENOTEMPTY:
+                        raise
             except FileNotFoundError:
                 # we can ignore file not found errors, since the whole point
                 # of this method is to remove the file and the directory!
@@ -148,14 +598,193 @@ class MezzanineFile:
                 raise RuntimeError('Unable to remove resource')
 
 
-def convert_I16B_to_L(img: Image) -> Image:
-    # format pattern is: big endian marker (">"), followed by
-    # the total number pixels (image width * height), followed
-    # by the datatype marked for "unsigned short", i.e., 2 bytes
-    byte_format = f'>{img.width * img.height}H'
-    # unpack the 16-bit big-endian representation of the image pixels
-    pixels = unpack(byte_format, img.tobytes())
-    # divide by 256 to scale it down to 8-bit
-    scaled_pixels = bytes((int(pixel / 256) for pixel in pixels))
-    # return a new grayscale (mode "L") image with the converted data
-    return Image.frombytes('L', (img.width, img.height), scaled_pixels, 'raw')
+def digest_source(source: BinaryIO | Path | str) -> str:
+    """Return the SHA-256 digest of a source image, in the same form as
+    mezcal.http.get_origin_digest()."""
+    if isinstance(source, (Path, str)):
+        with open(source, 'rb') as fh:
+            digest = file_digest(fh, 'sha256')
+    else:
+        digest = file_digest(source, 'sha256')
+        source.seek(0)
+    return f'sha-256-{digest.hexdigest()}'
+
+
+class ContentStore:
+    """Single copies of mezzanine files, named by a digest of their source
+    image, for the CONTENT_ADDRESSED layout.
+
+    Many repository paths can have the same image, such as the same file in
+    several collections, or several versions of a resource whose image did
+    not change. Each distinct source image's files are stored once in
+    objects_dir, and the file for each repository path is a hard link to
+    the stored file, so everything else reads and sends the per-path files
+    as usual. Each per-path file records the digest it is linked to in its
+    metadata.
+
+    A stored file's link count is its reference count: objects_dir holds one
+    link, and each repository path another. When a per-path file is deleted
+    or replaced, the stored file is removed if that was its last link.
+
+    The store has no locks of its own. Races between paths that share a
+    stored file can only cost deduplication (a path keeps its own copy, or a
+    stored file is removed while a path is still linked to it), never the
+    contents of a per-path file."""
+
+    def __init__(self, objects_dir: Path):
+        self.objects_dir = objects_dir
+        self._lock = Lock()
+        self.counts = {'linked': 0, 'added': 0, 'released': 0}
+
+    @property
+    def stats(self) -> dict:
+        return dict(self.counts)
+
+    def get_file(self, digest: str, name: str) -> MezzanineFile:
+        """Return the stored file with name (such as "image.jpg") for the source image with digest."""
+        encoded = digest.rsplit('-', 1)[-1]
+        pairtree = [encoded[n:n + 2] for n in range(0, 4, 2)]
+        return MezzanineFile(self.objects_dir / os.path.join(*pairtree) / digest / name)
+
+    def link(self, file: MezzanineFile, digest: str) -> Optional[dict]:
+        """Replace file with a link to the stored file for digest, and return the
+        stored file's metadata, or return None if there is no stored file."""
+        stored = self.get_file(digest, file.path.name)
+        metadata = stored.read_metadata()
+        file.path.parent.mkdir(parents=True, exist_ok=True)
+        # named like the temporary files of publish(), so delete() cleans it up if it is left behind
+        temp_path = file.path.with_name(f'.{file.path.name}.{token_hex(4)}.tmp')
+        try:
+            os.link(stored.path, temp_path)
+        except FileNotFoundError:
+            return None
+        try:
+            os.replace(temp_path, file.path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        self._count('linked')
+        return {key: metadata[key] for key in ('etag', 'size', 'mtime_ns') if key in metadata}
+
+    def add(self, file: MezzanineFile, digest: str):
+        """Store a newly created file as the stored file for digest, unless there already is one."""
+        stored = self.get_file(digest, file.path.name)
+        stored.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(file.path, stored.path)
+        except (FileExistsError, FileNotFoundError):
+            # stored by another path in the meantime, or its directory was
+            # just removed; this path keeps its own copy
+            return
+        stored.write_metadata({key: value for key, value in file.read_metadata().items() if key != 'digest'})
+        self._count('added')
+
+    def release(self, digest: str, name: str):
+        """Remove the stored file with name for digest if no repository path links to it anymore."""
+        stored = self.get_file(digest, name)
+        try:
+            if stored.path.stat().st_nlink > 1:
+                return
+        except FileNotFoundError:
+            return
+        stored.delete()
+        self._count('released')
+
+    def _count(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+
+
+def sync_dir(path: Path):
+    """Flush a directory's entries (such as a newly renamed file) to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def create_mezzanine_file(
+        path: Path | str,
+        source: Path | str | bytes,
+        options: Optional[EncodingOptions] = None,
+) -> ImageTimings:
+    """Create the mezzanine file at path from the image file path or image
+    data in source, and return the time taken by each stage.
+
+    This takes only picklable arguments, so that it can run in a worker
+    process. The caller is responsible for holding the file's lock, and for
+    recording the timings in the metrics of its own process."""
+    return MezzanineFile(Path(path), options=options).encode(
+        BytesIO(source) if isinstance(source, bytes) else Path(source)
+    )
+
+
+class ProcessEncoder:
+    """Pool of worker processes that decode, convert, and encode images, so
+    that this CPU-bound work is not limited by the GIL of the server process.
+
+    If a worker process dies (for example, killed for using too much memory,
+    or crashing in a native decoder), every job running in the pool fails
+    with BrokenProcessPool. When that happens, the pool is replaced, and each
+    of the failed jobs is retried once in a separate, single-use process.
+    This way only the job that actually crashes a worker fails."""
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers or os.cpu_count()
+        self.jobs = 0
+        self.crashes = 0
+        self._lock = Lock()
+        self._executor = self._new_executor(self.max_workers)
+
+    @staticmethod
+    def _new_executor(max_workers: int) -> ProcessPoolExecutor:
+        # forking a multithreaded server process can copy locks held by
+        # other threads into the child, so start workers from a clean process
+        method = 'forkserver' if 'forkserver' in get_all_start_methods() else 'spawn'
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context(method))
+
+    @property
+    def stats(self) -> dict:
+        return {'processes': self.max_workers, 'jobs': self.jobs, 'crashes': self.crashes}
+
+    def run(
+            self,
+            path: Path,
+            source: BinaryIO | Path | str,
+            options: Optional[EncodingOptions] = None,
+    ) -> ImageTimings:
+        """Create the mezzanine file at path from source in a worker process, and
+        return the time the worker took for each stage. Raises a RuntimeError if
+        the file could not be created, or if the worker process crashed."""
+        if not isinstance(source, (Path, str)):
+            # file-like objects can't be sent to another process
+            source = source.read()
+        with self._lock:
+            executor = self._executor
+            self.jobs += 1
+        try:
+            return executor.submit(create_mezzanine_file, path, source, options).result()
+        except BrokenProcessPool:
+            self._replace(executor)
+
+        logger.warning(f'Encoder process crashed while creating {path}; retrying in a separate process')
+        with self._new_executor(1) as retry_executor:
+            try:
+                return retry_executor.submit(create_mezzanine_file, path, source, options).result()
+            except BrokenProcessPool:
+                with self._lock:
+                    self.crashes += 1
+                logger.error(f'Encoder process crashed while creating {path}')
+                raise RuntimeError('Unable to create mezzanine copy')
+
+    def _replace(self, broken_executor: ProcessPoolExecutor):
+        with self._lock:
+            # only the first thread to notice replaces the pool
+            if self._executor is broken_executor:
+                logger.warning('Encoder process pool is broken; starting a new one')
+                self._executor = self._new_executor(self.max_workers)
+        broken_executor.shutdown(wait=False)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
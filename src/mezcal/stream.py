@@ -0,0 +1,133 @@
+"""Band-by-band decoding and conversion of large uncompressed TIFFs.
+
+Normally, creating a mezzanine file holds the whole decoded source image
+in memory, and then a converted copy of it. For a gigapixel master, that
+is several gigabytes. Instead, stream_to_jpeg_mode() decodes the source a
+band of rows at a time, converts each band to a JPEG mode, reduces it (if
+the mezzanine file has a maximum size), and pastes it into the output
+image, so that only one band of the source is in memory at a time.
+
+Pillow decodes uncompressed TIFFs as a list of "raw" strips or tiles, each
+of which is a run of rows at a known offset in the file, so a band of any
+height can be decoded by itself. Compressed TIFFs are decoded by libtiff
+as a single unit, so they can't be streamed this way.
+
+Pillow applies a TIFF's Orientation tag when it loads the image, which
+would rotate each band separately, so the bands are loaded as stored, and
+the assembled image is rotated or flipped once at the end."""
+import logging
+from typing import BinaryIO
+
+from PIL import Image
+
+from mezcal.convert import convert_to_jpeg_mode, SUPPORTED_JPEG_MODES
+from mezcal.pyramid import BITS_PER_SAMPLE, SAMPLES_PER_PIXEL, PLANAR_CONFIGURATION, ORIENTATION
+from mezcal.resize import reduce_factor
+
+logger = logging.getLogger(__name__)
+
+# how to turn an image stored with each Orientation tag value upright
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# modes whose conversion to a JPEG mode is done pixel by pixel; the
+# conversions of "I" and "F" images depend on the range of values in the
+# whole image, so they would come out differently for each band
+STREAMABLE_MODES = frozenset(SUPPORTED_JPEG_MODES) | {
+    'I;16', 'I;16L', 'I;16B', 'I;16N', '1', 'LA', 'La', 'P', 'PA', 'RGBA', 'RGBa', 'RGBX', 'LAB', 'HSV', 'YCbCr',
+}
+
+
+def decoded_size(img: Image.Image) -> int:
+    """Approximate number of bytes that the decoded img takes up in memory."""
+    return img.width * img.height * len(Image.new(img.mode, (1, 1)).tobytes())
+
+
+def can_stream(img: Image.Image, working_set: int) -> bool:
+    """Return True if the opened, but not yet loaded, img can be streamed, and
+    is larger than working_set bytes when decoded."""
+    return (
+        working_set > 0 and
+        img.format == 'TIFF' and
+        img.mode in STREAMABLE_MODES and
+        not getattr(img, 'use_load_libtiff', False) and
+        img.tag_v2.get(PLANAR_CONFIGURATION, 1) == 1 and
+        len(img.tile) > 0 and
+        all(tile[0] == 'raw' for tile in img.tile) and
+        decoded_size(img) > working_set
+    )
+
+
+def row_bytes(img: Image.Image, width: int) -> int:
+    """Number of bytes in a row of a strip or tile of img that is width pixels wide."""
+    bits = img.tag_v2.get(BITS_PER_SAMPLE, (1,))
+    if len(bits) == 1:
+        bits = bits * img.tag_v2.get(SAMPLES_PER_PIXEL, 1)
+    return (sum(bits) * width + 7) // 8
+
+
+def band_tiles(img: Image.Image, tiles: list, top: int, bottom: int) -> list:
+    """Return the parts of the raw tiles of img that are in the rows from top
+    to bottom, positioned relative to the top of the band."""
+    band = []
+    for decoder, (x0, y0, x1, y1), offset, args in tiles:
+        start, end = max(y0, top), min(y1, bottom)
+        if start >= end:
+            continue
+        # a stride of 0 means the rows are packed, as wide as the tile
+        stride = args[1] or row_bytes(img, x1 - x0)
+        band.append((decoder, (x0, start - top, x1, end - top), offset + (start - y0) * stride, args))
+    return band
+
+
+def read_band(source: BinaryIO | str, img: Image.Image, tiles: list, top: int, bottom: int) -> Image.Image:
+    """Decode the rows from top to bottom of the image in source."""
+    band = Image.open(source)
+    band.tile = band_tiles(img, tiles, top, bottom)
+    # the whole image is transposed once, after all the bands are decoded
+    band._tile_orientation = None
+    # Pillow decodes the tiles into an image of this size
+    band._size = (img.width, bottom - top)
+    band.load()
+    return band
+
+
+def stream_to_jpeg_mode(
+        source: BinaryIO | str,
+        img: Image.Image,
+        max_size: int = 0,
+        working_set: int = 0,
+) -> Image.Image:
+    """Decode the opened, but not yet loaded, img from source, a band of about
+    working_set bytes at a time, and return it converted to a JPEG mode. If
+    max_size is positive, each band is also reduced, so that the returned
+    image is at most a few times larger than max_size; see downscale() for
+    scaling it down to max_size. The returned image is transposed according
+    to the TIFF's Orientation tag, if it has one.
+
+    Only images for which can_stream() is True can be streamed."""
+    tiles = list(img.tile)
+    factor = reduce_factor(img.size, max_size)
+    # bands must be a multiple of the reduce factor tall, so that no block of pixels spans two bands
+    rows = max(working_set // (decoded_size(img) // img.height), 1) // factor * factor or factor
+    logger.debug(f'Streaming {img.width}x{img.height} image in bands of {rows} rows')
+
+    output = None
+    for top in range(0, img.height, rows):
+        band = convert_to_jpeg_mode(read_band(source, img, tiles, top, min(top + rows, img.height)))
+        if factor > 1:
+            band = band.reduce(factor)
+        if output is None:
+            output = Image.new(band.mode, (-(-img.width // factor), -(-img.height // factor)))
+        output.paste(band, (0, top // factor))
+    method = ORIENTATION_TRANSPOSE.get(img.tag_v2.get(ORIENTATION, 1))
+    if method is not None:
+        output = output.transpose(method)
+    return output
@@ -0,0 +1,78 @@
+"""Per-request timing of the stages of handling an image request.
+
+The trace for the current request is kept in a context variable, so that
+code anywhere in the request (such as MezzanineFile.create) can add to it
+without it being passed along explicitly. Stages that are run in another
+thread are only recorded if the thread runs in a copy of the request's
+context (as asyncio.to_thread() does)."""
+import json
+import random
+from contextvars import ContextVar
+from pathlib import Path
+from threading import Lock
+from time import perf_counter, time
+from typing import Optional
+from uuid import uuid4
+
+current_trace: ContextVar[Optional['Trace']] = ContextVar('current_trace', default=None)
+
+
+class Trace:
+    def __init__(self, repo_path: str, trace_id: Optional[str] = None):
+        self.id = trace_id or uuid4().hex
+        self.repo_path = repo_path
+        self.timestamp = time()
+        self.start = perf_counter()
+        # seconds spent in each stage, in the order they were first recorded
+        self.stages: dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @property
+    def elapsed(self) -> float:
+        return perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        """Value for a Server-Timing header, with durations in milliseconds."""
+        metrics = [f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in self.stages.items()]
+        metrics.append(f'total;dur={self.elapsed * 1000:.1f}')
+        return ', '.join(metrics)
+
+    def to_dict(self, status: int) -> dict:
+        return {
+            'id': self.id,
+            'timestamp': self.timestamp,
+            'path': self.repo_path,
+            'status': status,
+            'stages_ms': {stage: round(seconds * 1000, 3) for stage, seconds in self.stages.items()},
+            'total_ms': round(self.elapsed * 1000, 3),
+        }
+
+
+def record(stage: str, seconds: float):
+    """Add to the time of stage in the current request's trace, if there is one."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+class TraceLog:
+    """Writes a sample of request traces to a file, as one JSON object per line."""
+
+    def __init__(self, path: Path | str, sample_rate: float = 0.01):
+        self.path = Path(path)
+        self.sample_rate = sample_rate
+        self._lock = Lock()
+        self._file = open(self.path, 'a', buffering=1)
+
+    def write(self, trace: Trace, status: int):
+        if random.random() >= self.sample_rate:
+            return
+        line = json.dumps(trace.to_dict(status)) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
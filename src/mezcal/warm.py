@@ -0,0 +1,237 @@
+"""Pre-generate mezzanine files for a list of repository paths or URLs.
+
+Paths are read one per line from a file, or from standard input. Blank
+lines and lines starting with "#" are ignored. Full URLs must start with
+the REPO_BASE_URL. Configuration is taken from the same environment
+variables as the mezcal server.
+"""
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from enum import Enum
+from threading import Lock
+from time import perf_counter
+from typing import Iterable, Iterator, Optional, TextIO
+
+from filelock import Timeout
+
+from mezcal.http import OriginRepository, NotAnImageError, get_origin_digest
+from mezcal.index import CacheIndex
+from mezcal.revalidate import record_origin_metadata
+from mezcal.server import get_local_storage, get_origin_repository, get_cache_index
+from mezcal.storage import LocalStorage, ProcessEncoder
+from mezcal.web import get_authenticator, get_auth_type, LOCK_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class WarmResult(Enum):
+    CREATED = 1
+    SKIPPED = 2
+    FAILED = 3
+
+
+@dataclass
+class StageStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+@dataclass
+class WarmStats:
+    results: dict[WarmResult, int] = field(default_factory=lambda: {result: 0 for result in WarmResult})
+    stages: dict[str, StageStats] = field(
+        default_factory=lambda: {stage: StageStats() for stage in ('lock', 'fetch', 'encode')}
+    )
+    origin_bytes: int = 0
+    elapsed: float = 0.0
+    _lock: Lock = field(default_factory=Lock, repr=False)
+
+    def record(self, result: WarmResult, timings: Optional[dict[str, float]] = None, origin_bytes: int = 0):
+        with self._lock:
+            self.results[result] += 1
+            self.origin_bytes += origin_bytes
+            for stage, seconds in (timings or {}).items():
+                self.stages[stage].add(seconds)
+
+    @property
+    def total(self) -> int:
+        return sum(self.results.values())
+
+    def report(self) -> str:
+        elapsed = self.elapsed or float('inf')
+        created = self.results[WarmResult.CREATED]
+        lines = [
+            f'Processed {self.total} paths in {self.elapsed:.1f} s: '
+            f'{created} created, {self.results[WarmResult.SKIPPED]} skipped, '
+            f'{self.results[WarmResult.FAILED]} failed',
+            f'Throughput: {created / elapsed:.2f} images/s, '
+            f'{self.origin_bytes / elapsed / 1_000_000:.2f} MB/s from origin',
+            f'{"stage":<8}{"count":>8}{"mean (ms)":>12}{"max (ms)":>12}{"total (s)":>12}',
+        ]
+        for name, stage in self.stages.items():
+            lines.append(
+                f'{name:<8}{stage.count:>8}{stage.mean * 1000:>12.1f}{stage.max * 1000:>12.1f}{stage.total:>12.1f}'
+            )
+        return '\n'.join(lines)
+
+
+def read_paths(lines: Iterable[str], base_url: str) -> Iterator[str]:
+    """Yield the repository paths from lines of repository paths or URLs."""
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith(base_url):
+            yield line[len(base_url):]
+        elif line.startswith(('http://', 'https://')):
+            logger.error(f'URL {line} does not start with {base_url}; skipping')
+        else:
+            yield line.lstrip('/')
+
+
+class Warmer:
+    """Fills the cache for a stream of repository paths.
+
+    Origin requests run in a pool of fetch_workers threads. Each fetched
+    image is spooled and then decoded, converted, and encoded by the local
+    storage's encoder, if it has one. The locking is the same as for a cache
+    miss in the server, so this can run while the server is running."""
+
+    def __init__(
+            self,
+            local_storage: LocalStorage,
+            origin_repo: OriginRepository,
+            auth=None,
+            cache_index: Optional[CacheIndex] = None,
+            fetch_workers: int = 8,
+    ):
+        self.local_storage = local_storage
+        self.origin_repo = origin_repo
+        self.auth = auth
+        self.cache_index = cache_index
+        self.fetch_workers = fetch_workers
+        self.stats = WarmStats()
+
+    def warm(self, repo_path: str) -> WarmResult:
+        timings = {}
+        origin_bytes = 0
+        local_file = self.local_storage.get_file(repo_path)
+        if local_file.exists:
+            self.stats.record(WarmResult.SKIPPED)
+            return WarmResult.SKIPPED
+
+        try:
+            start = perf_counter()
+            with local_file.acquire_lock(LOCK_TIMEOUT):
+                timings['lock'] = perf_counter() - start
+                if local_file.exists:
+                    # created by someone else while we were waiting for the lock
+                    result = WarmResult.SKIPPED
+                elif local_file.fetch_shared():
+                    # created by another node
+                    if self.cache_index is not None:
+                        self.cache_index.add(local_file)
+                    result = WarmResult.CREATED
+                else:
+                    start = perf_counter()
+                    response = self.origin_repo.get(repo_path, auth=self.auth)
+                    digest = get_origin_digest(response.headers)
+                    if local_file.link_stored(digest):
+                        # the same image is already stored for another path
+                        response.close()
+                    else:
+                        with self.origin_repo.spool(repo_path, response) as body:
+                            origin_bytes = body.size
+                            timings['fetch'] = perf_counter() - start
+                            start = perf_counter()
+                            local_file.create(body.source, digest)
+                            timings['encode'] = perf_counter() - start
+                    record_origin_metadata(local_file, response.headers)
+                    if self.cache_index is not None:
+                        self.cache_index.add(local_file)
+                    result = WarmResult.CREATED
+        except Timeout:
+            logger.error(f'Unable to acquire a lock to {local_file} in {LOCK_TIMEOUT}s')
+            result = WarmResult.FAILED
+        except NotAnImageError:
+            logger.error(f'/{repo_path} is not an image')
+            result = WarmResult.FAILED
+        except Exception as e:
+            logger.error(f'Unable to create {local_file} for /{repo_path}: {e}')
+            result = WarmResult.FAILED
+
+        self.stats.record(result, timings, origin_bytes)
+        if result == WarmResult.CREATED:
+            logger.info(f'Created {local_file} for /{repo_path}')
+        return result
+
+    def run(self, repo_paths: Iterable[str]) -> WarmStats:
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix='Fetch') as fetch_executor:
+            # map() would queue every path up front; keep the queue bounded instead
+            pending = set()
+            for repo_path in repo_paths:
+                if len(pending) >= self.fetch_workers * 2:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                pending.add(fetch_executor.submit(self.warm, repo_path))
+        self.stats.elapsed = perf_counter() - start
+        return self.stats
+
+
+def run(args: Optional[list[str]] = None, stdin: TextIO = sys.stdin):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0], epilog='\n'.join(__doc__.splitlines()[2:]))
+    parser.add_argument(
+        'input', nargs='?', default='-', help='file with one repository path or URL per line (default: stdin)'
+    )
+    parser.add_argument(
+        '-f', '--fetch-workers', type=int, default=8, help='number of concurrent origin requests (default: 8)'
+    )
+    parser.add_argument(
+        '-e', '--encode-workers', type=int, default=os.cpu_count(),
+        help='number of encoding processes (default: number of CPUs)'
+    )
+    parser.add_argument('-v', '--verbose', action='store_true', help='enable debug logging')
+    options = parser.parse_args(args)
+    logging.getLogger().setLevel(logging.DEBUG if options.verbose else logging.INFO)
+
+    if not os.environ.get('REPO_BASE_URL'):
+        parser.error('the REPO_BASE_URL environment variable must be set')
+
+    encoder = ProcessEncoder(max_workers=options.encode_workers)
+    local_storage = get_local_storage(encoder=encoder)
+    origin_repo = get_origin_repository(pool_size=options.fetch_workers)
+    auth = get_authenticator(get_auth_type(os.environ.get('AUTH_TYPE', 'NONE')))
+
+    warmer = Warmer(
+        local_storage=local_storage,
+        origin_repo=origin_repo,
+        auth=auth,
+        cache_index=get_cache_index(local_storage),
+        fetch_workers=options.fetch_workers,
+    )
+    try:
+        if options.input == '-':
+            stats = warmer.run(read_paths(stdin, origin_repo.base_url))
+        else:
+            with open(options.input) as fh:
+                stats = warmer.run(read_paths(fh, origin_repo.base_url))
+    finally:
+        encoder.shutdown()
+
+    print(stats.report())
+    if stats.results[WarmResult.FAILED]:
+        sys.exit(1)
@@ -4,21 +4,34 @@ from http import HTTPStatus
 from threading import current_thread
 from typing import Optional
 
-from codetiming import Timer
 from filelock import Timeout
-from flask import Flask, send_file, request, url_for, redirect, abort
+from flask import Flask, Response, send_file, request, url_for, redirect, abort, g
 from requests.auth import HTTPBasicAuth, AuthBase
-from requests_jwtauth import HTTPBearerAuth, JWTSecretAuth
+from requests_jwtauth import HTTPBearerAuth
+from werkzeug.http import is_resource_modified
 
-from mezcal.config import TIMER_LOG_FORMAT
-from mezcal.http import OriginRepository, NotAnImageError, RepositoryAuthType
-from mezcal.storage import LocalStorage
+from mezcal.admission import Limiter, Overloaded, admit
+from mezcal.delivery import ProxyDelivery
+from mezcal.http import OriginRepository, NotAnImageError, RepositoryAuthType, CachedJWTSecretAuth, get_origin_digest
+from mezcal.index import CacheIndex
+from mezcal.memory import MemoryCache
+from mezcal.metrics import (
+    Timer, REGISTRY, CONTENT_TYPE, CACHE_HITS, CACHE_MISSES, NEGATIVE_CACHE_HITS, IN_FLIGHT_MISSES, REQUEST_SECONDS,
+)
+from mezcal.negative import NegativeCache
+from mezcal.revalidate import Revalidator, record_origin_metadata
+from mezcal.singleflight import SingleFlight
+from mezcal.storage import LocalStorage, MezzanineFile, FileInfo
+from mezcal.trace import Trace, TraceLog, current_trace
 
 logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(name)s:%(threadName)s:%(message)s')
 logging.getLogger('PIL').setLevel(logging.INFO)
 logging.getLogger('filelock').setLevel(logging.INFO)
 
 LOCK_TIMEOUT = 30
+DEFAULT_CACHE_CONTROL = 'no-cache'
+# seconds a client is asked to wait when a file is removed right after it was created for it
+REMOVED_RETRY_AFTER = 1
 
 
 def get_authenticator(authentication_type: RepositoryAuthType) -> Optional[AuthBase]:
@@ -36,7 +49,7 @@ def get_authenticator(authentication_type: RepositoryAuthType) -> Optional[AuthB
             case RepositoryAuthType.JWT_TOKEN:
                 return HTTPBearerAuth(os.environ['JWT_TOKEN'])
             case RepositoryAuthType.JWT_SECRET:
-                return JWTSecretAuth(
+                return CachedJWTSecretAuth(
                     secret=os.environ['JWT_SECRET'],
                     claims={
                         'sub': 'mezcal',
@@ -48,8 +61,94 @@ def get_authenticator(authentication_type: RepositoryAuthType) -> Optional[AuthB
         raise RuntimeError(f'Environment variable {e} is not set') from e
 
 
-def create_app(local_storage: LocalStorage, origin_repo: OriginRepository) -> Flask:
+def get_auth_type(name: str) -> RepositoryAuthType:
+    try:
+        return RepositoryAuthType[name.upper()]
+    except KeyError as e:
+        raise RuntimeError(f'{e} is not a recognized authentication type') from e
+
+
+def create_app(
+        local_storage: LocalStorage,
+        origin_repo: OriginRepository,
+        auth_type: Optional[RepositoryAuthType] = None,
+        cache_index: Optional[CacheIndex] = None,
+        cache_control: Optional[str] = None,
+        origin_max_age: Optional[float] = None,
+        trace_log: Optional[TraceLog] = None,
+        negative_cache: Optional[NegativeCache] = None,
+        memory_cache: Optional[MemoryCache] = None,
+        delivery: Optional[ProxyDelivery] = None,
+        fetch_limiter: Optional[Limiter] = None,
+        encode_limiter: Optional[Limiter] = None,
+) -> Flask:
+    """Create the Flask application.
+
+    If auth_type is not given, it is taken from the AUTH_TYPE environment
+    variable. The authenticator for the origin repository is created once
+    here and shared by all requests.
+
+    If a cache_index is given, it is updated whenever a file is sent,
+    created, or deleted.
+
+    The cache_control value is sent as the Cache-Control header of image
+    responses. If it is not given, it is taken from the CACHE_CONTROL
+    environment variable.
+
+    If origin_max_age (or if it is not given, the ORIGIN_MAX_AGE environment
+    variable) is positive, cached files older than that many seconds are
+    still sent, and revalidated against the origin in the background.
+
+    Image requests can ask for a copy in any of the local storage's enabled
+    formats with a "format" query parameter (such as "?format=tiff");
+    without one, they get the first enabled format. Likewise, they can ask
+    for one of the local storage's enabled size variants with a "size" query
+    parameter (such as "?size=1024").
+
+    Image responses have a Server-Timing header with the time spent in each
+    stage of the request. If a trace_log is given, a sample of the request
+    traces are also written to it.
+
+    If a negative_cache is given, origin failures that are not likely to
+    change soon (such as a 404 Not Found, or a resource that is not an
+    image) are remembered, and repeated requests for the same path fail
+    right away, without a request to the origin. A DELETE request for the
+    path forgets the failure.
+
+    If a memory_cache is given, the contents and ETags of recently sent
+    files are kept in it, and sent from there without touching the local
+    storage. A DELETE request removes the files from it.
+
+    If a delivery is given, GET requests for cached files are answered with
+    a header telling the front proxy to send the file, instead of sending it
+    from this process. Conditional requests are still answered here.
+
+    If a fetch_limiter or encode_limiter is given, cache misses wait for a
+    slot in it before requesting the image from the origin, or creating the
+    mezzanine file, respectively. If the limiter's queue is full, or the
+    wait is too long, the response is a 503 Service Unavailable with a
+    Retry-After header. Cache hits are never limited."""
+
     app = Flask(__name__)
+    if auth_type is None:
+        auth_type = get_auth_type(os.environ.get('AUTH_TYPE', 'NONE'))
+    if cache_control is None:
+        cache_control = os.environ.get('CACHE_CONTROL') or DEFAULT_CACHE_CONTROL
+    if origin_max_age is None:
+        origin_max_age = float(os.environ.get('ORIGIN_MAX_AGE', 0))
+    auth = get_authenticator(auth_type)
+    in_flight = SingleFlight()
+    revalidator = None
+    if origin_max_age > 0:
+        revalidator = Revalidator(
+            origin_repo,
+            max_age=origin_max_age,
+            auth=auth,
+            cache_index=cache_index,
+            memory_cache=memory_cache,
+            fetch_limiter=fetch_limiter,
+            encode_limiter=encode_limiter,
+        )
 
     @app.route('/')
     def home():
@@ -64,54 +163,239 @@ def create_app(local_storage: LocalStorage, origin_repo: OriginRepository) -> Fl
             app.logger.error(f'URL {url} does not start with {origin_repo.base_url}')
             abort(HTTPStatus.NOT_FOUND)
 
-    @app.route('/images/<path:repo_path>')
+    @app.route('/stats')
+    def stats():
+        return {
+            'origin': origin_repo.pool_stats,
+            'in_flight': len(in_flight),
+            **({'cache': cache_index.stats} if cache_index is not None else {}),
+            **({'encoder': local_storage.encoder.stats} if local_storage.encoder is not None else {}),
+            **({'revalidation': revalidator.stats} if revalidator is not None else {}),
+            **({'negative_cache': negative_cache.stats} if negative_cache is not None else {}),
+            **({'memory': memory_cache.stats} if memory_cache is not None else {}),
+            **({'content_store': local_storage.store.stats} if local_storage.store is not None else {}),
+            **({'shared': local_storage.shared.stats} if local_storage.shared is not None else {}),
+            **({'fetch': fetch_limiter.stats} if fetch_limiter is not None else {}),
+            **({'encode': encode_limiter.stats} if encode_limiter is not None else {}),
+        }
+
+    @app.before_request
+    def start_trace():
+        if request.endpoint == 'resource':
+            # use the caller's request ID, if it has one, so the traces can be correlated
+            g.trace = Trace(request.view_args['repo_path'], trace_id=request.headers.get('X-Request-ID'))
+            current_trace.set(g.trace)
+
+    @app.after_request
+    def finish_trace(response: Response) -> Response:
+        trace = g.get('trace')
+        if trace is not None:
+            response.headers['Server-Timing'] = trace.server_timing()
+            response.headers['X-Request-ID'] = trace.id
+            if trace_log is not None:
+                trace_log.write(trace, response.status_code)
+        return response
+
+    @app.teardown_request
+    def end_trace(_exc):
+        current_trace.set(None)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    def create_local_file(repo_path: str, local_file: MezzanineFile):
+        """Create the mezzanine copy for repo_path from the origin, unless it already exists.
+
+        The file lock is only needed on a cache miss, to coordinate with other
+        processes using the same storage."""
+        with local_file.acquire_lock(LOCK_TIMEOUT):
+            # another process may have created it already
+            if local_file.exists:
+                return
+            # or another node
+            if local_file.fetch_shared():
+                app.logger.debug(f'Fetched the shared copy of {local_file} for /{repo_path}')
+            else:
+                app.logger.debug(f'No local copy exists for /{repo_path} (local file path: {local_file})')
+                try:
+                    body = None
+                    # the origin connection is in use until the body is spooled
+                    with admit(fetch_limiter):
+                        response = origin_repo.get(repo_path, auth=auth)
+                        digest = get_origin_digest(response.headers)
+                        if local_file.link_stored(digest):
+                            # the same image is already stored for another path
+                            response.close()
+                        else:
+                            body = origin_repo.spool(repo_path, response)
+                    if body is not None:
+                        with body, admit(encode_limiter):
+                            local_file.create(body.source, digest)
+                    record_origin_metadata(local_file, response.headers)
+                except NotAnImageError as e:
+                    if negative_cache is not None:
+                        negative_cache.add(repo_path, e)
+                    abort(HTTPStatus.BAD_REQUEST, description='Requested resource is not an image')
+                except RuntimeError as e:
+                    if negative_cache is not None:
+                        negative_cache.add(repo_path, e)
+                    abort(HTTPStatus.INTERNAL_SERVER_ERROR, description=str(e))
+
+                app.logger.debug(f'Saved {local_file} for /{repo_path}')
+            # however it got here, the new file counts toward the cache limits
+            if cache_index is not None:
+                cache_index.add(local_file)
+
+    def send_local_file(
+            repo_path: str,
+            local_file: MezzanineFile,
+            info: FileInfo,
+            data: Optional[bytes] = None,
+    ) -> Response:
+        """Send local_file, or just its headers for a HEAD request or a 304
+        Not Modified response. If the contents of the file are given in data,
+        they are sent instead of opening the file. Range requests are handled
+        by send_file() or make_conditional(), or by the proxy if there is a
+        delivery. Raises FileNotFoundError if the file is removed before it is
+        opened.
+
+        Under waitress, send_file() uses the server's wsgi.file_wrapper, so
+        the file is sent a block at a time, but not with sendfile(), which
+        waitress does not support; use a delivery to avoid copying the file
+        through this process."""
+        if not is_resource_modified(request.environ, etag=info.etag, last_modified=info.last_modified):
+            # answered from the metadata alone, without opening the file
+            response = Response(status=HTTPStatus.NOT_MODIFIED)
+        elif request.method == 'HEAD':
+            response = Response(mimetype=local_file.format.mimetype)
+            response.content_length = info.size
+            response.accept_ranges = 'bytes'
+        elif delivery is not None:
+            # the proxy sends the file, and handles any Range header
+            app.logger.info('Handing %s to the proxy for /%s', local_file, repo_path)
+            response = Response(mimetype=local_file.format.mimetype)
+            response.headers[delivery.header] = delivery.get_location(local_file.path)
+        else:
+            if data is None and memory_cache is not None:
+                data = memory_cache.load(local_file, info)
+            if data is not None:
+                app.logger.info('Sending %s from memory for /%s', local_file, repo_path)
+                response = Response(data, mimetype=local_file.format.mimetype)
+                response.set_etag(info.etag)
+                response.last_modified = info.last_modified
+                response.make_conditional(request.environ, accept_ranges=True, complete_length=info.size)
+            else:
+                app.logger.info('Sending file %s for /%s', local_file, repo_path)
+                response = send_file(
+                    local_file.path, mimetype=local_file.format.mimetype, etag=info.etag, conditional=True
+                )
+        response.set_etag(info.etag)
+        response.last_modified = info.last_modified
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    @app.route('/images/<path:repo_path>', methods=['GET', 'HEAD'])
     def resource(repo_path):
         with Timer(
-            name=f'retrieve image {repo_path} in {current_thread().name}',
-            logger=app.logger.info,
-            text=TIMER_LOG_FORMAT
+            'retrieve image %s in %s', repo_path, current_thread().name,
+            histogram=REQUEST_SECONDS,
+            logger=app.logger,
         ):
-            local_file = local_storage.get_file(repo_path)
             try:
-                with local_file.lock.acquire(timeout=LOCK_TIMEOUT):
-                    if not local_file.exists:
-                        app.logger.debug(f'No local copy exists for /{repo_path} (local file path: {local_file})')
-                        auth_type = RepositoryAuthType[os.environ.get("AUTH_TYPE", "NONE")]
-                        try:
-                            response = origin_repo.get(repo_path, auth=get_authenticator(auth_type))
-                            local_file.create(response.raw)
-                        except NotAnImageError:
-                            abort(HTTPStatus.BAD_REQUEST, description='Requested resource is not an image')
-                        except RuntimeError as e:
-                            abort(HTTPStatus.INTERNAL_SERVER_ERROR, description=str(e))
-
-                        app.logger.debug(f'Saved {local_file} for /{repo_path}')
-
-                    app.logger.info(f'Sending file {local_file} for /{repo_path}')
-                    return send_file(local_file.path, mimetype='image/jpeg')
+                image_format = local_storage.get_format(request.args.get('format'))
+                size = local_storage.get_size(request.args.get('size'))
+            except RuntimeError as e:
+                abort(HTTPStatus.BAD_REQUEST, description=str(e))
+            local_file = local_storage.get_file(repo_path, image_format, size)
+            try:
+                cached = memory_cache.get(local_file) if memory_cache is not None else None
+                if cached is not None:
+                    info, data = cached
+                else:
+                    # mezzanine files are published atomically, so an existing
+                    # file is always complete and can be sent without locking
+                    info, data = local_file.info(), None
+                response = send_local_file(repo_path, local_file, info, data)
+                CACHE_HITS.inc()
+                if cache_index is not None:
+                    cache_index.touch(local_file)
+                if revalidator is not None:
+                    revalidator.submit(repo_path, local_file, info)
+                return response
+            except FileNotFoundError:
+                if request.method == 'HEAD':
+                    # HEAD only reports on the local copy, and never fetches from the origin
+                    abort(HTTPStatus.NOT_FOUND)
+                app.logger.debug('No local copy of %s to send; creating it', local_file)
+
+            if negative_cache is not None and (entry := negative_cache.get(repo_path)) is not None:
+                # failed recently, so don't bother the origin again
+                app.logger.debug(f'Origin request for /{repo_path} failed recently with {entry.error}')
+                NEGATIVE_CACHE_HITS.inc()
+                abort(entry.status, description=entry.description)
 
+            CACHE_MISSES.inc()
+            IN_FLIGHT_MISSES.inc()
+            try:
+                # concurrent requests for the same image (in the same format and size) in this
+                # process wait for a single thread to check for and create the local file
+                in_flight.run(
+                    str(local_file.path), lambda: create_local_file(repo_path, local_file), timeout=LOCK_TIMEOUT
+                )
             except Timeout:
                 app.logger.error(
                     f'Unable to acquire a lock to {local_file} in {LOCK_TIMEOUT}s (lock path: {local_file.lock_path})'
                 )
                 abort(HTTPStatus.INTERNAL_SERVER_ERROR, description='Unable to access mezzanine copy')
+            except TimeoutError:
+                app.logger.error(f'Request in progress for {local_file} did not finish in {LOCK_TIMEOUT}s')
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR, description='Unable to access mezzanine copy')
+            except Overloaded as e:
+                app.logger.warning(f'Not creating {local_file} for /{repo_path}: {e}')
+                abort(HTTPStatus.SERVICE_UNAVAILABLE, description=str(e), retry_after=e.retry_after)
+            finally:
+                IN_FLIGHT_MISSES.dec()
+
+            try:
+                return send_local_file(repo_path, local_file, local_file.info())
+            except FileNotFoundError:
+                # deleted or evicted by another request as soon as it was created
+                app.logger.warning(f'{local_file} was removed before it could be sent for /{repo_path}')
+                abort(
+                    HTTPStatus.SERVICE_UNAVAILABLE,
+                    description='Mezzanine copy was removed; try again',
+                    retry_after=REMOVED_RETRY_AFTER,
+                )
 
     @app.route('/images/<path:repo_path>', methods=['DELETE'])
     def delete_resource(repo_path):
-        local_file = local_storage.get_file(repo_path)
+        if negative_cache is not None:
+            negative_cache.invalidate(repo_path)
+        # removes the copies in every format
+        for local_file in local_storage.get_files(repo_path):
+            if memory_cache is not None:
+                memory_cache.invalidate(local_file)
+            try:
+                with local_file.acquire_lock(LOCK_TIMEOUT):
+                    try:
+                        app.logger.info(f'Removing {local_file} for /{repo_path}')
+                        local_file.delete()
+                        if cache_index is not None:
+                            cache_index.remove(local_file)
+                    except RuntimeError as e:
+                        abort(HTTPStatus.INTERNAL_SERVER_ERROR, description=str(e))
+            except Timeout:
+                app.logger.error(
+                    f'Unable to acquire a lock to {local_file} in {LOCK_TIMEOUT}s (lock path: {local_file.lock_path})'
+                )
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR, description='Unable to access mezzanine copy')
 
-        try:
-            with local_file.lock.acquire(timeout=LOCK_TIMEOUT):
-                try:
-                    app.logger.info(f'Removing {local_file} for /{repo_path}')
-                    local_file.delete()
-                except RuntimeError as e:
-                    abort(HTTPStatus.INTERNAL_SERVER_ERROR, description=str(e))
-        except Timeout:
-            app.logger.error(
-                f'Unable to acquire a lock to {local_file} in {LOCK_TIMEOUT}s (lock path: {local_file.lock_path})'
-            )
-            abort(HTTPStatus.INTERNAL_SERVER_ERROR, description='Unable to access mezzanine copy')
+        if local_storage.shared is not None:
+            try:
+                local_storage.shared.delete(local_storage.get_dir(repo_path))
+            except RuntimeError as e:
+                abort(HTTPStatus.INTERNAL_SERVER_ERROR, description=str(e))
 
         return '', HTTPStatus.NO_CONTENT
 
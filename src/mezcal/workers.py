@@ -0,0 +1,204 @@
+"""Running the server in several pre-forked worker processes.
+
+The parent process binds the listening socket, then forks the workers,
+which all accept connections from that socket, so the kernel spreads the
+connections between them. Each worker creates its own application (with
+its own origin connection pool, encoder processes, and background
+threads) after it is forked, since forking a process with running threads
+can leave locks held in the child.
+
+On SIGTERM or SIGINT, the parent passes the signal on to the workers.
+Each worker stops accepting connections and waits for the requests it is
+already handling (including any images being encoded for them) to finish,
+for up to shutdown_timeout seconds. Workers that are still running after
+that are killed. A worker that exits while the server is not stopping is
+replaced."""
+import _thread
+import logging
+import os
+import signal
+import socket
+from dataclasses import dataclass
+from io import BytesIO
+from threading import Event, Thread
+from time import monotonic, sleep
+from typing import Callable
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# how long to wait before replacing a worker that exited, so that a worker
+# that fails on startup doesn't make the parent fork as fast as it can
+RESPAWN_DELAY = 1
+
+
+@dataclass(frozen=True)
+class ServerOptions:
+    """Settings for the listening socket, the worker processes, and waitress.
+    The defaults for threads, connection_limit, channel_timeout, and
+    max_request_body_size are waitress's defaults."""
+    listen: str = '0.0.0.0:5000'
+    workers: int = 1
+    threads: int = 4
+    connection_limit: int = 100
+    backlog: int = 1024
+    channel_timeout: int = 120
+    max_request_body_size: int = 1024 * 1024 * 1024
+    shutdown_timeout: float = 30
+
+    @property
+    def waitress_args(self) -> dict:
+        return {
+            'threads': self.threads,
+            'connection_limit': self.connection_limit,
+            'backlog': self.backlog,
+            'channel_timeout': self.channel_timeout,
+            'max_request_body_size': self.max_request_body_size,
+        }
+
+
+def bind(listen: str, backlog: int) -> socket.socket:
+    """Return a socket listening on listen ("host:port", or "[host]:port" for IPv6 addresses)."""
+    host, _, port = listen.rpartition(':')
+    family, socktype, proto, _, address = socket.getaddrinfo(
+        host.strip('[]') or None, int(port), type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+    )[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+def warm_up():
+    """Load and register Pillow's image plugins, and run the codecs used for
+    mezzanine files once, so that the first requests to a new worker don't
+    pay for them."""
+    Image.init()
+    img = Image.new('RGB', (16, 16))
+    for image_format in ('JPEG', 'TIFF', 'PNG'):
+        buffer = BytesIO()
+        img.save(buffer, format=image_format)
+        buffer.seek(0)
+        Image.open(buffer).load()
+
+
+def serve_until_stopped(server, shutdown_timeout: float):
+    """Run a waitress server until SIGTERM or SIGINT, then stop accepting
+    connections, and wait up to shutdown_timeout seconds for its running
+    and queued tasks to finish before returning."""
+    drained = Event()
+
+    def drain():
+        dispatcher = server.task_dispatcher
+        deadline = monotonic() + shutdown_timeout
+        # waitress has no public API for these, or for a graceful shutdown
+        while (dispatcher.active_count or dispatcher.queue) and monotonic() < deadline:
+            sleep(0.1)
+        drained.set()
+        # runs finish() in the main thread; the signal must keep a Python
+        # handler, since interrupt_main() does nothing for an ignored signal
+        _thread.interrupt_main(signal.SIGTERM)
+
+    def finish(_signum, _frame):
+        # further signals while draining are ignored
+        if drained.is_set():
+            # server.run() returns on a KeyboardInterrupt in the main thread
+            raise KeyboardInterrupt
+
+    def stop(signum, _frame):
+        logger.info(f'Received {signal.Signals(signum).name}; finishing requests in progress')
+        signal.signal(signal.SIGTERM, finish)
+        signal.signal(signal.SIGINT, finish)
+        server.accepting = False
+        Thread(target=drain, name='Drain', daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.run()
+
+
+class Prefork:
+    """Runs target(sock, worker) in each of workers forked processes, where
+    worker is the number of the worker, from 0. POSIX only."""
+
+    def __init__(
+            self,
+            sock: socket.socket,
+            workers: int,
+            target: Callable[[socket.socket, int], None],
+            shutdown_timeout: float = 30,
+    ):
+        self.sock = sock
+        self.workers = workers
+        self.target = target
+        self.shutdown_timeout = shutdown_timeout
+        self.stopping = False
+        self._children: dict[int, int] = {}
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        for worker in range(self.workers):
+            self.spawn(worker)
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker = self._children.pop(pid, None)
+            if worker is None:
+                continue
+            if self.stopping:
+                logger.info(f'Worker {worker} (pid {pid}) stopped')
+            else:
+                logger.error(f'Worker {worker} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}')
+                sleep(RESPAWN_DELAY)
+                if not self.stopping:
+                    self.spawn(worker)
+        signal.alarm(0)
+        self.sock.close()
+
+    def spawn(self, worker: int):
+        pid = os.fork()
+        if pid == 0:
+            # in the worker; the target installs its own signal handlers
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            status = 0
+            try:
+                self.target(self.sock, worker)
+            except BaseException:
+                logger.exception(f'Worker {worker} failed')
+                status = 1
+            finally:
+                logging.shutdown()
+                os._exit(status)
+        self._children[pid] = worker
+        logger.info(f'Started worker {worker} (pid {pid})')
+
+    def stop(self, signum, _frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info(f'Received {signal.Signals(signum).name}; stopping {len(self._children)} workers')
+        for pid in list(self._children):
+            self._signal(pid, signal.SIGTERM)
+        # leave the workers a little more time than they give their own requests
+        signal.alarm(int(self.shutdown_timeout) + 5)
+
+    def kill(self, _signum, _frame):
+        for pid, worker in list(self._children.items()):
+            logger.warning(f'Worker {worker} (pid {pid}) did not stop in time; killing it')
+            self._signal(pid, signal.SIGKILL)
+
+    @staticmethod
+    def _signal(pid: int, signum: int):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            # already exited, but not yet waited for
+            pass
@@ -1,19 +1,52 @@
+from contextlib import ExitStack
+from http import HTTPStatus
+
 import pytest
 
 from mezcal.http import OriginRepository
 from mezcal.storage import LocalStorage
 from mezcal.web import create_app
 
+BASE_URL = 'http://example.org/repo/'
+
+
+class MockImageResponse:
+    """Stands in for the requests.Response returned by OriginRepository.get(),
+    with the file at path as its raw body."""
+
+    def __init__(self, path, content_type='image/jpeg', headers=None, status_code=HTTPStatus.OK):
+        self.status_code = status_code
+        self.headers = headers if headers is not None else {'Content-Type': content_type}
+        self.raw = open(path, mode='rb')
+
+    def close(self):
+        self.raw.close()
+
+
+@pytest.fixture()
+def make_client(datadir):
+    """Return a function that creates an app with create_app(**kwargs) and
+    returns a test client for it. The origin repository defaults to one at
+    BASE_URL, and the local storage to one in datadir."""
+    with ExitStack() as stack:
+        def make(**kwargs):
+            kwargs.setdefault('origin_repo', OriginRepository(base_url=BASE_URL))
+            kwargs.setdefault('local_storage', LocalStorage(storage_dir=datadir))
+            app = create_app(**kwargs)
+            client = stack.enter_context(app.test_client())
+            # Establish an application context
+            stack.enter_context(app.app_context())
+            return client
+
+        yield make
+
+
+@pytest.fixture()
+def test_client(make_client):
+    return make_client()
+
 
 @pytest.fixture()
-def test_client(datadir):
-    flask_app = create_app(
-        origin_repo=OriginRepository(base_url='http://example.org/repo/'),
-        local_storage=LocalStorage(storage_dir=datadir),
-    )
-
-    # Create a test client using the Flask application configured for testing
-    with flask_app.test_client() as testing_client:
-        # Establish an application context
-        with flask_app.app_context():
-            yield testing_client
+def image_response():
+    """Return the MockImageResponse class, for patching OriginRepository.get()."""
+    return MockImageResponse
@@ -0,0 +1,150 @@
+import asyncio
+from http import HTTPStatus
+from threading import Thread, Event
+from unittest.mock import patch
+
+import pytest
+
+from mezcal.admission import Limiter, Overloaded, admit, admit_now
+from mezcal.http import OriginRepository
+
+
+def test_limit_must_be_positive():
+    with pytest.raises(RuntimeError):
+        Limiter('fetch', limit=0)
+
+
+def test_admit_none():
+    with admit(None):
+        pass
+
+
+def test_reject_when_queue_full():
+    limiter = Limiter('fetch', limit=1, queue_size=0, retry_after=7)
+    with limiter.slot():
+        with pytest.raises(Overloaded) as exc_info:
+            limiter.acquire()
+    assert exc_info.value.retry_after == 7
+    assert exc_info.value.reason == 'queue is full'
+    assert limiter.stats['rejected'] == 1
+    assert limiter.stats['active'] == 0
+
+
+def test_try_slot_does_not_queue():
+    limiter = Limiter('encode', limit=1, queue_size=5)
+    with admit_now(limiter):
+        assert not limiter.try_acquire()
+        with pytest.raises(Overloaded) as exc_info:
+            with limiter.try_slot():
+                pass
+    assert exc_info.value.reason == 'no free slot'
+    assert limiter.stats['waiting'] == 0
+    assert limiter.stats['rejected'] == 0
+    with admit_now(None):
+        assert limiter.try_acquire()
+    limiter.release()
+    assert limiter.stats['active'] == 0
+
+
+def test_timeout_in_queue():
+    limiter = Limiter('fetch', limit=1, queue_size=1, timeout=0.05)
+    with limiter.slot():
+        with pytest.raises(Overloaded):
+            limiter.acquire()
+        assert limiter.stats['waiting'] == 0
+    assert limiter.stats['timed_out'] == 1
+    # the timed out caller gave up its place, so the slot is free again
+    with limiter.slot():
+        assert limiter.stats['active'] == 1
+
+
+def test_release_hands_slot_to_waiter():
+    limiter = Limiter('encode', limit=1, queue_size=1, timeout=5)
+    entered = Event()
+    limiter.acquire()
+
+    def wait():
+        with limiter.slot():
+            entered.set()
+
+    thread = Thread(target=wait)
+    thread.start()
+    while limiter.stats['waiting'] == 0:
+        pass
+    assert not entered.is_set()
+    limiter.release()
+    thread.join()
+    assert entered.is_set()
+    assert limiter.stats == {
+        'limit': 1, 'queue_size': 1, 'active': 0, 'waiting': 0, 'admitted': 2, 'queued': 1, 'rejected': 0,
+        'timed_out': 0,
+    }
+
+
+def test_async_slot():
+    limiter = Limiter('fetch', limit=1, queue_size=1, timeout=5)
+
+    async def run():
+        order = []
+
+        async def task(name):
+            async with limiter.async_slot():
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(task('a'), task('b'))
+        async with limiter.async_slot():
+            waiter = asyncio.create_task(limiter.acquire_async())
+            await asyncio.sleep(0.01)
+            with pytest.raises(Overloaded):
+                await limiter.acquire_async()
+        await waiter
+        limiter.release()
+        return order
+
+    assert asyncio.run(run()) == ['a', 'b']
+    assert limiter.stats['active'] == 0
+    assert limiter.stats['rejected'] == 1
+
+
+def test_async_cancelled_while_waiting():
+    limiter = Limiter('fetch', limit=1, queue_size=1, timeout=5)
+
+    async def run():
+        await limiter.acquire_async()
+        waiter = asyncio.create_task(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.stats['waiting'] == 0
+        limiter.release()
+
+    asyncio.run(run())
+    assert limiter.stats['active'] == 0
+
+
+@pytest.fixture
+def fetch_limiter():
+    return Limiter('fetch', limit=1, queue_size=0, retry_after=3)
+
+
+@pytest.fixture
+def test_client(make_client, fetch_limiter):
+    return make_client(fetch_limiter=fetch_limiter)
+
+
+def test_miss_rejected_when_overloaded(test_client, fetch_limiter):
+    with fetch_limiter.slot(), patch.object(OriginRepository, 'get') as mock_get:
+        response = test_client.get('/images/bar')
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.headers['Retry-After'] == '3'
+    mock_get.assert_not_called()
+    assert test_client.get('/stats').json['fetch']['rejected'] == 1
+
+
+def test_hit_bypasses_limiter(test_client, fetch_limiter):
+    with fetch_limiter.slot():
+        response = test_client.get('/images/foo')
+    assert response.status_code == HTTPStatus.OK
+    assert fetch_limiter.stats['rejected'] == 0
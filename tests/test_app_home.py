@@ -17,3 +17,10 @@ def test_home_valid_param(test_client):
 def test_home_invalid_param(test_client):
     response = test_client.get('/?url=http://bad-example.org/repo/foo')
     assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_stats(test_client):
+    response = test_client.get('/stats')
+    assert response.status_code == 200
+    assert response.json['origin']['size'] == 10
+    assert response.json['in_flight'] == 0
@@ -1,10 +1,12 @@
 from http import HTTPStatus
 from unittest.mock import patch
 
-from filelock import Timeout, FileLock
+import pytest
+from filelock import Timeout
 
 from mezcal.http import OriginRepository, NotAnImageError
-from mezcal.storage import MezzanineFile
+from mezcal.locks import DirectoryLock
+from mezcal.storage import LocalStorage, MezzanineFile
 
 
 def test_resource_not_an_image(test_client):
@@ -21,30 +23,104 @@ def test_resource_runtime_error(test_client):
 
 
 def test_resource_lock_timeout(test_client):
-    with patch.object(FileLock, 'acquire', side_effect=Timeout('foo')):
-        response = test_client.get('/images/foo')
+    with patch.object(DirectoryLock, 'acquire', side_effect=Timeout('bar')):
+        response = test_client.get('/images/bar')
     assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
     assert 'Unable to access mezzanine copy' in response.text
 
 
+def test_resource_cached_does_not_lock(test_client):
+    with patch.object(DirectoryLock, 'acquire', side_effect=Timeout('foo')) as mock_acquire:
+        response = test_client.get('/images/foo')
+    assert response.status_code == HTTPStatus.OK
+    assert response.content_type == 'image/jpeg'
+    mock_acquire.assert_not_called()
+
+
 def test_resource_successful_is_cached(test_client):
     response = test_client.get('/images/foo')
     assert response.status_code == HTTPStatus.OK
     assert response.content_type == 'image/jpeg'
 
 
-def test_resource_successful(test_client, datadir):
-    class MockImageResponse:
-        @property
-        def raw(self):
-            return open(datadir / 'foo/image.jpg', mode='rb')
-
-    with patch.object(OriginRepository, 'get', return_value=MockImageResponse()):
+def test_resource_successful(test_client, datadir, image_response):
+    with patch.object(OriginRepository, 'get', return_value=image_response(datadir / 'foo/image.jpg')):
         response = test_client.get('/images/bar')
     assert response.status_code == HTTPStatus.OK
     assert response.content_type == 'image/jpeg'
 
 
+def test_resource_removed_after_miss(test_client, datadir, image_response):
+    # as if the new file were deleted or evicted as soon as it was created
+    with patch.object(OriginRepository, 'get', return_value=image_response(datadir / 'foo/image.jpg')), \
+            patch.object(MezzanineFile, 'info', side_effect=FileNotFoundError):
+        response = test_client.get('/images/bar')
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_resource_validators(test_client):
+    response = test_client.get('/images/foo')
+    assert response.headers['ETag']
+    assert response.headers['Last-Modified']
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+
+def test_resource_if_none_match(test_client):
+    etag = test_client.get('/images/foo').headers['ETag']
+    with patch('mezcal.web.send_file') as mock_send_file:
+        response = test_client.get('/images/foo', headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+    assert response.headers['ETag'] == etag
+    assert response.data == b''
+    mock_send_file.assert_not_called()
+
+
+def test_resource_if_modified_since(test_client):
+    last_modified = test_client.get('/images/foo').headers['Last-Modified']
+    response = test_client.get('/images/foo', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+
+def test_resource_etag_changed(test_client):
+    response = test_client.get('/images/foo', headers={'If-None-Match': '"something-else"'})
+    assert response.status_code == HTTPStatus.OK
+
+
+def test_resource_range(test_client, datadir):
+    response = test_client.get('/images/foo', headers={'Range': 'bytes=0-99'})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.data == (datadir / 'foo/image.jpg').read_bytes()[:100]
+    assert response.headers['Content-Range'].startswith('bytes 0-99/')
+
+
+def test_resource_range_not_satisfiable(test_client):
+    response = test_client.get('/images/foo', headers={'Range': 'bytes=100000000-'})
+    assert response.status_code == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+
+
+def test_resource_head(test_client, datadir):
+    with patch('mezcal.web.send_file') as mock_send_file:
+        response = test_client.head('/images/foo')
+    assert response.status_code == HTTPStatus.OK
+    assert response.content_length == (datadir / 'foo/image.jpg').stat().st_size
+    assert response.headers['ETag']
+    mock_send_file.assert_not_called()
+
+
+def test_resource_head_not_cached(test_client):
+    with patch.object(OriginRepository, 'get') as mock_get:
+        response = test_client.head('/images/bar')
+    assert response.status_code == HTTPStatus.NOT_FOUND
+    mock_get.assert_not_called()
+
+
+def test_resource_cache_control(make_client):
+    response = make_client(cache_control='public, max-age=86400').get('/images/foo')
+    assert response.headers['Cache-Control'] == 'public, max-age=86400'
+
+
 def test_resource_delete(test_client):
     response = test_client.delete('/images/foo')
     assert response.status_code == HTTPStatus.NO_CONTENT
@@ -58,7 +134,35 @@ def test_resource_delete_runtime_error(test_client):
 
 
 def test_resource_delete_lock_timeout(test_client):
-    with patch.object(FileLock, 'acquire', side_effect=Timeout('foo')):
+    with patch.object(DirectoryLock, 'acquire', side_effect=Timeout('foo')):
         response = test_client.delete('/images/foo')
     assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
     assert 'Unable to access mezzanine copy' in response.text
+
+
+@pytest.fixture
+def tiff_client(make_client, datadir):
+    return make_client(local_storage=LocalStorage(storage_dir=datadir, formats=['jpeg', 'tiff']))
+
+
+def test_resource_format(tiff_client, datadir, image_response):
+    with patch.object(OriginRepository, 'get', return_value=image_response(datadir / 'foo/image.jpg')):
+        response = tiff_client.get('/images/foo?format=tiff')
+    assert response.status_code == HTTPStatus.OK
+    assert response.content_type == 'image/tiff'
+    assert (datadir / 'foo/image.tif').exists()
+    # the flat JPEG is still the default
+    assert tiff_client.get('/images/foo').content_type == 'image/jpeg'
+
+
+def test_resource_format_not_enabled(test_client):
+    response = test_client.get('/images/foo?format=tiff')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert 'TIFF is not an enabled image format' in response.text
+
+
+def test_resource_delete_all_formats(tiff_client, datadir):
+    (datadir / 'foo/image.tif').write_bytes(b'')
+    response = tiff_client.delete('/images/foo')
+    assert response.status_code == HTTPStatus.NO_CONTENT
+    assert not (datadir / 'foo').exists()
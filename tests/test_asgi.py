@@ -0,0 +1,270 @@
+import asyncio
+import base64
+from hashlib import sha256
+from http import HTTPStatus
+from unittest.mock import patch
+
+import pytest
+from filelock import Timeout
+from requests.auth import HTTPBasicAuth
+
+from mezcal.http import OriginRepository
+from mezcal.locks import DirectoryLock
+from mezcal.storage import LocalStorage, MezzanineFile, DirectoryLayout
+
+httpx = pytest.importorskip('httpx')
+
+from mezcal.asgi import MezcalASGI, RequestsAuth  # noqa: E402
+
+
+def origin_transport(datadir, content_type='image/jpeg', status_code=HTTPStatus.OK, requests=None, headers=None):
+    image_data = (datadir / 'foo/image.jpg').read_bytes()
+
+    def handler(request):
+        if requests is not None:
+            requests.append(request)
+        return httpx.Response(
+            status_code, headers={'Content-Type': content_type, **(headers or {})}, stream=httpx.ByteStream(image_data)
+        )
+
+    return httpx.MockTransport(handler)
+
+
+def request(app, method, path, headers=None):
+    async def send():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+            return await client.request(method, path, headers=headers)
+
+    return asyncio.run(send())
+
+
+def create_asgi_app(datadir, formats=('jpeg',), **kwargs):
+    return MezcalASGI(
+        origin_repo=OriginRepository(base_url='http://example.org/repo/', max_retries=0),
+        local_storage=LocalStorage(storage_dir=datadir, formats=formats),
+        transport=origin_transport(datadir, **kwargs),
+    )
+
+
+def test_resource_cached(datadir):
+    app = create_asgi_app(datadir)
+    with patch.object(DirectoryLock, 'acquire', side_effect=Timeout('foo')) as mock_acquire:
+        response = request(app, 'GET', '/images/foo')
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['Content-Type'] == 'image/jpeg'
+    assert response.content == (datadir / 'foo/image.jpg').read_bytes()
+    mock_acquire.assert_not_called()
+
+
+def test_resource_head(datadir):
+    response = request(create_asgi_app(datadir), 'HEAD', '/images/foo')
+    assert response.status_code == HTTPStatus.OK
+    assert int(response.headers['Content-Length']) == (datadir / 'foo/image.jpg').stat().st_size
+    assert response.content == b''
+
+
+def test_resource_successful(datadir):
+    origin_requests = []
+    app = create_asgi_app(datadir, requests=origin_requests)
+    response = request(app, 'GET', '/images/bar')
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['Content-Type'] == 'image/jpeg'
+    assert (datadir / 'bar/image.jpg').exists()
+    assert [str(r.url) for r in origin_requests] == ['http://example.org/repo/bar']
+
+
+def test_resource_removed_after_miss(datadir):
+    # as if the new file were deleted or evicted as soon as it was created
+    with patch.object(MezzanineFile, 'info', side_effect=FileNotFoundError):
+        response = request(create_asgi_app(datadir), 'GET', '/images/bar')
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_resource_concurrent_misses_fetch_once(datadir):
+    origin_requests = []
+    app = create_asgi_app(datadir, requests=origin_requests)
+
+    async def send():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+            return await asyncio.gather(*(client.get('/images/bar') for _ in range(5)))
+
+    responses = asyncio.run(send())
+    assert [r.status_code for r in responses] == [HTTPStatus.OK] * 5
+    assert len(origin_requests) == 1
+
+
+def test_resource_same_digest_not_downloaded(datadir, tmp_path):
+    image_data = (datadir / 'foo/image.jpg').read_bytes()
+    body_reads = []
+
+    class RecordingStream(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            body_reads.append(1)
+            yield image_data
+
+    def handler(_request):
+        digest = base64.b64encode(sha256(image_data).digest()).decode()
+        headers = {'Content-Type': 'image/jpeg', 'Content-Digest': f'sha-256=:{digest}:'}
+        return httpx.Response(HTTPStatus.OK, headers=headers, stream=RecordingStream())
+
+    local_storage = LocalStorage(storage_dir=tmp_path, layout=DirectoryLayout.CONTENT_ADDRESSED)
+    app = MezcalASGI(
+        origin_repo=OriginRepository(base_url='http://example.org/repo/', max_retries=0),
+        local_storage=local_storage,
+        transport=httpx.MockTransport(handler),
+    )
+    assert request(app, 'GET', '/images/bar').status_code == HTTPStatus.OK
+    # the same image at another path is linked to the stored copy, without reading the body
+    assert request(app, 'GET', '/images/baz').status_code == HTTPStatus.OK
+    assert len(body_reads) == 1
+    assert local_storage.get_file('baz').path.stat().st_ino == local_storage.get_file('bar').path.stat().st_ino
+
+
+def test_resource_invalid_content_length(datadir):
+    app = create_asgi_app(datadir, headers={'Content-Length': 'not a number'})
+    response = request(app, 'GET', '/images/bar')
+    assert response.status_code == HTTPStatus.OK
+    assert (datadir / 'bar/image.jpg').exists()
+
+
+def test_resource_miss_waits_for_lock(datadir):
+    origin_requests = []
+    app = create_asgi_app(datadir, requests=origin_requests)
+    # another process is creating the file
+    with app.local_storage.get_file('bar', app.local_storage.get_format()).acquire_lock(1):
+        with patch('mezcal.asgi.LOCK_TIMEOUT', 0.1):
+            response = request(app, 'GET', '/images/bar')
+    assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert origin_requests == []
+
+
+def test_stats(datadir):
+    app = create_asgi_app(datadir)
+    request(app, 'GET', '/images/bar')
+    response = request(app, 'GET', '/stats')
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()['origin']['requests'] == 1
+    assert response.json()['in_flight'] == 0
+
+
+def test_resource_format(datadir):
+    app = create_asgi_app(datadir, formats=('jpeg', 'tiff'))
+    response = request(app, 'GET', '/images/bar?format=tiff')
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['Content-Type'] == 'image/tiff'
+    assert (datadir / 'bar/image.tif').exists()
+    assert not (datadir / 'bar/image.jpg').exists()
+
+
+def test_resource_format_not_enabled(datadir):
+    response = request(create_asgi_app(datadir), 'GET', '/images/foo?format=tiff')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_resource_not_an_image(datadir):
+    response = request(create_asgi_app(datadir, content_type='text/html'), 'GET', '/images/bar')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert 'Requested resource is not an image' in response.text
+    assert not (datadir / 'bar/image.jpg').exists()
+
+
+def test_resource_origin_error(datadir):
+    app = create_asgi_app(datadir, status_code=HTTPStatus.NOT_FOUND)
+    response = request(app, 'GET', '/images/bar')
+    assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+def test_resource_lock_timeout(datadir):
+    with patch.object(DirectoryLock, 'acquire', side_effect=Timeout('bar')):
+        response = request(create_asgi_app(datadir), 'GET', '/images/bar')
+    assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert 'Unable to access mezzanine copy' in response.text
+
+
+def test_resource_delete(datadir):
+    response = request(create_asgi_app(datadir), 'DELETE', '/images/foo')
+    assert response.status_code == HTTPStatus.NO_CONTENT
+    assert not (datadir / 'foo/image.jpg').exists()
+
+
+def test_resource_delete_lock_timeout(datadir):
+    with patch.object(DirectoryLock, 'acquire', side_effect=Timeout('foo')):
+        response = request(create_asgi_app(datadir), 'DELETE', '/images/foo')
+    assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert 'Unable to access mezzanine copy' in response.text
+    assert (datadir / 'foo/image.jpg').exists()
+
+
+def test_not_found(datadir):
+    response = request(create_asgi_app(datadir), 'GET', '/other')
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+def test_requests_auth():
+    request = httpx.Request('GET', 'http://example.org/repo/bar')
+    flow = RequestsAuth(HTTPBasicAuth('user', 'pass')).auth_flow(request)
+    assert next(flow).headers['Authorization'] == 'Basic dXNlcjpwYXNz'
+
+
+def test_resource_if_none_match(datadir):
+    app = create_asgi_app(datadir)
+    etag = request(app, 'GET', '/images/foo').headers['ETag']
+    response = request(app, 'GET', '/images/foo', headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+    assert response.content == b''
+
+
+def test_resource_range(datadir):
+    response = request(create_asgi_app(datadir), 'GET', '/images/foo', headers={'Range': 'bytes=10-19'})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.content == (datadir / 'foo/image.jpg').read_bytes()[10:20]
+    assert response.headers['Content-Range'].startswith('bytes 10-19/')
+
+
+def test_resource_range_not_satisfiable(datadir):
+    response = request(create_asgi_app(datadir), 'GET', '/images/foo', headers={'Range': 'bytes=100000000-'})
+    assert response.status_code == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+
+
+def test_resource_head_not_cached(datadir):
+    origin_requests = []
+    response = request(create_asgi_app(datadir, requests=origin_requests), 'HEAD', '/images/bar')
+    assert response.status_code == HTTPStatus.NOT_FOUND
+    assert origin_requests == []
+
+
+def test_resource_server_timing(datadir):
+    response = request(create_asgi_app(datadir), 'GET', '/images/bar', headers={'X-Request-ID': 'request-1'})
+    assert response.status_code == HTTPStatus.OK
+    stages = [metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')]
+    assert {'lock', 'origin', 'download', 'decode', 'encode', 'total'} <= set(stages)
+    assert response.headers['X-Request-ID'] == 'request-1'
+
+
+def test_resource_zerocopy(datadir):
+    app = create_asgi_app(datadir)
+    messages = []
+    scope = {
+        'type': 'http',
+        'method': 'GET',
+        'path': '/images/foo',
+        'query_string': b'',
+        'headers': [],
+        'extensions': {'http.response.zerocopy': {}},
+    }
+
+    async def send(message):
+        if message['type'] == 'http.response.zerocopy':
+            # the file is closed once the message is sent
+            message = {**message, 'file': message['file'].read()}
+        messages.append(message)
+
+    asyncio.run(app(scope, None, send))
+    assert messages[0]['type'] == 'http.response.start'
+    assert messages[0]['status'] == HTTPStatus.OK
+    size = (datadir / 'foo/image.jpg').stat().st_size
+    assert messages[1] == {
+        'type': 'http.response.zerocopy', 'file': (datadir / 'foo/image.jpg').read_bytes(), 'offset': 0, 'count': size,
+    }
+    assert len(messages) == 2
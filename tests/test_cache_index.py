@@ -0,0 +1,166 @@
+import sqlite3
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+import pytest
+from filelock import Timeout
+
+from mezcal.index import CacheIndex, EvictionPolicy
+from mezcal.locks import DirectoryLock
+from mezcal.storage import LocalStorage, DirectoryLayout, MezzanineFile
+
+
+def add_file(local_storage: LocalStorage, repo_path: str, size: int = 100):
+    file = local_storage.get_file(repo_path)
+    file.path.parent.mkdir(parents=True, exist_ok=True)
+    file.path.write_bytes(b'x' * size)
+    return file
+
+
+@pytest.mark.parametrize('layout', list(DirectoryLayout))
+def test_rebuild(tmp_path, layout):
+    local_storage = LocalStorage(tmp_path, layout)
+    for n in range(3):
+        add_file(local_storage, f'foo/{n}')
+    index = CacheIndex(local_storage)
+    index.rebuild()
+    assert index.totals == (3, 300)
+
+    local_storage.get_file('foo/0').delete()
+    index.rebuild()
+    assert index.totals == (2, 200)
+
+
+def test_rebuild_keeps_files_created_during_scan(tmp_path):
+    local_storage = LocalStorage(tmp_path)
+    index = CacheIndex(local_storage)
+    gone = add_file(local_storage, 'foo/0')
+    index.add(gone)
+    gone.delete()
+    # created and indexed after the scan passed its directory
+    with patch.object(Path, 'rglob', return_value=iter(())):
+        index.add(add_file(local_storage, 'foo/1'))
+        index.rebuild()
+    assert index.totals == (1, 100)
+
+
+def test_database_errors_are_logged(tmp_path, caplog):
+    local_storage = LocalStorage(tmp_path)
+    index = CacheIndex(local_storage)
+    index._db = MagicMock(**{'execute.side_effect': sqlite3.OperationalError('database is locked')})
+    file = add_file(local_storage, 'foo/1')
+    index.add(file)
+    index.remove(file)
+    assert 'Unable to add' in caplog.text
+    assert 'Unable to remove' in caplog.text
+
+
+def test_unknown_policy(tmp_path):
+    with pytest.raises(RuntimeError) as e:
+        CacheIndex(LocalStorage(tmp_path), policy='foo')
+    assert str(e.value) == "'FOO' is not a recognized eviction policy"
+
+
+def test_add_and_remove(tmp_path):
+    local_storage = LocalStorage(tmp_path)
+    index = CacheIndex(local_storage)
+    file = add_file(local_storage, 'foo/1', size=42)
+    index.add(file)
+    assert index.stats['files'] == 1
+    assert index.stats['bytes'] == 42
+    index.remove(file)
+    assert index.totals == (0, 0)
+
+
+def test_no_eviction_under_limit(tmp_path):
+    local_storage = LocalStorage(tmp_path)
+    index = CacheIndex(local_storage, max_files=5)
+    for n in range(5):
+        index.add(add_file(local_storage, f'foo/{n}'))
+    assert index.evict() == 0
+    assert index.totals == (5, 500)
+
+
+def test_evict_lru(tmp_path):
+    local_storage = LocalStorage(tmp_path)
+    index = CacheIndex(local_storage, max_bytes=1000, low_water=0.5)
+    files = []
+    for n in range(12):
+        with patch('mezcal.index.time', return_value=float(n)):
+            file = add_file(local_storage, f'foo/{n}')
+            index.add(file)
+            files.append(file)
+    # make the two oldest files the most recently used
+    with patch('mezcal.index.time', return_value=100.0):
+        index.touch(files[0])
+        index.touch(files[1])
+
+    # evicts down to 500 bytes
+    assert index.evict() == 7
+    assert index.totals == (5, 500)
+    assert index.stats['evictions'] == 7
+    remaining = [file for file in files if file.exists]
+    assert remaining == [files[0], files[1], files[9], files[10], files[11]]
+
+
+def test_evict_lfu(tmp_path):
+    local_storage = LocalStorage(tmp_path)
+    index = CacheIndex(local_storage, max_files=2, policy=EvictionPolicy.LFU, low_water=1.0)
+    files = [add_file(local_storage, f'foo/{n}') for n in range(3)]
+    for file in files:
+        index.add(file)
+    for _ in range(3):
+        index.touch(files[0])
+    index.touch(files[2])
+
+    assert index.evict() == 1
+    assert not files[1].exists
+    assert files[0].exists
+    assert files[2].exists
+
+
+def test_evict_skips_locked_files(tmp_path):
+    local_storage = LocalStorage(tmp_path)
+    index = CacheIndex(local_storage, max_files=1, low_water=1.0)
+    for n in range(2):
+        index.add(add_file(local_storage, f'foo/{n}'))
+    with patch.object(DirectoryLock, 'acquire', side_effect=Timeout('foo')):
+        assert index.evict() == 0
+    assert index.totals == (2, 200)
+
+
+def test_evict_removes_entries_of_missing_files(tmp_path):
+    local_storage = LocalStorage(tmp_path)
+    index = CacheIndex(local_storage, max_files=1, low_water=1.0)
+    files = [add_file(local_storage, f'foo/{n}') for n in range(3)]
+    for file in files:
+        index.add(file)
+    # removed behind the index's back
+    files[0].path.unlink()
+    with patch.object(MezzanineFile, 'delete', side_effect=RuntimeError('Unable to remove resource')):
+        assert index.evict() == 0
+    # the entry of the missing file is gone, and the files that could not be deleted are kept
+    assert index.totals == (2, 200)
+    assert files[1].exists and files[2].exists
+
+
+def test_start_and_stop(tmp_path):
+    local_storage = LocalStorage(tmp_path)
+    add_file(local_storage, 'foo/1')
+    index = CacheIndex(local_storage)
+    index.start(interval=60)
+    index.stop()
+    # the index was rebuilt in the background thread
+    assert index.totals == (1, 100)
+
+
+def test_app_updates_index(make_client, datadir, tmp_path):
+    local_storage = LocalStorage(storage_dir=datadir)
+    index = CacheIndex(local_storage, max_files=10, db_path=tmp_path / 'index.sqlite')
+    index.rebuild()
+    client = make_client(local_storage=local_storage, cache_index=index)
+    assert client.get('/images/foo').status_code == 200
+    index.flush()
+    assert client.get('/stats').json['cache']['files'] == 1
+    assert client.delete('/images/foo').status_code == 204
+    assert client.get('/stats').json['cache']['files'] == 0
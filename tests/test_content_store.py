@@ -0,0 +1,116 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from mezcal.storage import LocalStorage, DirectoryLayout, OBJECTS_DIRNAME, digest_source
+
+
+@pytest.fixture
+def local_storage(tmp_path):
+    return LocalStorage(tmp_path, DirectoryLayout.CONTENT_ADDRESSED)
+
+
+def make_source(color='red') -> BytesIO:
+    source = BytesIO()
+    Image.new('RGB', (40, 30), color).save(source, format='PNG')
+    source.seek(0)
+    return source
+
+
+def test_digest_source(tmp_path):
+    source = make_source()
+    digest = digest_source(source)
+    assert digest.startswith('sha-256-')
+    # the source can still be read from the start
+    assert source.tell() == 0
+    path = tmp_path / 'source.png'
+    path.write_bytes(source.getvalue())
+    assert digest_source(path) == digest
+
+
+def test_same_source_is_stored_once(local_storage):
+    foo = local_storage.get_file('foo')
+    bar = local_storage.get_file('bar')
+    assert foo.create(make_source()) is not None
+    # linked, not encoded
+    assert bar.create(make_source()) is None
+
+    assert foo.path.samefile(bar.path)
+    # one link in the store, and one for each path
+    assert foo.path.stat().st_nlink == 3
+    assert foo.info().etag == bar.info().etag
+    assert foo.read_metadata()['digest'] == bar.read_metadata()['digest']
+    assert local_storage.store.stats == {'linked': 1, 'added': 1, 'released': 0}
+
+
+def test_different_sources_are_stored_separately(local_storage):
+    foo = local_storage.get_file('foo')
+    bar = local_storage.get_file('bar')
+    foo.create(make_source('red'))
+    bar.create(make_source('blue'))
+    assert not foo.path.samefile(bar.path)
+    assert foo.path.stat().st_nlink == 2
+
+
+def test_delete_keeps_stored_file_until_last_link(local_storage):
+    foo = local_storage.get_file('foo')
+    bar = local_storage.get_file('bar')
+    foo.create(make_source())
+    bar.create(make_source())
+    stored = local_storage.store.get_file(foo.read_metadata()['digest'], foo.path.name)
+
+    foo.delete()
+    assert not foo.exists
+    assert stored.exists
+    assert bar.path.stat().st_nlink == 2
+
+    bar.delete()
+    assert not bar.exists
+    assert not stored.exists
+    assert not stored.path.parent.exists()
+    assert local_storage.store.stats['released'] == 1
+
+
+def test_replace_releases_old_stored_file(local_storage):
+    foo = local_storage.get_file('foo')
+    foo.create(make_source('red'))
+    old = local_storage.store.get_file(foo.read_metadata()['digest'], foo.path.name)
+    foo.create(make_source('blue'))
+    assert not old.exists
+    assert foo.path.stat().st_nlink == 2
+
+
+def test_origin_digest_skips_encoding(local_storage):
+    foo = local_storage.get_file('foo')
+    bar = local_storage.get_file('bar')
+    foo.create(make_source(), digest='sha-1-0123456789abcdef')
+    assert bar.link_stored('sha-1-0123456789abcdef')
+    assert foo.path.samefile(bar.path)
+    assert not local_storage.get_file('baz').link_stored('sha-1-fedcba9876543210')
+
+
+def test_size_variants_are_stored_separately(tmp_path):
+    local_storage = LocalStorage(tmp_path, DirectoryLayout.CONTENT_ADDRESSED, sizes=[10])
+    full = local_storage.get_file('foo')
+    small = local_storage.get_file('bar', size=10)
+    full.create(make_source())
+    small.create(make_source())
+    assert not full.path.samefile(small.path)
+    with Image.open(small.path) as img:
+        assert max(img.size) == 10
+
+
+def test_link_stored_without_store(tmp_path):
+    assert not LocalStorage(tmp_path).get_file('foo').link_stored('sha-1-0123456789abcdef')
+
+
+def test_objects_dir(local_storage):
+    file = local_storage.get_file('foo')
+    file.create(make_source())
+    digest = file.read_metadata()['digest']
+    hex_digest = digest.rsplit('-', 1)[-1]
+    stored = local_storage.store.get_file(digest, 'image.jpg')
+    assert stored.path == (
+        local_storage.storage_dir / OBJECTS_DIRNAME / hex_digest[:2] / hex_digest[2:4] / digest / 'image.jpg'
+    )
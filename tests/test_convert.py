@@ -0,0 +1,100 @@
+import sys
+from struct import unpack
+
+import pytest
+from PIL import Image
+
+from mezcal.convert import convert_to_jpeg_mode, convert_16_bit_to_L, UnsupportedModeError
+
+# 16-bit sample values covering the full range, including both extremes
+SAMPLES_16_BIT = [0, 255, 256, 4095, 32767, 32768, 65280, 65535]
+
+
+def get_byte_order(mode: str) -> str:
+    if mode == 'I;16N':
+        return '>' if sys.byteorder == 'big' else '<'
+    return '>' if mode == 'I;16B' else '<'
+
+
+def make_16_bit_image(mode: str) -> Image.Image:
+    byte_order = get_byte_order(mode)
+    img = Image.new(mode, (len(SAMPLES_16_BIT), 1))
+    data = b''.join(value.to_bytes(2, 'big' if byte_order == '>' else 'little') for value in SAMPLES_16_BIT)
+    img.frombytes(data)
+    return img
+
+
+@pytest.mark.parametrize('mode', ['I;16', 'I;16L', 'I;16B', 'I;16N'])
+def test_convert_16_bit_to_L(mode):
+    img = make_16_bit_image(mode)
+    converted = convert_16_bit_to_L(img)
+    assert converted.mode == 'L'
+    assert converted.size == img.size
+    # should match the original per-pixel struct.unpack implementation
+    byte_order = get_byte_order(mode)
+    expected = [int(pixel / 256) for pixel in unpack(f'{byte_order}{len(SAMPLES_16_BIT)}H', img.tobytes())]
+    assert list(converted.getdata()) == expected
+
+
+@pytest.mark.parametrize(
+    ('mode', 'expected_mode'),
+    [
+        ('L', 'L'),
+        ('RGB', 'RGB'),
+        ('CMYK', 'CMYK'),
+        ('1', 'L'),
+        ('LA', 'L'),
+        ('I', 'L'),
+        ('F', 'L'),
+        ('I;16', 'L'),
+        ('I;16B', 'L'),
+        ('I;16N', 'L'),
+        ('P', 'RGB'),
+        ('PA', 'RGB'),
+        ('RGBA', 'RGB'),
+        ('RGBX', 'RGB'),
+    ]
+)
+def test_convert_to_jpeg_mode(mode, expected_mode):
+    img = Image.new(mode, (4, 4))
+    assert convert_to_jpeg_mode(img).mode == expected_mode
+
+
+def test_convert_supported_mode_is_unchanged():
+    img = Image.new('RGB', (4, 4))
+    assert convert_to_jpeg_mode(img) is img
+
+
+def test_convert_I_scales_16_bit_values():
+    img = Image.new('I', (2, 1))
+    img.putdata([0, 65535])
+    assert list(convert_to_jpeg_mode(img).getdata()) == [0, 255]
+
+
+def test_convert_I_keeps_8_bit_values():
+    img = Image.new('I', (2, 1))
+    img.putdata([0, 200])
+    assert list(convert_to_jpeg_mode(img).getdata()) == [0, 200]
+
+
+def test_convert_F_stretches_range():
+    img = Image.new('F', (3, 1))
+    img.putdata([-1.0, 0.0, 1.0])
+    assert list(convert_to_jpeg_mode(img).getdata()) == [0, 127, 255]
+
+
+def test_convert_palette_with_transparency():
+    img = Image.new('P', (2, 1))
+    img.putpalette([255, 0, 0, 0, 0, 255])
+    img.putdata([0, 1])
+    img.info['transparency'] = 1
+    converted = convert_to_jpeg_mode(img)
+    assert converted.mode == 'RGB'
+    assert converted.getpixel((0, 0)) == (255, 0, 0)
+
+
+def test_convert_unsupported_mode():
+    img = Image.new('I;16', (2, 1))
+    img.mode = 'I;16S'
+    with pytest.raises(UnsupportedModeError):
+        convert_to_jpeg_mode(img)
@@ -0,0 +1,68 @@
+from http import HTTPStatus
+from pathlib import Path
+
+import pytest
+
+from mezcal.delivery import DeliveryMode, ProxyDelivery, get_delivery_mode
+
+
+@pytest.mark.parametrize(
+    ('name', 'expected'),
+    [
+        ('x-accel-redirect', DeliveryMode.X_ACCEL_REDIRECT),
+        ('X_SENDFILE', DeliveryMode.X_SENDFILE),
+    ]
+)
+def test_get_delivery_mode(name, expected):
+    assert get_delivery_mode(name) == expected
+
+
+def test_unknown_delivery_mode():
+    with pytest.raises(RuntimeError):
+        get_delivery_mode('carrier-pigeon')
+
+
+def test_x_accel_redirect_requires_prefix():
+    with pytest.raises(RuntimeError):
+        ProxyDelivery(DeliveryMode.X_ACCEL_REDIRECT, Path('/cache'))
+
+
+@pytest.mark.parametrize(
+    ('mode', 'prefix', 'expected'),
+    [
+        (DeliveryMode.X_ACCEL_REDIRECT, '/_mezcal/', '/_mezcal/foo%20bar/image.jpg'),
+        (DeliveryMode.X_SENDFILE, '', '/cache/foo bar/image.jpg'),
+        (DeliveryMode.X_SENDFILE, '/mnt/cache', '/mnt/cache/foo bar/image.jpg'),
+    ]
+)
+def test_get_location(mode, prefix, expected):
+    delivery = ProxyDelivery(mode, Path('/cache'), prefix)
+    assert delivery.get_location(Path('/cache/foo bar/image.jpg')) == expected
+
+
+@pytest.fixture
+def test_client(make_client, datadir):
+    return make_client(delivery=ProxyDelivery(DeliveryMode.X_ACCEL_REDIRECT, datadir, '/_mezcal'))
+
+
+def test_resource_handed_to_proxy(test_client):
+    response = test_client.get('/images/foo')
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers['X-Accel-Redirect'] == '/_mezcal/foo/image.jpg'
+    assert response.content_type == 'image/jpeg'
+    assert response.headers['ETag']
+    assert response.data == b''
+
+
+def test_conditional_answered_here(test_client):
+    etag = test_client.get('/images/foo').headers['ETag']
+    response = test_client.get('/images/foo', headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+    assert 'X-Accel-Redirect' not in response.headers
+
+
+def test_head_answered_here(test_client, datadir):
+    response = test_client.head('/images/foo')
+    assert response.status_code == HTTPStatus.OK
+    assert 'X-Accel-Redirect' not in response.headers
+    assert response.content_length == (datadir / 'foo/image.jpg').stat().st_size
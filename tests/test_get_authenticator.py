@@ -1,9 +1,14 @@
+from unittest.mock import patch
+
 import pytest
+from requests import Request
 from requests.auth import HTTPBasicAuth
 from requests_jwtauth import HTTPBearerAuth, JWTSecretAuth
 
-from mezcal.http import RepositoryAuthType
-from mezcal.web import get_authenticator
+import mezcal.web
+from mezcal.http import RepositoryAuthType, CachedJWTSecretAuth, OriginRepository
+from mezcal.storage import LocalStorage
+from mezcal.web import get_authenticator, get_auth_type, create_app
 
 
 def test_get_authenticator_none():
@@ -42,3 +47,48 @@ def test_get_authenticator_missing_env(monkeypatch):
     with pytest.raises(RuntimeError) as e:
         _auth = get_authenticator(RepositoryAuthType.JWT_TOKEN)
         assert str(e) == "Environment variable 'JWT_TOKEN' is not set"
+
+
+# base64url-encoded 256-bit key
+SECRET = 'c2VjcmV0LXNlY3JldC1zZWNyZXQtc2VjcmV0LXNlY3I'
+
+
+def test_jwt_secret_token_is_reused():
+    auth = CachedJWTSecretAuth(secret=SECRET, ttl=3600, expiration_buffer=60)
+    first = auth(Request()).headers['Authorization']
+    second = auth(Request()).headers['Authorization']
+    assert first.startswith('Bearer ')
+    assert first == second
+
+
+def test_jwt_secret_token_is_renewed_before_expiration():
+    auth = CachedJWTSecretAuth(secret=SECRET, ttl=3600, expiration_buffer=60)
+    with patch('mezcal.http.time', return_value=1000.0):
+        first = auth(Request()).headers['Authorization']
+    # still outside the expiration buffer
+    with patch('mezcal.http.time', return_value=1000.0 + 3600 - 61):
+        assert auth(Request()).headers['Authorization'] == first
+    # inside the expiration buffer
+    with patch('mezcal.http.time', return_value=1000.0 + 3600 - 59):
+        assert auth(Request()).headers['Authorization'] != first
+
+
+def test_get_auth_type():
+    assert get_auth_type('jwt_secret') == RepositoryAuthType.JWT_SECRET
+
+
+def test_get_auth_type_unknown():
+    with pytest.raises(RuntimeError) as e:
+        get_auth_type('foo')
+    assert str(e.value) == "'FOO' is not a recognized authentication type"
+
+
+def test_create_app_builds_authenticator_once(monkeypatch, tmp_path):
+    monkeypatch.setenv('AUTH_TYPE', 'JWT_TOKEN')
+    monkeypatch.setenv('JWT_TOKEN', 'token')
+    with patch.object(mezcal.web, 'get_authenticator', wraps=get_authenticator) as mock_get_authenticator:
+        create_app(
+            origin_repo=OriginRepository(base_url='http://example.org/repo/'),
+            local_storage=LocalStorage(storage_dir=tmp_path),
+        )
+    mock_get_authenticator.assert_called_once_with(RepositoryAuthType.JWT_TOKEN)
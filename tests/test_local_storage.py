@@ -1,14 +1,15 @@
 import io
 import logging
+from hashlib import md5
 from pathlib import Path
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import PIL
 import pytest
 from PIL.Image import Image
-from filelock import FileLock
 
-from mezcal.storage import LocalStorage, DirectoryLayout
+from mezcal.locks import DirectoryLock
+from mezcal.storage import LocalStorage, DirectoryLayout, ImageFormat, EncodingOptions, MezzanineFile
 
 
 def test_unknown_directory_layout():
@@ -23,6 +24,7 @@ def test_unknown_directory_layout():
         (DirectoryLayout.BASIC, '/foo/bar/1'),
         (DirectoryLayout.MD5_ENCODED, '/foo/79693ef14b88881ffa7c1f69787a7f91'),
         (DirectoryLayout.MD5_ENCODED_PAIRTREE, '/foo/79/69/3e/79693ef14b88881ffa7c1f69787a7f91'),
+        (DirectoryLayout.CONTENT_ADDRESSED, '/foo/79/69/3e/79693ef14b88881ffa7c1f69787a7f91'),
     ]
 )
 def test_get_dir(layout, expected):
@@ -43,7 +45,7 @@ def test_get_file_lock(tmp_path):
     file = local_storage.get_file('bar/1')
     assert str(file.lock_path) == str(tmp_path / 'bar/1.lock')
     lock = file.lock
-    assert isinstance(lock, FileLock)
+    assert isinstance(lock, DirectoryLock)
 
 
 @pytest.mark.parametrize(
@@ -53,7 +55,8 @@ def test_get_file_lock(tmp_path):
         ('RGB', 0, 1),
         # modes that require conversion
         ('RGBA', 1, 1),
-        ('I;16', 1, 1),
+        ('LA', 1, 1),
+        ('RGBX', 1, 1),
     ]
 )
 def test_image_convert_mock(monkeypatch, tmp_path, mode, expected_convert_calls, expected_save_calls):
@@ -136,3 +139,176 @@ def test_delete_error(monkeypatch, tmp_path):
     monkeypatch.setattr(Path, 'rmdir', mock_rmdir)
     with pytest.raises(RuntimeError):
         file.delete()
+
+
+def test_create_leaves_no_temp_files(tmp_path, datadir):
+    local_storage = LocalStorage(tmp_path)
+    file = local_storage.get_file('bar/1')
+    with open(datadir / 'sample.tif', 'rb') as fh:
+        file.create(fh)
+    assert file.exists
+    assert file.temp_files == []
+    assert sorted(file.path.parent.iterdir()) == [file.path, file.metadata_path]
+
+
+def test_create_records_etag(tmp_path, datadir):
+    local_storage = LocalStorage(tmp_path)
+    file = local_storage.get_file('bar/1')
+    with open(datadir / 'sample.tif', 'rb') as fh:
+        file.create(fh)
+    info = file.info()
+    assert info.etag == md5(file.path.read_bytes()).hexdigest()
+    assert info.size == file.path.stat().st_size
+
+
+def test_info_without_metadata(tmp_path, datadir):
+    local_storage = LocalStorage(tmp_path)
+    file = local_storage.get_file('bar/1')
+    with open(datadir / 'sample.tif', 'rb') as fh:
+        file.create(fh)
+    file.metadata_path.unlink()
+    stat = file.path.stat()
+    assert file.info().etag == f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+
+def test_info_caches_etag(tmp_path, datadir):
+    local_storage = LocalStorage(tmp_path)
+    file = local_storage.get_file('bar/1')
+    with open(datadir / 'sample.tif', 'rb') as fh:
+        file.create(fh)
+    etag = file.info().etag
+    with patch.object(MezzanineFile, 'read_metadata') as mock_read_metadata:
+        assert local_storage.get_file('bar/1').info().etag == etag
+    mock_read_metadata.assert_not_called()
+    # a replaced file is a new inode, so its ETag is read again
+    with open(datadir / 'sample.tif', 'rb') as fh:
+        file.publish(PIL.Image.open(fh).convert('L'))
+    assert file.info().etag == md5(file.path.read_bytes()).hexdigest() != etag
+
+
+def test_info_not_found(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        LocalStorage(tmp_path).get_file('bar/1').info()
+
+
+def test_delete_removes_metadata(tmp_path, datadir):
+    local_storage = LocalStorage(tmp_path)
+    file = local_storage.get_file('bar/1')
+    with open(datadir / 'sample.tif', 'rb') as fh:
+        file.create(fh)
+    file.delete()
+    assert not file.metadata_path.exists()
+    assert not file.path.parent.exists()
+
+
+def test_failed_create_leaves_no_file(monkeypatch, tmp_path):
+    mock_fh = MagicMock(spec=io.FileIO)
+    mock_image = MagicMock(spec=Image)
+    mock_image.mode = 'RGB'
+    mock_image.save = MagicMock(side_effect=OSError)
+    monkeypatch.setattr(PIL.Image, 'open', lambda *_: mock_image)
+
+    local_storage = LocalStorage(tmp_path)
+    file = local_storage.get_file('bar/1')
+    with pytest.raises(RuntimeError):
+        file.create(mock_fh)
+    assert not file.exists
+    assert file.temp_files == []
+
+
+def test_delete_removes_temp_files(tmp_path):
+    local_storage = LocalStorage(tmp_path)
+    file = local_storage.get_file('bar/1')
+    file.path.parent.mkdir(parents=True)
+    (file.path.parent / '.image.jpg.abc123.tmp').write_bytes(b'partial')
+    file.delete()
+    assert not file.path.parent.exists()
+
+
+def test_get_file_format(tmp_path):
+    local_storage = LocalStorage(tmp_path, formats=['jpeg', 'tiff'])
+    assert local_storage.get_file('bar/1').path == tmp_path / 'bar/1/image.jpg'
+    tiff_file = local_storage.get_file('bar/1', ImageFormat.TIFF)
+    assert tiff_file.path == tmp_path / 'bar/1/image.tif'
+    assert tiff_file.format == ImageFormat.TIFF
+
+
+def test_get_format(tmp_path):
+    local_storage = LocalStorage(tmp_path, formats=['tiff'])
+    assert local_storage.get_format() == ImageFormat.TIFF
+    assert local_storage.get_format('TIFF') == ImageFormat.TIFF
+    with pytest.raises(RuntimeError):
+        local_storage.get_format('jpeg')
+    with pytest.raises(RuntimeError):
+        local_storage.get_format('png')
+
+
+def test_invalid_format(tmp_path):
+    with pytest.raises(RuntimeError):
+        LocalStorage(tmp_path, formats=['gif'])
+
+
+def test_create_tiff(tmp_path, datadir):
+    file = LocalStorage(tmp_path, formats=['tiff']).get_file('bar/1')
+    with open(datadir / 'sample.tif', 'rb') as fh:
+        file.create(fh)
+    with PIL.Image.open(file.path) as img:
+        assert img.format == 'TIFF'
+        assert 322 in img.tag_v2
+    assert file.info().etag == md5(file.path.read_bytes()).hexdigest()
+
+
+def test_delete_keeps_other_formats(tmp_path, datadir):
+    local_storage = LocalStorage(tmp_path, formats=['jpeg', 'tiff'])
+    jpeg_file = local_storage.get_file('bar/1', ImageFormat.JPEG)
+    tiff_file = local_storage.get_file('bar/1', ImageFormat.TIFF)
+    for file in (jpeg_file, tiff_file):
+        with open(datadir / 'sample.tif', 'rb') as fh:
+            file.create(fh)
+    jpeg_file.delete()
+    assert not jpeg_file.exists
+    assert tiff_file.exists
+    tiff_file.delete()
+    assert not tiff_file.path.parent.exists()
+
+
+def test_get_file_size_variant(tmp_path):
+    local_storage = LocalStorage(tmp_path, formats=['jpeg', 'tiff'], sizes=[1024])
+    file = local_storage.get_file('bar/1', ImageFormat.TIFF, size=1024)
+    assert file.path == tmp_path / 'bar/1/image-1024.tif'
+    assert file.format == ImageFormat.TIFF
+    assert file.size == 1024
+    assert local_storage.get_file('bar/1').size is None
+
+
+def test_get_size(tmp_path):
+    local_storage = LocalStorage(tmp_path, sizes=[1024])
+    assert local_storage.get_size() is None
+    assert local_storage.get_size('1024') == 1024
+    with pytest.raises(RuntimeError):
+        local_storage.get_size('512')
+    with pytest.raises(RuntimeError):
+        local_storage.get_size('large')
+
+
+def test_create_max_size(tmp_path):
+    local_storage = LocalStorage(tmp_path, options=EncodingOptions(max_size=1000), sizes=[100])
+    source = io.BytesIO()
+    PIL.Image.new('RGB', (4000, 2000)).save(source, format='JPEG')
+    for size, expected in ((None, (1000, 500)), (100, (100, 50))):
+        file = local_storage.get_file('bar/1', size=size)
+        source.seek(0)
+        file.create(source)
+        with PIL.Image.open(file.path) as img:
+            assert img.size == expected
+
+
+def test_get_files_includes_size_variants(tmp_path, datadir):
+    local_storage = LocalStorage(tmp_path, sizes=[100])
+    file = local_storage.get_file('bar/1', size=100)
+    with open(datadir / 'sample.tif', 'rb') as fh:
+        file.create(fh)
+    assert file.path in [f.path for f in local_storage.get_files('bar/1')]
+    for f in local_storage.get_files('bar/1'):
+        f.delete()
+    assert not file.path.parent.exists()
@@ -0,0 +1,152 @@
+from pathlib import Path
+from threading import Thread
+from unittest.mock import patch
+
+import pytest
+from filelock import Timeout
+
+from mezcal.locks import LockManager, DirectoryLock, DirectoryLockManager, ShardedLockManager, LeaseLockManager
+from mezcal.server import get_lock_manager
+from mezcal.storage import LocalStorage
+
+
+def test_directory_lock_path(tmp_path):
+    lock_manager = DirectoryLockManager()
+    assert lock_manager.get_lock_path(tmp_path / 'foo/bar/image.jpg') == tmp_path / 'foo/bar.lock'
+    assert isinstance(lock_manager.get_lock(tmp_path / 'foo/bar/image.jpg'), DirectoryLock)
+    assert (tmp_path / 'foo').is_dir()
+
+
+def test_lock_manager_is_abstract():
+    with pytest.raises(TypeError):
+        LockManager()
+
+
+def test_directory_lock_removed_on_release(tmp_path):
+    lock_manager = DirectoryLockManager()
+    lock = lock_manager.get_lock(tmp_path / 'foo/bar/image.jpg')
+    with lock.acquire(timeout=1):
+        assert lock.is_locked
+        assert (tmp_path / 'foo/bar.lock').exists()
+        with pytest.raises(Timeout):
+            lock_manager.get_lock(tmp_path / 'foo/bar/image.jpg').acquire(timeout=0)
+    assert not lock.is_locked
+    assert list((tmp_path / 'foo').iterdir()) == []
+
+
+def test_directory_lock_waiter_relocks_new_file(tmp_path):
+    lock_manager = DirectoryLockManager(poll_interval=0.01)
+    path = tmp_path / 'foo/bar/image.jpg'
+    lock = lock_manager.get_lock(path).acquire(timeout=1)
+    waiter = lock_manager.get_lock(path)
+    thread = Thread(target=waiter.acquire, kwargs={'timeout': 5})
+    thread.start()
+    # removes the lock file that the waiter has been trying to lock
+    lock.release()
+    thread.join()
+    assert waiter.is_locked
+    # the waiter holds the lock on the file that is at the lock path now
+    with pytest.raises(Timeout):
+        lock_manager.get_lock(path).acquire(timeout=0)
+    waiter.release()
+    assert not (tmp_path / 'foo/bar.lock').exists()
+
+
+def test_sharded_lock_paths(tmp_path):
+    lock_manager = ShardedLockManager(tmp_path / 'locks', shards=4)
+    lock_paths = {lock_manager.get_lock_path(Path(f'/cache/{n}/image.jpg')) for n in range(100)}
+    assert len(lock_paths) == 4
+    assert all(lock_path.parent == tmp_path / 'locks' for lock_path in lock_paths)
+    # the same path always gets the same lock
+    path = Path('/cache/1/image.jpg')
+    assert lock_manager.get_lock_path(path) == lock_manager.get_lock_path(path)
+
+
+def test_sharded_lock_files_are_bounded(tmp_path):
+    lock_manager = ShardedLockManager(tmp_path / 'locks', shards=2)
+    for n in range(20):
+        with lock_manager.get_lock(Path(f'/cache/{n}/image.jpg')).acquire(timeout=1):
+            pass
+    assert len(list((tmp_path / 'locks').iterdir())) <= 2
+
+
+def test_sharded_cleanup(tmp_path):
+    (tmp_path / 'locks').mkdir()
+    (tmp_path / 'locks' / '0000.lock').touch()
+    (tmp_path / 'locks' / '0005.lock').touch()
+    ShardedLockManager(tmp_path / 'locks', shards=2).cleanup()
+    assert [p.name for p in (tmp_path / 'locks').iterdir()] == ['0000.lock']
+
+
+def test_sharded_invalid_shards(tmp_path):
+    with pytest.raises(RuntimeError):
+        ShardedLockManager(tmp_path, shards=0)
+
+
+def test_lease_lock(tmp_path):
+    lock_manager = LeaseLockManager(tmp_path / 'leases.sqlite')
+    lock = lock_manager.get_lock(Path('/cache/foo/image.jpg'))
+    with lock.acquire(timeout=1):
+        assert lock.is_locked
+        other = lock_manager.get_lock(Path('/cache/foo/image.jpg'))
+        with pytest.raises(Timeout):
+            other.acquire(timeout=0)
+        # a different path is not blocked
+        with lock_manager.get_lock(Path('/cache/bar/image.jpg')).acquire(timeout=0):
+            pass
+    assert not lock.is_locked
+    with lock_manager.get_lock(Path('/cache/foo/image.jpg')).acquire(timeout=0):
+        pass
+
+
+def test_lease_lock_expires(tmp_path):
+    lock_manager = LeaseLockManager(tmp_path / 'leases.sqlite', ttl=10)
+    with patch('mezcal.locks.time', return_value=1000.0):
+        # simulate a process that acquired the lock and then hung
+        lock_manager.get_lock(Path('/cache/foo/image.jpg')).acquire(timeout=0)
+        with pytest.raises(Timeout):
+            lock_manager.get_lock(Path('/cache/foo/image.jpg')).acquire(timeout=0)
+    with patch('mezcal.locks.time', return_value=1011.0):
+        with lock_manager.get_lock(Path('/cache/foo/image.jpg')).acquire(timeout=0):
+            pass
+
+
+def test_lease_cleanup(tmp_path):
+    lock_manager = LeaseLockManager(tmp_path / 'leases.sqlite', ttl=10)
+    with patch('mezcal.locks.time', return_value=1000.0):
+        lock_manager.get_lock(Path('/cache/foo/image.jpg')).acquire(timeout=0)
+    with patch('mezcal.locks.time', return_value=1011.0):
+        assert lock_manager.cleanup() == 1
+
+
+def test_storage_uses_lock_manager(tmp_path, datadir):
+    lock_manager = ShardedLockManager(tmp_path / 'locks', shards=8)
+    local_storage = LocalStorage(tmp_path / 'cache', lock_manager=lock_manager)
+    file = local_storage.get_file('bar/1')
+    assert file.lock_path.parent == tmp_path / 'locks'
+    with file.lock.acquire(timeout=1):
+        with open(datadir / 'sample.tif', 'rb') as fh:
+            file.create(fh)
+    file.delete()
+    # no lock file was left next to the cached directory
+    assert list((tmp_path / 'cache').rglob('*.lock')) == []
+
+
+@pytest.mark.parametrize(
+    ('backend', 'expected_class'),
+    [
+        ('directory', DirectoryLockManager),
+        ('sharded', ShardedLockManager),
+        ('lease', LeaseLockManager),
+    ]
+)
+def test_get_lock_manager(monkeypatch, tmp_path, backend, expected_class):
+    monkeypatch.setenv('LOCK_BACKEND', backend)
+    monkeypatch.delenv('LOCK_DIR', raising=False)
+    assert isinstance(get_lock_manager(tmp_path), expected_class)
+
+
+def test_get_lock_manager_unknown(monkeypatch, tmp_path):
+    monkeypatch.setenv('LOCK_BACKEND', 'foo')
+    with pytest.raises(RuntimeError):
+        get_lock_manager(tmp_path)
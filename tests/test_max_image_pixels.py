@@ -1,10 +1,22 @@
 from importlib import reload
 
 import PIL.Image
+import pytest
 
 import mezcal.storage
 
 
+@pytest.fixture(autouse=True)
+def restore_modules():
+    # reloading replaces the module globals (such as Pillow's plugin registry
+    # and the DirectoryLayout enum) that other modules and tests already hold
+    # references to, so put the originals back afterwards
+    saved = {module: dict(vars(module)) for module in (PIL.Image, mezcal.storage)}
+    yield
+    for module, module_vars in saved.items():
+        vars(module).update(module_vars)
+
+
 def test_max_image_pixels(monkeypatch):
     monkeypatch.setenv('MAX_IMAGE_PIXELS', '1024')
     reload(PIL.Image)
@@ -0,0 +1,116 @@
+from http import HTTPStatus
+from unittest.mock import patch
+
+import pytest
+
+from mezcal.memory import MemoryCache
+from mezcal.server import get_memory_cache
+from mezcal.storage import MezzanineFile
+
+
+def make_file(tmp_path, name, size):
+    path = tmp_path / name / 'image.jpg'
+    path.parent.mkdir(parents=True)
+    path.write_bytes(b'x' * size)
+    return MezzanineFile(path)
+
+
+def test_load_and_get(tmp_path):
+    memory_cache = MemoryCache(max_bytes=100)
+    file = make_file(tmp_path, 'a', 10)
+    assert memory_cache.get(file) is None
+    assert memory_cache.load(file, file.info()) == b'x' * 10
+    info, data = memory_cache.get(file)
+    assert data == b'x' * 10
+    assert info.etag == file.info().etag
+    assert memory_cache.stats == {'files': 1, 'bytes': 10, 'max_bytes': 100, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_get_memory_cache_shared_by_workers(monkeypatch):
+    monkeypatch.setenv('MEMORY_CACHE_MAX_BYTES', '1000')
+    assert get_memory_cache().max_bytes == 1000
+    assert get_memory_cache(workers=4).max_bytes == 250
+    monkeypatch.setenv('MEMORY_CACHE_MAX_BYTES', '0')
+    assert get_memory_cache(workers=4) is None
+
+
+def test_evicts_least_recently_used(tmp_path):
+    memory_cache = MemoryCache(max_bytes=25)
+    files = [make_file(tmp_path, name, 10) for name in 'abc']
+    memory_cache.load(files[0], files[0].info())
+    memory_cache.load(files[1], files[1].info())
+    memory_cache.get(files[0])
+    memory_cache.load(files[2], files[2].info())
+    assert memory_cache.get(files[1]) is None
+    assert memory_cache.get(files[0]) is not None
+    assert memory_cache.stats['evictions'] == 1
+    assert memory_cache.stats['bytes'] == 20
+
+
+def test_large_file_not_cached(tmp_path):
+    memory_cache = MemoryCache(max_bytes=100, max_file_size=5)
+    file = make_file(tmp_path, 'a', 10)
+    assert memory_cache.load(file, file.info()) is None
+    assert memory_cache.get(file) is None
+
+
+def test_max_age(tmp_path):
+    memory_cache = MemoryCache(max_bytes=100, max_age=-1)
+    file = make_file(tmp_path, 'a', 10)
+    memory_cache.load(file, file.info())
+    assert memory_cache.get(file) is None
+    assert memory_cache.stats['bytes'] == 0
+
+
+def test_invalidate(tmp_path):
+    memory_cache = MemoryCache(max_bytes=100)
+    file = make_file(tmp_path, 'a', 10)
+    memory_cache.load(file, file.info())
+    memory_cache.invalidate(file)
+    assert memory_cache.get(file) is None
+
+
+@pytest.fixture
+def memory_cache():
+    return MemoryCache(max_bytes=1024 * 1024)
+
+
+@pytest.fixture
+def test_client(make_client, memory_cache):
+    return make_client(memory_cache=memory_cache)
+
+
+def test_resource_from_memory(test_client, memory_cache, datadir):
+    first = test_client.get('/images/foo')
+    with patch.object(MezzanineFile, 'info', side_effect=AssertionError('storage was accessed')):
+        second = test_client.get('/images/foo')
+    assert second.status_code == HTTPStatus.OK
+    assert second.data == first.data == (datadir / 'foo/image.jpg').read_bytes()
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert second.content_type == 'image/jpeg'
+    assert memory_cache.stats['hits'] == 1
+
+
+def test_resource_from_memory_conditional(test_client):
+    etag = test_client.get('/images/foo').headers['ETag']
+    response = test_client.get('/images/foo', headers={'If-None-Match': etag})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+
+def test_resource_from_memory_range(test_client, datadir):
+    test_client.get('/images/foo')
+    response = test_client.get('/images/foo', headers={'Range': 'bytes=0-9'})
+    assert response.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert response.data == (datadir / 'foo/image.jpg').read_bytes()[:10]
+
+
+def test_delete_invalidates_memory(test_client, memory_cache):
+    test_client.get('/images/foo')
+    assert memory_cache.stats['files'] == 1
+    test_client.delete('/images/foo')
+    assert memory_cache.stats['files'] == 0
+
+
+def test_stats(test_client):
+    test_client.get('/images/foo')
+    assert test_client.get('/stats').json['memory']['files'] == 1
@@ -0,0 +1,143 @@
+import logging
+import os
+from http import HTTPStatus
+from unittest.mock import patch
+
+import pytest
+from filelock import Timeout
+
+from mezcal.locks import DirectoryLock
+from mezcal.metrics import (
+    Registry, Metric, Counter, Gauge, Histogram, Timer, CACHE_HITS, LOCK_TIMEOUTS, IMAGE_DECODE_SECONDS,
+)
+from mezcal.storage import LocalStorage
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter(registry):
+    counter = Counter('test_total', 'Test counter', ('result',), registry=registry)
+    hits = counter.labels('hit')
+    hits.inc()
+    hits.inc(2)
+    counter.labels('miss').inc()
+    assert registry.render() == (
+        '# HELP test_total Test counter\n'
+        '# TYPE test_total counter\n'
+        'test_total{result="hit"} 3\n'
+        'test_total{result="miss"} 1\n'
+    )
+
+
+def test_metric_is_abstract(registry):
+    with pytest.raises(TypeError):
+        Metric('test_total', 'Test metric', registry=registry)
+
+
+def test_unlabeled_metrics_are_reported_before_use(registry):
+    Counter('test_total', 'Test counter', registry=registry)
+    assert 'test_total 0\n' in registry.render()
+
+
+def test_wrong_number_of_labels(registry):
+    counter = Counter('test_total', 'Test counter', ('result',), registry=registry)
+    with pytest.raises(ValueError):
+        counter.labels()
+
+
+def test_duplicate_metric(registry):
+    Counter('test_total', 'Test counter', registry=registry)
+    with pytest.raises(RuntimeError):
+        Counter('test_total', 'Test counter', registry=registry)
+
+
+def test_label_values_are_escaped(registry):
+    Counter('test_total', 'Test counter', ('mode',), registry=registry).labels('a"b\\c').inc()
+    assert 'test_total{mode="a\\"b\\\\c"} 1\n' in registry.render()
+
+
+def test_gauge(registry):
+    gauge = Gauge('test_in_flight', 'Test gauge', registry=registry)
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert 'test_in_flight 1\n' in registry.render()
+
+
+def test_histogram(registry):
+    histogram = Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1), registry=registry)
+    histogram.observe(0.05)
+    histogram.observe(0.1)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    output = registry.render()
+    assert 'test_seconds_bucket{le="0.1"} 2\n' in output
+    assert 'test_seconds_bucket{le="1"} 3\n' in output
+    assert 'test_seconds_bucket{le="+Inf"} 4\n' in output
+    assert 'test_seconds_sum 5.65\n' in output
+    assert 'test_seconds_count 4\n' in output
+
+
+def test_label_process():
+    registry = Registry(label_process=True)
+    Counter('test_total', 'Test counter', ('result',), registry=registry).labels('hit').inc()
+    Histogram('test_seconds', 'Test histogram', buckets=(1,), registry=registry).observe(0.5)
+    output = registry.render()
+    pid = os.getpid()
+    assert f'test_total{{result="hit",pid="{pid}"}} 1\n' in output
+    assert f'test_seconds_bucket{{pid="{pid}",le="1"}} 1\n' in output
+    assert f'test_seconds_count{{pid="{pid}"}} 1\n' in output
+
+
+def test_timer(registry, caplog):
+    histogram = Histogram('test_seconds', 'Test histogram', ('mode',), registry=registry)
+    logger = logging.getLogger('test_timer')
+    with caplog.at_level(logging.INFO, logger='test_timer'):
+        with Timer('do %s', 'something', histogram=histogram.labels('RGB'), logger=logger) as timer:
+            pass
+    assert timer.elapsed >= 0
+    assert 'test_seconds_count{mode="RGB"} 1\n' in registry.render()
+    assert 'Time to do something' in caplog.text
+
+
+def test_timer_formats_name_lazily(registry):
+    class Name:
+        def __str__(self):
+            raise AssertionError('name was formatted')
+
+    logger = logging.getLogger('test_timer_lazy')
+    logger.setLevel(logging.WARNING)
+    with Timer('do %s', Name(), logger=logger):
+        pass
+
+
+def test_metrics_endpoint(test_client):
+    hits = CACHE_HITS.value
+    assert test_client.get('/images/foo').status_code == HTTPStatus.OK
+    assert CACHE_HITS.value == hits + 1
+
+    response = test_client.get('/metrics')
+    assert response.status_code == HTTPStatus.OK
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    assert f'mezcal_cache_requests_total{{result="hit"}} {hits + 1}\n' in response.text
+    assert '# TYPE mezcal_image_request_seconds histogram\n' in response.text
+
+
+def test_lock_timeouts_are_counted(tmp_path):
+    timeouts = LOCK_TIMEOUTS.labels().value
+    local_file = LocalStorage(tmp_path).get_file('foo')
+    with patch.object(DirectoryLock, 'acquire', side_effect=Timeout('foo')):
+        with pytest.raises(Timeout):
+            local_file.acquire_lock(1)
+    assert LOCK_TIMEOUTS.labels().value == timeouts + 1
+
+
+def test_image_timings_are_recorded(tmp_path, datadir):
+    local_file = LocalStorage(tmp_path).get_file('foo')
+    with open(datadir / 'sample.tif', 'rb') as fh:
+        timings = local_file.create(fh)
+    assert IMAGE_DECODE_SECONDS.labels(timings.mode).count >= 1
+    assert timings.decode >= 0 and timings.convert >= 0 and timings.encode > 0
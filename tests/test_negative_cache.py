@@ -0,0 +1,109 @@
+from http import HTTPStatus
+from unittest.mock import patch
+
+import pytest
+
+from mezcal.http import OriginRepository, NotAnImageError, OriginStatusError
+from mezcal.negative import NegativeCache, NEGATIVE_DB_FILENAME
+from mezcal.storage import LocalStorage
+
+
+@pytest.fixture
+def negative_cache():
+    return NegativeCache(ttl=60)
+
+
+@pytest.fixture
+def test_client(make_client, tmp_path, negative_cache):
+    return make_client(local_storage=LocalStorage(storage_dir=tmp_path), negative_cache=negative_cache)
+
+
+def test_add_not_an_image(negative_cache):
+    entry = negative_cache.add('bar', NotAnImageError())
+    assert entry.error == 'NotAnImageError'
+    assert entry.status == HTTPStatus.BAD_REQUEST
+    assert entry.origin_status is None
+    assert negative_cache.get('bar') == entry
+
+
+def test_add_not_found(negative_cache):
+    entry = negative_cache.add('bar', OriginStatusError('Unable to retrieve resource', status=404))
+    assert entry.origin_status == 404
+    assert negative_cache.get('bar') == entry
+
+
+@pytest.mark.parametrize('error', [RuntimeError('oops'), OriginStatusError('Unable to retrieve resource', status=503)])
+def test_transient_errors_not_remembered(negative_cache, error):
+    assert negative_cache.add('bar', error) is None
+    assert negative_cache.get('bar') is None
+
+
+def test_expired():
+    negative_cache = NegativeCache(ttl=0)
+    negative_cache.add('bar', NotAnImageError())
+    assert negative_cache.get('bar') is None
+    assert negative_cache.stats['entries'] == 0
+
+
+def test_max_entries():
+    negative_cache = NegativeCache(ttl=60, max_entries=2)
+    for path in ('a', 'b', 'c'):
+        negative_cache.add(path, NotAnImageError())
+    assert negative_cache.get('a') is None
+    assert negative_cache.get('c') is not None
+
+
+def test_invalidate(negative_cache):
+    negative_cache.add('bar', NotAnImageError())
+    negative_cache.invalidate('bar')
+    assert negative_cache.get('bar') is None
+    assert negative_cache.stats['invalidated'] == 1
+
+
+def test_persisted(tmp_path):
+    local_storage = LocalStorage(tmp_path)
+    NegativeCache(ttl=60, local_storage=local_storage).add('bar/1', NotAnImageError())
+    assert (tmp_path / NEGATIVE_DB_FILENAME).exists()
+    # no per-path directory is created for a path that was never cached
+    assert not (tmp_path / 'bar').exists()
+    # another process using the same storage
+    other = NegativeCache(ttl=60, local_storage=local_storage)
+    assert other.get('bar/1').error == 'NotAnImageError'
+    other.invalidate('bar/1')
+    assert NegativeCache(ttl=60, local_storage=local_storage).get('bar/1') is None
+
+
+def test_persisted_expired_entries_removed(tmp_path):
+    local_storage = LocalStorage(tmp_path)
+    negative_cache = NegativeCache(ttl=-1, local_storage=local_storage)
+    for path in ('a', 'b', 'c'):
+        negative_cache.add(path, NotAnImageError())
+    # each add removes the entries that have already expired
+    assert negative_cache.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0] == 1
+
+
+def test_resource_failure_is_remembered(test_client, negative_cache):
+    with patch.object(OriginRepository, 'get', side_effect=NotAnImageError) as mock_get:
+        for _ in range(3):
+            response = test_client.get('/images/bar')
+            assert response.status_code == HTTPStatus.BAD_REQUEST
+            assert 'Requested resource is not an image' in response.text
+    assert mock_get.call_count == 1
+    assert negative_cache.stats['hits'] == 2
+    assert test_client.get('/stats').json['negative_cache']['entries'] == 1
+
+
+def test_resource_not_found_is_remembered(test_client):
+    error = OriginStatusError('Unable to retrieve resource', status=404)
+    with patch.object(OriginRepository, 'get', side_effect=error) as mock_get:
+        assert test_client.get('/images/bar').status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+        assert test_client.get('/images/bar').status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert mock_get.call_count == 1
+
+
+def test_delete_forgets_failure(test_client):
+    with patch.object(OriginRepository, 'get', side_effect=NotAnImageError) as mock_get:
+        test_client.get('/images/bar')
+        assert test_client.delete('/images/bar').status_code == HTTPStatus.NO_CONTENT
+        test_client.get('/images/bar')
+    assert mock_get.call_count == 2
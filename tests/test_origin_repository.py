@@ -1,7 +1,13 @@
+import base64
+from hashlib import sha1, sha256
+from io import BytesIO
+from pathlib import Path
+from threading import Thread
+
 import pytest
 import requests
 
-from mezcal.http import OriginRepository, NotAnImageError
+from mezcal.http import OriginRepository, NotAnImageError, OriginTooLargeError, get_origin_digest
 
 
 class MockOKResponse:
@@ -9,6 +15,9 @@ class MockOKResponse:
     status_code = 200
     reason = 'OK'
 
+    def close(self):
+        pass
+
 
 class NonImageResponse(MockOKResponse):
     headers = {'Content-Type': 'text/plain'}
@@ -23,6 +32,9 @@ class MockBadRequestResponse:
     status_code = 400
     reason = 'Bad Request'
 
+    def close(self):
+        pass
+
 
 def mock_request(response):
     def _request(*_args, **_kwargs):
@@ -31,14 +43,14 @@ def mock_request(response):
 
 
 def test_not_an_image(monkeypatch):
-    monkeypatch.setattr(requests, 'get', mock_request(response=NonImageResponse()))
+    monkeypatch.setattr(requests.Session, 'get', mock_request(response=NonImageResponse()))
     repo = OriginRepository('http://example.com/repo')
     with pytest.raises(NotAnImageError):
         repo.get('/foo')
 
 
 def test_image(monkeypatch):
-    monkeypatch.setattr(requests, 'get', mock_request(response=ImageResponse()))
+    monkeypatch.setattr(requests.Session, 'get', mock_request(response=ImageResponse()))
     repo = OriginRepository('http://example.com/repo')
     response = repo.get('/foo')
     assert response.ok
@@ -48,8 +60,147 @@ def test_image(monkeypatch):
 
 
 def test_origin_not_ok_response(monkeypatch):
-    monkeypatch.setattr(requests, 'get', mock_request(response=MockBadRequestResponse()))
+    monkeypatch.setattr(requests.Session, 'get', mock_request(response=MockBadRequestResponse()))
     repo = OriginRepository('http://example.com/repo')
     with pytest.raises(RuntimeError) as e:
         repo.get('/foo')
         assert str(e) == 'Unable to retrieve resource'
+
+
+def test_origin_connection_error(monkeypatch):
+    def _request(*_args, **_kwargs):
+        raise requests.exceptions.ConnectTimeout
+    monkeypatch.setattr(requests.Session, 'get', _request)
+    repo = OriginRepository('http://example.com/repo')
+    with pytest.raises(RuntimeError) as e:
+        repo.get('/foo')
+    assert str(e.value) == 'Unable to retrieve resource'
+
+
+class MockNotModifiedResponse(MockOKResponse):
+    status_code = 304
+    reason = 'Not Modified'
+    headers = {}
+
+
+def test_conditional_not_modified(monkeypatch):
+    calls = []
+
+    def _request(*_args, **kwargs):
+        calls.append(kwargs)
+        return MockNotModifiedResponse()
+    monkeypatch.setattr(requests.Session, 'get', _request)
+    repo = OriginRepository('http://example.com/repo')
+    response = repo.get('/foo', validators={'etag': '"v1"', 'last_modified': None})
+    assert response.status_code == 304
+    assert calls[0]['headers'] == {'If-None-Match': '"v1"'}
+
+
+def test_timeout_and_retry_config(monkeypatch):
+    calls = []
+
+    def _request(*_args, **kwargs):
+        calls.append(kwargs)
+        return ImageResponse()
+    monkeypatch.setattr(requests.Session, 'get', _request)
+    repo = OriginRepository('http://example.com/repo', connect_timeout=2, read_timeout=30, max_retries=4)
+    repo.get('/foo')
+    assert calls[0]['timeout'] == (2, 30)
+    assert calls[0]['stream']
+    assert repo.adapter.max_retries.total == 4
+    assert 503 in repo.adapter.max_retries.status_forcelist
+
+
+def test_sessions_are_per_thread_and_share_a_pool():
+    repo = OriginRepository('http://example.com/repo')
+    sessions = []
+    threads = [Thread(target=lambda: sessions.append(repo.session)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sessions[0] is not sessions[1]
+    assert repo.session is repo.session
+    for session in sessions:
+        assert session.get_adapter('http://example.com/repo') is repo.adapter
+
+
+def test_pool_stats():
+    repo = OriginRepository('http://example.com/repo', pool_size=5)
+    assert repo.pool_stats == {'size': 5, 'idle': 0, 'connections': 0, 'requests': 0}
+
+
+class BodyResponse(ImageResponse):
+    def __init__(self, body: bytes, content_length: bool = True):
+        self.raw = BytesIO(body)
+        self.headers = {**ImageResponse.headers}
+        if content_length:
+            self.headers['Content-Length'] = str(len(body))
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_spool_in_memory():
+    repo = OriginRepository('http://example.com/repo', spool_memory_limit=100)
+    response = BodyResponse(b'x' * 50)
+    with repo.spool('/foo', response) as body:
+        assert body.path is None
+        assert body.size == 50
+        assert body.source.read() == b'x' * 50
+    assert response.closed
+
+
+@pytest.mark.parametrize('content_length', [True, False])
+def test_spool_on_disk(tmp_path, content_length):
+    repo = OriginRepository('http://example.com/repo', spool_memory_limit=100, spool_dir=tmp_path)
+    with repo.spool('/foo', BodyResponse(b'x' * 150, content_length=content_length)) as body:
+        assert isinstance(body.source, Path)
+        assert body.source.parent == tmp_path
+        assert body.source.read_bytes() == b'x' * 150
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_spool_content_length_too_large():
+    repo = OriginRepository('http://example.com/repo', max_size=100)
+    response = BodyResponse(b'x' * 150)
+    with pytest.raises(OriginTooLargeError):
+        repo.spool('/foo', response)
+    assert response.closed
+    # should not have read any of the body
+    assert response.raw.tell() == 0
+
+
+def test_spool_body_too_large(tmp_path):
+    repo = OriginRepository('http://example.com/repo', max_size=100, spool_memory_limit=10, spool_dir=tmp_path)
+    response = BodyResponse(b'x' * 150, content_length=False)
+    with pytest.raises(OriginTooLargeError):
+        repo.spool('/foo', response)
+    assert response.closed
+    assert list(tmp_path.iterdir()) == []
+
+
+SHA256 = sha256(b'image').digest()
+SHA1 = sha1(b'image').digest()
+
+
+@pytest.mark.parametrize(
+    ('headers', 'expected'),
+    [
+        ({'Content-Digest': f'sha-256=:{base64.b64encode(SHA256).decode()}:'}, f'sha-256-{SHA256.hex()}'),
+        ({'Digest': f'SHA={base64.b64encode(SHA1).decode()}'}, f'sha-{SHA1.hex()}'),
+        # the strongest algorithm is used
+        (
+            {'Digest': f'sha={base64.b64encode(SHA1).decode()}, sha-256={base64.b64encode(SHA256).decode()}'},
+            f'sha-256-{SHA256.hex()}',
+        ),
+        # unknown algorithms, bad encodings, and digests of the wrong length are ignored
+        ({'Digest': 'unixsum=30637'}, None),
+        ({'Digest': 'sha-256=not base64!'}, None),
+        ({'Digest': f'sha-256={base64.b64encode(SHA1).decode()}'}, None),
+        ({}, None),
+    ]
+)
+def test_get_origin_digest(headers, expected):
+    assert get_origin_digest(headers) == expected
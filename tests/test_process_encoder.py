@@ -0,0 +1,70 @@
+import io
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import MagicMock
+
+import pytest
+from PIL import Image
+
+from mezcal.storage import LocalStorage, ProcessEncoder
+
+
+@pytest.fixture(scope='module')
+def encoder():
+    encoder = ProcessEncoder(max_workers=1)
+    yield encoder
+    encoder.shutdown()
+
+
+def test_create_from_path(encoder, tmp_path, datadir):
+    local_storage = LocalStorage(tmp_path, encoder=encoder)
+    file = local_storage.get_file('bar/1')
+    file.create(datadir / 'sample.tif')
+    assert file.exists
+    assert Image.open(file.path).format == 'JPEG'
+
+
+def test_create_from_file_object(encoder, tmp_path, datadir):
+    local_storage = LocalStorage(tmp_path, encoder=encoder)
+    file = local_storage.get_file('bar/1')
+    file.create(io.BytesIO((datadir / 'sample.tif').read_bytes()))
+    assert file.exists
+    assert encoder.stats['jobs'] >= 1
+
+
+def test_create_failure(encoder, tmp_path):
+    local_storage = LocalStorage(tmp_path, encoder=encoder)
+    file = local_storage.get_file('bar/1')
+    (tmp_path / 'invalid.tif').write_bytes(b'not an image')
+    with pytest.raises(RuntimeError):
+        file.create(tmp_path / 'invalid.tif')
+    assert not file.exists
+
+
+def mock_executor(result=None, crash=False):
+    executor = MagicMock()
+    future = executor.submit.return_value
+    if crash:
+        future.result.side_effect = BrokenProcessPool
+    else:
+        future.result.return_value = result
+    executor.__enter__.return_value = executor
+    return executor
+
+
+def test_crash_is_retried(monkeypatch, tmp_path):
+    executors = [mock_executor(crash=True), mock_executor(), mock_executor(result=1.5)]
+    monkeypatch.setattr(ProcessEncoder, '_new_executor', staticmethod(lambda *_: executors.pop(0)))
+    encoder = ProcessEncoder(max_workers=2)
+    assert encoder.run(tmp_path / 'image.jpg', tmp_path / 'source.tif') == 1.5
+    # the broken pool was replaced
+    assert executors == []
+    assert encoder.stats['crashes'] == 0
+
+
+def test_repeated_crash_fails(monkeypatch, tmp_path):
+    executors = [mock_executor(crash=True), mock_executor(), mock_executor(crash=True)]
+    monkeypatch.setattr(ProcessEncoder, '_new_executor', staticmethod(lambda *_: executors.pop(0)))
+    encoder = ProcessEncoder(max_workers=2)
+    with pytest.raises(RuntimeError):
+        encoder.run(tmp_path / 'image.jpg', tmp_path / 'source.tif')
+    assert encoder.stats['crashes'] == 1
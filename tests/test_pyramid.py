@@ -0,0 +1,75 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageChops
+
+from mezcal.pyramid import get_levels, write_pyramid
+from mezcal.storage import MezzanineFile
+
+
+def open_pyramid(img, **kwargs):
+    fh = BytesIO()
+    write_pyramid(img, fh, **kwargs)
+    fh.seek(0)
+    return Image.open(fh)
+
+
+def test_get_levels():
+    levels = get_levels(Image.new('RGB', (1000, 300)), tile_size=256)
+    assert [level.size for level in levels] == [(1000, 300), (500, 150), (250, 75)]
+
+
+def test_get_levels_single_tile():
+    assert [level.size for level in get_levels(Image.new('L', (200, 100)))] == [(200, 100)]
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'L'])
+def test_write_pyramid(mode):
+    img = Image.radial_gradient('L').resize((600, 400)).convert(mode)
+    pyramid = open_pyramid(img, tile_size=128)
+    assert pyramid.format == 'TIFF'
+    assert pyramid.n_frames == 4
+    sizes = []
+    for level in range(pyramid.n_frames):
+        pyramid.seek(level)
+        pyramid.load()
+        assert pyramid.mode == mode
+        assert pyramid.tag_v2[322] == pyramid.tag_v2[323] == 128
+        sizes.append(pyramid.size)
+    assert sizes == [(600, 400), (300, 200), (150, 100), (75, 50)]
+
+    pyramid.seek(0)
+    # lossy, but close to the original
+    extrema = ImageChops.difference(pyramid.convert(mode), img).convert('L').getextrema()
+    assert extrema[1] < 16
+
+
+def test_write_pyramid_from_file(datadir):
+    with Image.open(datadir / 'sample.tif') as img:
+        img = img.convert('RGB')
+    pyramid = open_pyramid(img)
+    pyramid.load()
+    assert pyramid.size == img.size
+
+
+def test_create_pyramid_from_cmyk(tmp_path):
+    source = tmp_path / 'source.jpg'
+    Image.new('CMYK', (300, 200), (0, 255, 255, 0)).save(source)
+    file = MezzanineFile(tmp_path / 'out' / 'image.tif')
+    file.create(source)
+    with Image.open(file.path) as img:
+        assert img.mode == 'RGB'
+        assert img.size == (300, 200)
+        # red, with some loss from the JPEG compression
+        r, g, b = img.getpixel((150, 100))
+        assert r > 240 and g < 16 and b < 16
+
+
+def test_write_pyramid_invalid_mode():
+    with pytest.raises(ValueError):
+        write_pyramid(Image.new('RGBA', (10, 10)), BytesIO())
+
+
+def test_write_pyramid_invalid_tile_size():
+    with pytest.raises(ValueError):
+        write_pyramid(Image.new('RGB', (10, 10)), BytesIO(), tile_size=100)
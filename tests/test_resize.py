@@ -0,0 +1,72 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from mezcal.pyramid import write_pyramid
+from mezcal.resize import fit, open_image, downscale
+
+
+def save(img, **kwargs):
+    fh = BytesIO()
+    img.save(fh, **kwargs)
+    fh.seek(0)
+    return fh
+
+
+@pytest.mark.parametrize(
+    ('size', 'max_size', 'expected'),
+    [
+        ((4000, 2000), 1000, (1000, 500)),
+        ((2000, 4000), 1000, (500, 1000)),
+        ((3000, 1), 1000, (1000, 1)),
+    ]
+)
+def test_fit(size, max_size, expected):
+    assert fit(size, max_size) == expected
+
+
+def test_open_jpeg_draft():
+    fh = save(Image.new('RGB', (4000, 2000)), format='JPEG')
+    img = open_image(fh, max_size=1000)
+    # decoded at 1/4 scale
+    assert img.size == (1000, 500)
+
+
+def test_open_jpeg_draft_not_smaller_than_max_size():
+    fh = save(Image.new('RGB', (4000, 2000)), format='JPEG')
+    img = open_image(fh, max_size=1500)
+    # 1/4 scale would be too small
+    assert img.size == (2000, 1000)
+
+
+def test_open_pyramid_subfile():
+    fh = BytesIO()
+    write_pyramid(Image.new('RGB', (1024, 512)), fh, tile_size=128)
+    fh.seek(0)
+    img = open_image(fh, max_size=300)
+    # the levels are 1024, 512, 256, and 128 pixels wide
+    assert img.size == (512, 256)
+
+
+def test_open_without_max_size():
+    fh = save(Image.new('RGB', (4000, 2000)), format='JPEG')
+    assert open_image(fh).size == (4000, 2000)
+
+
+def test_open_small_image():
+    fh = save(Image.new('L', (400, 200)), format='PNG')
+    assert open_image(fh, max_size=1000).size == (400, 200)
+
+
+@pytest.mark.parametrize('mode', ['L', 'RGB', 'CMYK'])
+def test_downscale(mode):
+    img = downscale(Image.new(mode, (5000, 3000)), 1000)
+    assert img.mode == mode
+    assert img.size == (1000, 600)
+
+
+def test_downscale_unchanged():
+    img = Image.new('RGB', (500, 300))
+    assert downscale(img, 1000) is img
+    assert downscale(img, 0) is img
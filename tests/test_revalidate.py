@@ -0,0 +1,180 @@
+import os
+from http import HTTPStatus
+from time import time
+from unittest.mock import patch
+
+import pytest
+
+from mezcal.admission import Limiter, Overloaded
+from mezcal.http import OriginRepository, get_origin_metadata, get_conditional_headers
+from mezcal.revalidate import Revalidator, record_origin_metadata
+from mezcal.storage import LocalStorage
+
+BASE_URL = 'http://example.org/repo/'
+ORIGIN_HEADERS = {
+    'Content-Type': 'image/tiff',
+    'ETag': '"v1"',
+    'Last-Modified': 'Wed, 01 Jan 2025 00:00:00 GMT',
+    'Content-Length': '1234',
+}
+
+
+class MockNotModifiedResponse:
+    status_code = HTTPStatus.NOT_MODIFIED
+    headers = {}
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def local_file(tmp_path, datadir):
+    file = LocalStorage(tmp_path).get_file('foo')
+    with open(datadir / 'sample.tif', 'rb') as fh:
+        file.create(fh)
+    with file.lock.acquire():
+        record_origin_metadata(file, ORIGIN_HEADERS)
+    return file
+
+
+def make_stale(local_file):
+    """Make local_file older than max_age, and last validated that long ago, and return its info."""
+    old = time() - 120
+    os.utime(local_file.path, (old, old))
+    with local_file.lock.acquire():
+        local_file.update_metadata(validated=old)
+    return local_file.info()
+
+
+@pytest.fixture
+def revalidator():
+    revalidator = Revalidator(OriginRepository(BASE_URL), max_age=60)
+    yield revalidator
+    revalidator.shutdown()
+
+
+def test_get_origin_metadata():
+    assert get_origin_metadata(ORIGIN_HEADERS) == {
+        'etag': '"v1"',
+        'last_modified': 'Wed, 01 Jan 2025 00:00:00 GMT',
+        'content_length': 1234,
+    }
+    assert get_origin_metadata({}) == {'etag': None, 'last_modified': None, 'content_length': None}
+
+
+def test_get_conditional_headers():
+    assert get_conditional_headers(None) == {}
+    assert get_conditional_headers(get_origin_metadata(ORIGIN_HEADERS)) == {
+        'If-None-Match': '"v1"',
+        'If-Modified-Since': 'Wed, 01 Jan 2025 00:00:00 GMT',
+    }
+
+
+def test_origin_metadata_recorded(local_file):
+    metadata = local_file.read_metadata()
+    assert metadata['origin']['etag'] == '"v1"'
+    assert metadata['validated'] <= time()
+
+
+def test_is_stale(revalidator, local_file):
+    assert not revalidator.is_stale(local_file, local_file.info())
+    assert revalidator.is_stale(local_file, make_stale(local_file))
+
+
+def test_is_stale_reads_metadata_only_for_old_files(revalidator, local_file):
+    new_info = local_file.info()
+    os.utime(local_file.path, (time() - 120, time() - 120))
+    old_info = local_file.info()
+    with patch.object(local_file, 'read_metadata', wraps=local_file.read_metadata) as mock_read_metadata:
+        assert not revalidator.is_stale(local_file, new_info)
+        mock_read_metadata.assert_not_called()
+        # validated recently, which is remembered
+        assert not revalidator.is_stale(local_file, old_info)
+        assert not revalidator.is_stale(local_file, old_info)
+    assert mock_read_metadata.call_count == 1
+
+
+def test_revalidate_not_modified(revalidator, local_file):
+    etag = local_file.info().etag
+    with patch.object(OriginRepository, 'get', return_value=MockNotModifiedResponse()) as mock_get:
+        assert revalidator.revalidate('foo', local_file, local_file.read_metadata()['origin']) == 'not_modified'
+    assert mock_get.call_args.kwargs['validators']['etag'] == '"v1"'
+    assert local_file.info().etag == etag
+
+
+def test_revalidate_updated(revalidator, local_file, datadir, image_response):
+    response = image_response(datadir / 'sample.tif', headers={**ORIGIN_HEADERS, 'ETag': '"v2"'})
+    with patch.object(OriginRepository, 'get', return_value=response):
+        with patch.object(local_file, 'create', wraps=local_file.create) as mock_create:
+            assert revalidator.revalidate('foo', local_file, local_file.read_metadata()['origin']) == 'updated'
+    mock_create.assert_called_once()
+    assert local_file.read_metadata()['origin']['etag'] == '"v2"'
+
+
+def test_revalidate_deleted(revalidator, local_file):
+    local_file.delete()
+    with patch.object(OriginRepository, 'get', return_value=MockNotModifiedResponse()):
+        assert revalidator.revalidate('foo', local_file, None) == 'skipped'
+    assert not local_file.exists
+
+
+def test_submit(revalidator, local_file):
+    assert not revalidator.submit('foo', local_file, local_file.info())
+    info = make_stale(local_file)
+    with patch.object(OriginRepository, 'get', return_value=MockNotModifiedResponse()):
+        assert revalidator.submit('foo', local_file, info)
+        revalidator.shutdown()
+    assert revalidator.stats['not_modified'] == 1
+    assert revalidator.stats['in_progress'] == 0
+    assert not revalidator.is_stale(local_file, local_file.info())
+
+
+def test_submit_failed_is_not_retried_immediately(revalidator, local_file):
+    info = make_stale(local_file)
+    with patch.object(OriginRepository, 'get', side_effect=RuntimeError('Unable to retrieve resource')) as mock_get:
+        assert revalidator.submit('foo', local_file, info)
+        revalidator.shutdown()
+        assert not revalidator.submit('foo', local_file, info)
+    assert mock_get.call_count == 1
+    assert revalidator.stats['failed'] == 1
+
+
+def test_revalidate_skipped_when_limiter_full(local_file):
+    fetch_limiter = Limiter('fetch', limit=1, queue_size=5)
+    revalidator = Revalidator(OriginRepository(BASE_URL), max_age=60, fetch_limiter=fetch_limiter)
+    info = make_stale(local_file)
+    with fetch_limiter.slot(), patch.object(OriginRepository, 'get') as mock_get:
+        assert revalidator.submit('foo', local_file, info)
+        revalidator.shutdown()
+    mock_get.assert_not_called()
+    assert revalidator.stats['overloaded'] == 1
+    assert fetch_limiter.stats['waiting'] == 0
+    # tried again after retry_interval, not on the next request
+    assert not revalidator.submit('foo', local_file, info)
+
+
+def test_revalidate_takes_encode_slot(local_file, datadir, image_response):
+    encode_limiter = Limiter('encode', limit=1)
+    revalidator = Revalidator(OriginRepository(BASE_URL), max_age=60, encode_limiter=encode_limiter)
+    response = image_response(datadir / 'sample.tif', headers={**ORIGIN_HEADERS, 'ETag': '"v2"'})
+    with patch.object(OriginRepository, 'get', return_value=response), \
+            patch.object(local_file, 'create', wraps=local_file.create) as mock_create:
+        with encode_limiter.slot(), pytest.raises(Overloaded):
+            revalidator.revalidate('foo', local_file, None)
+        mock_create.assert_not_called()
+    response = image_response(datadir / 'sample.tif', headers={**ORIGIN_HEADERS, 'ETag': '"v2"'})
+    with patch.object(OriginRepository, 'get', return_value=response):
+        assert revalidator.revalidate('foo', local_file, None) == 'updated'
+    assert encode_limiter.stats['admitted'] == 2
+    assert encode_limiter.stats['active'] == 0
+
+
+def test_app_serves_stale_file(make_client, local_file, tmp_path):
+    with local_file.lock.acquire():
+        local_file.update_metadata(validated=time() - 120)
+    client = make_client(local_storage=LocalStorage(tmp_path), origin_max_age=60)
+    with patch.object(Revalidator, 'submit') as mock_submit:
+        response = client.get('/images/foo')
+    assert response.status_code == HTTPStatus.OK
+    mock_submit.assert_called_once()
+    assert 'revalidation' in client.get('/stats').json
@@ -0,0 +1,152 @@
+from http import HTTPStatus
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+from mezcal.http import OriginRepository
+from mezcal.index import CacheIndex
+from mezcal.shared import SharedStorage, FilesystemBackend, S3Backend
+from mezcal.storage import LocalStorage, EncodingOptions
+
+
+@pytest.fixture
+def s3_backend():
+    boto3 = pytest.importorskip('boto3')
+    moto = pytest.importorskip('moto')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='mezcal')
+        yield S3Backend(client, 'mezcal', prefix='cache', multipart_threshold=1024 * 1024)
+
+
+@pytest.fixture(params=['filesystem', 's3'])
+def backend(request, tmp_path):
+    if request.param == 'filesystem':
+        return FilesystemBackend(tmp_path / 'shared')
+    return request.getfixturevalue('s3_backend')
+
+
+def make_source() -> BytesIO:
+    source = BytesIO()
+    Image.linear_gradient('L').convert('RGB').save(source, format='PNG')
+    source.seek(0)
+    return source
+
+
+def make_node(tmp_path, backend, name, **options) -> LocalStorage:
+    storage_dir = tmp_path / name
+    return LocalStorage(
+        storage_dir, options=EncodingOptions(**options), shared=SharedStorage(backend, storage_dir)
+    )
+
+
+def test_upload_and_download(tmp_path, backend):
+    path = tmp_path / 'file'
+    path.write_bytes(b'data')
+    assert backend.upload('foo/image.jpg', path, {'etag': 'abc'})
+    fh = BytesIO()
+    assert backend.download('foo/image.jpg', fh) == {'etag': 'abc'}
+    assert fh.getvalue() == b'data'
+    assert backend.get_metadata('foo/image.jpg') == {'etag': 'abc'}
+
+
+def test_download_missing(backend):
+    fh = BytesIO()
+    assert backend.download('foo/image.jpg', fh) is None
+    assert fh.getvalue() == b''
+    assert backend.get_metadata('foo/image.jpg') is None
+
+
+def test_conditional_upload(tmp_path, backend):
+    path = tmp_path / 'file'
+    path.write_bytes(b'first')
+    assert backend.upload('foo/image.jpg', path, {'etag': '1'})
+    path.write_bytes(b'second')
+    assert not backend.upload('foo/image.jpg', path, {'etag': '2'})
+    assert backend.get_metadata('foo/image.jpg') == {'etag': '1'}
+    assert backend.upload('foo/image.jpg', path, {'etag': '2'}, replace=True)
+    fh = BytesIO()
+    assert backend.download('foo/image.jpg', fh) == {'etag': '2'}
+    assert fh.getvalue() == b'second'
+
+
+def test_list_and_delete(tmp_path, backend):
+    path = tmp_path / 'file'
+    path.write_bytes(b'data')
+    for key in ('foo/image.jpg', 'foo/image.tif', 'foo/bar/image.jpg'):
+        backend.upload(key, path, {})
+    # objects in "subdirectories" belong to other repository paths
+    assert backend.list('foo') == ['foo/image.jpg', 'foo/image.tif']
+    backend.delete('foo/image.jpg')
+    assert backend.list('foo') == ['foo/image.tif']
+    assert backend.list('baz') == []
+
+
+def test_multipart_upload(tmp_path, s3_backend):
+    path = tmp_path / 'file'
+    data = bytes(range(256)) * (6 * 1024 * 1024 // 256)
+    path.write_bytes(data)
+    assert s3_backend.upload('foo/image.tif', path, {'etag': 'abc'})
+    fh = BytesIO()
+    assert s3_backend.download('foo/image.tif', fh) == {'etag': 'abc'}
+    assert fh.getvalue() == data
+
+
+def test_nodes_share_files(tmp_path, backend):
+    first = make_node(tmp_path, backend, 'first')
+    second = make_node(tmp_path, backend, 'second')
+    file = first.get_file('foo')
+    file.create(make_source())
+    assert first.shared.stats['upload'] == 1
+
+    other_file = second.get_file('foo')
+    assert other_file.fetch_shared()
+    assert other_file.path.read_bytes() == file.path.read_bytes()
+    assert other_file.info().etag == file.info().etag
+    assert second.shared.stats['hit'] == 1
+
+    assert not second.get_file('bar').fetch_shared()
+    assert second.shared.stats['miss'] == 1
+
+
+def test_conflicting_create_uses_shared_copy(tmp_path, backend):
+    first = make_node(tmp_path, backend, 'first', quality=90)
+    second = make_node(tmp_path, backend, 'second', quality=50)
+    file = first.get_file('foo')
+    file.create(make_source())
+    # created at the same time, before the first node's copy was uploaded
+    other_file = second.get_file('foo')
+    other_file.create(make_source())
+    assert second.shared.stats['conflict'] == 1
+    assert other_file.path.read_bytes() == file.path.read_bytes()
+    assert other_file.info().etag == file.info().etag
+
+
+def test_delete(tmp_path, backend):
+    node = make_node(tmp_path, backend, 'node')
+    node.get_file('foo').create(make_source())
+    node.get_file('foo/bar').create(make_source())
+    node.shared.delete(node.get_dir('foo'))
+    assert backend.get_metadata('foo/image.jpg') is None
+    assert backend.get_metadata('foo/bar/image.jpg') is not None
+
+
+def test_fetched_files_are_indexed(make_client, tmp_path):
+    backend = FilesystemBackend(tmp_path / 'shared')
+    first = make_node(tmp_path, backend, 'first')
+    for path in ('foo', 'bar'):
+        first.get_file(path).create(make_source())
+    second = make_node(tmp_path, backend, 'second')
+    index = CacheIndex(second, max_files=1, db_path=tmp_path / 'index.sqlite')
+    client = make_client(local_storage=second, cache_index=index)
+    with patch.object(OriginRepository, 'get') as mock_get:
+        for path in ('foo', 'bar'):
+            assert client.get(f'/images/{path}').status_code == HTTPStatus.OK
+    mock_get.assert_not_called()
+    assert second.shared.stats['hit'] == 2
+    index.flush()
+    assert index.totals[0] == 2
+    assert index.evict() >= 1
+    assert not all(second.get_file(path).exists for path in ('foo', 'bar'))
@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from unittest.mock import MagicMock
+
+import pytest
+
+from mezcal.singleflight import SingleFlight
+
+
+def test_run_single_caller():
+    in_flight = SingleFlight()
+    assert in_flight.run('foo', lambda: 42) == 42
+    assert 'foo' not in in_flight
+    assert len(in_flight) == 0
+
+
+def test_concurrent_callers_share_one_run():
+    in_flight = SingleFlight()
+    started = Event()
+    release = Event()
+
+    def work():
+        started.set()
+        release.wait(timeout=5)
+        return 'done'
+
+    func = MagicMock(side_effect=work)
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        leader = executor.submit(in_flight.run, 'foo', func)
+        started.wait(timeout=5)
+        assert 'foo' in in_flight
+        waiters = [executor.submit(in_flight.run, 'foo', func, 5) for _ in range(4)]
+        release.set()
+        results = [leader.result()] + [waiter.result() for waiter in waiters]
+
+    # any waiter that arrived after the leader finished runs it again,
+    # but there should never be more than one run at a time
+    assert func.call_count < 5
+    assert results == ['done'] * 5
+    assert len(in_flight) == 0
+
+
+def test_waiters_get_leader_exception():
+    in_flight = SingleFlight()
+    started = Event()
+    release = Event()
+
+    def work():
+        started.set()
+        release.wait(timeout=5)
+        raise ValueError('boom')
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(in_flight.run, 'foo', work)
+        started.wait(timeout=5)
+        waiter = executor.submit(in_flight.run, 'foo', work, 5)
+        release.set()
+        with pytest.raises(ValueError):
+            leader.result()
+        with pytest.raises(ValueError):
+            waiter.result()
+    assert len(in_flight) == 0
+
+
+def test_waiter_timeout():
+    in_flight = SingleFlight()
+    started = Event()
+    release = Event()
+
+    def work():
+        started.set()
+        release.wait(timeout=5)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(in_flight.run, 'foo', work)
+        started.wait(timeout=5)
+        with pytest.raises(TimeoutError):
+            in_flight.run('foo', work, timeout=0.01)
+        release.set()
+
+
+def test_different_keys_do_not_wait():
+    in_flight = SingleFlight()
+    release = Event()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(in_flight.run, 'foo', lambda: release.wait(timeout=5))
+        assert in_flight.run('bar', lambda: 'bar') == 'bar'
+        release.set()
@@ -0,0 +1,78 @@
+import pytest
+from PIL import Image, ImageChops
+
+from mezcal.convert import convert_to_jpeg_mode
+from mezcal.resize import downscale
+from mezcal.storage import MezzanineFile, EncodingOptions
+from mezcal.stream import can_stream, stream_to_jpeg_mode
+
+
+def make_tiff(path, mode, size=(300, 200), **kwargs):
+    img = Image.linear_gradient('L').resize(size).convert(mode)
+    img.save(path, format='TIFF', **kwargs)
+    return path
+
+
+@pytest.mark.parametrize('mode', ['L', 'I;16', 'RGB', 'RGBA'])
+def test_stream_matches_full_decode(tmp_path, mode):
+    path = make_tiff(tmp_path / 'source.tif', mode)
+    with Image.open(path) as img:
+        # for L and RGB, this is img itself, so it has to be loaded before img is closed
+        expected = convert_to_jpeg_mode(img)
+        expected.load()
+    img = Image.open(path)
+    assert can_stream(img, working_set=1000)
+    streamed = stream_to_jpeg_mode(path, img, working_set=1000)
+    assert streamed.size == expected.size
+    assert ImageChops.difference(streamed, expected).getbbox() is None
+
+
+def test_stream_with_max_size(tmp_path):
+    path = make_tiff(tmp_path / 'source.tif', 'RGB', size=(1000, 600))
+    streamed = downscale(stream_to_jpeg_mode(path, Image.open(path), max_size=100, working_set=1000), 100)
+    assert streamed.size == (100, 60)
+
+
+def test_cannot_stream_small_image(tmp_path):
+    path = make_tiff(tmp_path / 'source.tif', 'L')
+    assert not can_stream(Image.open(path), working_set=1024 * 1024)
+    assert not can_stream(Image.open(path), working_set=0)
+
+
+def test_cannot_stream_compressed_image(tmp_path):
+    path = make_tiff(tmp_path / 'source.tif', 'L', compression='tiff_lzw')
+    assert not can_stream(Image.open(path), working_set=1000)
+
+
+def test_cannot_stream_jpeg(tmp_path):
+    path = tmp_path / 'source.jpg'
+    Image.new('RGB', (300, 200)).save(path)
+    assert not can_stream(Image.open(path), working_set=1000)
+
+
+def test_create_streamed(tmp_path):
+    path = make_tiff(tmp_path / 'source.tif', 'I;16')
+    file = MezzanineFile(tmp_path / 'out' / 'image.jpg', options=EncodingOptions(working_set=1000))
+    file.create(path)
+    with Image.open(file.path) as img:
+        assert img.mode == 'L'
+        assert img.size == (300, 200)
+
+
+@pytest.mark.parametrize('orientation', [1, 3, 6, 8])
+def test_stream_orientation(tmp_path, orientation):
+    path = make_tiff(tmp_path / 'source.tif', 'RGB', size=(500, 250), tiffinfo={274: orientation})
+    with Image.open(path) as img:
+        expected = img.copy()
+    img = Image.open(path)
+    assert can_stream(img, working_set=1000)
+    streamed = stream_to_jpeg_mode(path, img, working_set=1000)
+    assert streamed.size == expected.size
+    assert ImageChops.difference(streamed, expected).getbbox() is None
+
+
+def test_create_streamed_orientation(datadir, tmp_path):
+    file = MezzanineFile(tmp_path / 'image.jpg', options=EncodingOptions(working_set=1000))
+    file.create(datadir / '500x250_orientation_6.tif')
+    with Image.open(file.path) as img:
+        assert img.size == (250, 500)
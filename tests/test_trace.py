@@ -0,0 +1,87 @@
+import json
+from http import HTTPStatus
+from unittest.mock import patch
+
+from mezcal.http import OriginRepository
+from mezcal.metrics import Timer
+from mezcal.trace import Trace, TraceLog, current_trace, record
+
+
+def parse_server_timing(value: str) -> dict[str, float]:
+    stages = {}
+    for metric in value.split(', '):
+        name, duration = metric.split(';dur=')
+        stages[name] = float(duration)
+    return stages
+
+
+def test_trace():
+    trace = Trace('foo', trace_id='abc')
+    trace.add('decode', 0.5)
+    trace.add('decode', 0.25)
+    trace.add('encode', 0.001)
+    stages = parse_server_timing(trace.server_timing())
+    assert stages['decode'] == 750.0
+    assert stages['encode'] == 1.0
+    assert list(stages) == ['decode', 'encode', 'total']
+    assert trace.to_dict(200)['id'] == 'abc'
+
+
+def test_record_without_trace():
+    assert current_trace.get() is None
+    record('decode', 1.0)
+
+
+def test_timer_records_stage():
+    trace = Trace('foo')
+    token = current_trace.set(trace)
+    try:
+        with Timer('do something', stage='origin'):
+            pass
+    finally:
+        current_trace.reset(token)
+    assert 'origin' in trace.stages
+
+
+def test_trace_log(tmp_path):
+    trace_log = TraceLog(tmp_path / 'trace.log', sample_rate=1.0)
+    trace_log.write(Trace('foo', trace_id='abc'), 200)
+    trace_log.close()
+    entry = json.loads((tmp_path / 'trace.log').read_text())
+    assert entry['id'] == 'abc'
+    assert entry['path'] == 'foo'
+    assert entry['status'] == 200
+
+
+def test_trace_log_not_sampled(tmp_path):
+    trace_log = TraceLog(tmp_path / 'trace.log', sample_rate=0.0)
+    trace_log.write(Trace('foo'), 200)
+    trace_log.close()
+    assert (tmp_path / 'trace.log').read_text() == ''
+
+
+def test_server_timing_hit(test_client):
+    response = test_client.get('/images/foo', headers={'X-Request-ID': 'request-1'})
+    assert response.status_code == HTTPStatus.OK
+    assert list(parse_server_timing(response.headers['Server-Timing'])) == ['total']
+    assert response.headers['X-Request-ID'] == 'request-1'
+
+
+def test_server_timing_miss(make_client, datadir, tmp_path, image_response):
+    client = make_client(trace_log=TraceLog(tmp_path / 'trace.log', sample_rate=1.0))
+    origin_response = image_response(datadir / 'sample.tif', content_type='image/tiff')
+    with patch.object(OriginRepository, 'get', return_value=origin_response):
+        response = client.get('/images/bar')
+    assert response.status_code == HTTPStatus.OK
+    stages = parse_server_timing(response.headers['Server-Timing'])
+    assert {'lock', 'download', 'decode', 'convert', 'encode', 'total'} <= stages.keys()
+    assert current_trace.get() is None
+
+    entry = json.loads((tmp_path / 'trace.log').read_text())
+    assert entry['id'] == response.headers['X-Request-ID']
+    assert entry['path'] == 'bar'
+    assert entry['stages_ms'].keys() == stages.keys() - {'total'}
+
+
+def test_no_server_timing_on_other_endpoints(test_client):
+    assert 'Server-Timing' not in test_client.get('/stats').headers
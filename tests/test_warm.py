@@ -0,0 +1,78 @@
+import io
+from unittest.mock import patch
+
+import pytest
+from filelock import Timeout
+
+from mezcal.http import OriginRepository, NotAnImageError
+from mezcal.locks import DirectoryLock
+from mezcal.storage import LocalStorage
+from mezcal.warm import read_paths, Warmer, WarmResult, run
+
+BASE_URL = 'http://example.org/repo/'
+
+
+@pytest.fixture
+def warmer(tmp_path):
+    # encode in the fetch threads instead of worker processes, so that the tests run quickly
+    return Warmer(
+        local_storage=LocalStorage(tmp_path / 'cache'),
+        origin_repo=OriginRepository(BASE_URL),
+        fetch_workers=2,
+    )
+
+
+def test_read_paths():
+    lines = [
+        'foo/1\n',
+        '\n',
+        '# comment\n',
+        f'{BASE_URL}foo/2\n',
+        'http://bad-example.org/repo/foo/3\n',
+        '/foo/4\n',
+    ]
+    assert list(read_paths(lines, BASE_URL)) == ['foo/1', 'foo/2', 'foo/4']
+
+
+def test_warm(warmer, datadir, image_response):
+    def get(*_, **__):
+        return image_response(datadir / 'sample.tif', content_type='image/tiff')
+
+    with patch.object(OriginRepository, 'get', side_effect=get):
+        stats = warmer.run(['foo/1', 'foo/2', 'foo/1'])
+    assert warmer.local_storage.get_file('foo/1').exists
+    assert warmer.local_storage.get_file('foo/2').exists
+    assert stats.total == 3
+    assert stats.results[WarmResult.CREATED] + stats.results[WarmResult.SKIPPED] == 3
+    assert stats.results[WarmResult.CREATED] >= 2
+    assert stats.results[WarmResult.FAILED] == 0
+    assert stats.stages['encode'].count == stats.results[WarmResult.CREATED]
+    assert stats.origin_bytes > 0
+    assert 'created' in stats.report()
+
+
+def test_warm_skips_existing(warmer):
+    file = warmer.local_storage.get_file('foo/1')
+    file.path.parent.mkdir(parents=True)
+    file.path.write_bytes(b'')
+    with patch.object(OriginRepository, 'get') as mock_get:
+        assert warmer.warm('foo/1') == WarmResult.SKIPPED
+    mock_get.assert_not_called()
+
+
+@pytest.mark.parametrize('error', [NotAnImageError, RuntimeError('Unable to retrieve resource')])
+def test_warm_origin_failure(warmer, error):
+    with patch.object(OriginRepository, 'get', side_effect=error):
+        assert warmer.warm('foo/1') == WarmResult.FAILED
+    assert warmer.stats.results[WarmResult.FAILED] == 1
+
+
+def test_warm_lock_timeout(warmer):
+    with patch.object(DirectoryLock, 'acquire', side_effect=Timeout('foo')):
+        assert warmer.warm('foo/1') == WarmResult.FAILED
+
+
+def test_run_requires_base_url(monkeypatch):
+    monkeypatch.delenv('REPO_BASE_URL', raising=False)
+    with pytest.raises(SystemExit):
+        run([], stdin=io.StringIO(''))
@@ -0,0 +1,96 @@
+import os
+import signal
+import socket
+from http.client import HTTPConnection
+from multiprocessing import get_context
+from time import sleep
+
+import pytest
+from waitress import create_server
+
+from mezcal.workers import Prefork, ServerOptions, bind, serve_until_stopped, warm_up
+
+
+def test_bind():
+    sock = bind('127.0.0.1:0', backlog=16)
+    try:
+        host, port = sock.getsockname()
+        assert host == '127.0.0.1'
+        assert port > 0
+        socket.create_connection((host, port)).close()
+    finally:
+        sock.close()
+
+
+def test_waitress_args():
+    args = ServerOptions(threads=8, connection_limit=500).waitress_args
+    assert args['threads'] == 8
+    assert args['connection_limit'] == 500
+    assert 'listen' not in args
+
+
+def test_warm_up():
+    warm_up()
+
+
+def slow_app(environ, start_response):
+    sleep(0.5)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'done']
+
+
+def serve_slow_app(sock):
+    server = create_server(slow_app, sockets=[sock])
+    serve_until_stopped(server, shutdown_timeout=5)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork()')
+def test_serve_until_stopped_finishes_requests():
+    sock = bind('127.0.0.1:0', backlog=16)
+    # in a separate process, so that the signal handlers don't affect pytest,
+    # and a server that never stops can be killed instead of hanging the tests
+    process = get_context('fork').Process(target=serve_slow_app, args=(sock,))
+    process.start()
+    try:
+        connection = HTTPConnection(*sock.getsockname(), timeout=10)
+        connection.request('GET', '/')
+        # the request is in progress when the signal arrives
+        sleep(0.2)
+        os.kill(process.pid, signal.SIGTERM)
+        assert connection.getresponse().read() == b'done'
+        process.join(timeout=10)
+        assert process.exitcode == 0
+    finally:
+        if process.is_alive():
+            process.kill()
+            process.join()
+        sock.close()
+
+
+def write_pid_and_wait(directory, sock, worker):
+    (directory / f'{worker}.tmp').write_text(str(os.getpid()))
+    (directory / f'{worker}.tmp').rename(directory / str(worker))
+    signal.pause()
+
+
+def run_prefork(directory, sock):
+    Prefork(sock, workers=2, target=lambda s, w: write_pid_and_wait(directory, s, w), shutdown_timeout=1).run()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork()')
+def test_prefork(tmp_path):
+    sock = bind('127.0.0.1:0', backlog=16)
+    process = get_context('fork').Process(target=run_prefork, args=(tmp_path, sock))
+    process.start()
+    for _ in range(50):
+        if (tmp_path / '0').exists() and (tmp_path / '1').exists():
+            break
+        sleep(0.1)
+    pids = [int((tmp_path / str(worker)).read_text()) for worker in range(2)]
+    process.terminate()
+    process.join(timeout=10)
+    sock.close()
+    assert process.exitcode == 0
+    for pid in pids:
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)